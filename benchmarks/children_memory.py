@@ -0,0 +1,47 @@
+"""Measures the memory held by the labelled children of a histogram.
+
+Creates children of a 12 buckets histogram on an in-memory SQLite backend
+and reports the Python memory allocated per child:
+
+    python benchmarks/children_memory.py --children 10000
+"""
+
+import argparse
+import tracemalloc
+
+from prometheus_client import CollectorRegistry
+
+from prometheus_distributed_client import setup
+from prometheus_distributed_client.sqlite import Histogram
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--children", type=int, default=10000)
+    args = parser.parse_args()
+
+    setup(sqlite=":memory:", created="disabled")
+    histogram = Histogram(
+        "latency",
+        "...",
+        ["service", "endpoint"],
+        buckets=BUCKETS,
+        registry=CollectorRegistry(),
+    )
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    for index in range(args.children):
+        histogram.labels(f"service-{index % 10}", f"/endpoint/{index}")
+    after = tracemalloc.take_snapshot()
+    allocated = sum(
+        stat.size_diff for stat in after.compare_to(before, "filename")
+    )
+    print(f"children: {args.children}")
+    print(f"allocated: {allocated / 2**20:.1f} MiB")
+    print(f"per child: {allocated / args.children:.0f} bytes")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+"""Measures the cold-start cost of a short-lived process.
+
+Each run is a fresh interpreter importing the SQLite backend, calling
+``setup()`` with a database path, declaring a few metrics and writing one
+value twice. Reports the median over the runs of each step, for a new
+database (whose tables are created) and for an existing one (whose tables
+are only looked up), and which backend libraries the import loaded:
+
+    python benchmarks/cold_start.py --runs 20
+
+``python -X importtime -c "import prometheus_distributed_client.sqlite"``
+details the import step.
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+CHILD = """
+import json, sys, time
+start = time.perf_counter()
+from prometheus_client import CollectorRegistry
+from prometheus_distributed_client import setup, sqlite
+imported = time.perf_counter()
+setup(sqlite=sys.argv[1])
+registry = CollectorRegistry()
+jobs = sqlite.Counter("jobs", "...", ["kind"], registry=registry)
+sqlite.Gauge("last_run", "...", registry=registry)
+sqlite.Histogram("duration", "...", registry=registry)
+declared = time.perf_counter()
+jobs.labels("cron").inc()
+first = time.perf_counter()
+jobs.labels("cron").inc()
+second = time.perf_counter()
+print(json.dumps({
+    "import": imported - start,
+    "setup + declare": declared - imported,
+    "first write": first - declared,
+    "next write": second - first,
+    "loaded": sorted({"redis", "sqlite3"} & set(sys.modules)),
+}))
+"""
+
+STEPS = ("import", "setup + declare", "first write", "next write")
+
+
+def run(path: str) -> dict:
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    output = subprocess.run(
+        [sys.executable, "-c", CHILD, path],
+        capture_output=True,
+        check=True,
+        text=True,
+        env={**os.environ, "PYTHONPATH": root},
+    ).stdout
+    return json.loads(output)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=20)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        new, existing = [], []
+        for index in range(args.runs):
+            path = os.path.join(directory, f"metrics_{index}.db")
+            new.append(run(path))
+            existing.append(run(path))
+    for name, results in (("new database", new), ("existing", existing)):
+        timings = "  ".join(
+            f"{step} {statistics.median(r[step] for r in results) * 1e3:6.2f}"
+            " ms"
+            for step in STEPS
+        )
+        print(f"{name:<13} {timings}")
+    print("loaded by the first write:", ", ".join(new[0]["loaded"]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+"""Compares classic and exponential histograms on a wide distribution.
+
+Observes log-uniform latencies spanning five orders of magnitude (100µs to
+10s) with a classic histogram (the prometheus_client default buckets) and
+exponential histograms, on an in-memory SQLite backend, and reports per
+layout the statements written per observation, the time per observation,
+the stored buckets and the relative error of quantiles estimated from the
+rendered buckets as ``histogram_quantile`` does:
+
+    python benchmarks/exponential_histogram.py --observations 20000
+"""
+
+import argparse
+import math
+import random
+import sqlite3
+import time
+
+from prometheus_client import CollectorRegistry
+
+from prometheus_distributed_client import setup
+from prometheus_distributed_client.sqlite import (
+    ExponentialHistogram,
+    Histogram,
+)
+
+QUANTILES = (0.1, 0.5, 0.9, 0.99)
+
+
+def histogram_quantile(q: float, buckets) -> float:
+    """Linear interpolation within cumulative (le, count) buckets."""
+    total = buckets[-1][1]
+    rank = q * total
+    lower_bound, lower_count = 0.0, 0.0
+    for bound, count in buckets:
+        if count >= rank:
+            if math.isinf(bound):
+                return lower_bound
+            share = (rank - lower_count) / ((count - lower_count) or 1)
+            return lower_bound + (bound - lower_bound) * share
+        lower_bound, lower_count = bound, count
+    return lower_bound
+
+
+def run(name, metric, values, conn):
+    statements = []
+    conn.set_trace_callback(statements.append)
+    start = time.perf_counter()
+    for value in values:
+        metric.observe(value)
+    elapsed = time.perf_counter() - start
+    conn.set_trace_callback(None)
+    buckets = sorted(
+        (float(sample.labels["le"]), sample.value)
+        for family in metric.collect()
+        for sample in family.samples
+        if sample.name.endswith("_bucket")
+    )
+    ordered = sorted(values)
+    errors = []
+    for q in QUANTILES:
+        expected = ordered[int(q * (len(ordered) - 1))]
+        estimate = histogram_quantile(q, buckets)
+        error = abs(estimate - expected) / expected
+        errors.append(f"p{q * 100:g} {error:6.1%}")
+    writes = sum(
+        statement.lstrip().startswith("INSERT") for statement in statements
+    )
+    print(
+        f"{name:<28} {writes / len(values):5.1f} writes/obs "
+        f"{elapsed / len(values) * 1e6:7.1f} µs/obs "
+        f"{len(buckets):4d} buckets  {'  '.join(errors)}"
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--observations", type=int, default=20000)
+    args = parser.parse_args()
+
+    rng = random.Random(42)
+    values = [10 ** rng.uniform(-4, 1) for _ in range(args.observations)]
+    conn = sqlite3.connect(":memory:")
+    setup(sqlite=conn, created="disabled")
+    layouts = [
+        ("classic (default buckets)", Histogram, {}),
+        ("exponential schema 3", ExponentialHistogram, {"schema": 3}),
+        (
+            "exponential, rendered at 0",
+            ExponentialHistogram,
+            {"schema": 3, "render_schema": 0},
+        ),
+    ]
+    for index, (name, cls, kwargs) in enumerate(layouts):
+        metric = cls(
+            f"latency_{index}", "...", registry=CollectorRegistry(), **kwargs
+        )
+        run(name, metric, values, conn)
+
+
+if __name__ == "__main__":
+    main()
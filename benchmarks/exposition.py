@@ -0,0 +1,86 @@
+"""Compares prometheus_client.generate_latest with the direct renderer.
+
+Fills an in-memory SQLite database with labelled counters and times both
+renderers over the same registry:
+
+    python benchmarks/exposition.py --series 1000000
+
+The first direct rendering fills the fragment cache, the following ones
+are the steady state of a scraped exporter.
+"""
+
+import argparse
+import sqlite3
+import time
+
+from prometheus_client import CollectorRegistry, generate_latest
+
+from prometheus_distributed_client import setup
+from prometheus_distributed_client.exposition import (
+    FragmentCache,
+    generate_latest as direct_generate_latest,
+)
+from prometheus_distributed_client.fields import encode_field
+from prometheus_distributed_client.sqlite import Counter
+
+LABELNAMES = ("service", "endpoint", "status")
+METRICS = 10
+
+
+def fill(conn: sqlite3.Connection, series: int) -> CollectorRegistry:
+    registry = CollectorRegistry()
+    per_metric = series // METRICS
+    for index in range(METRICS):
+        name = f"bench_requests_{index}"
+        Counter(name, "exposition benchmark", LABELNAMES, registry=registry)
+        conn.executemany(
+            "INSERT INTO metrics (metric_key, subkey, value) VALUES (?, ?, ?)",
+            (
+                (
+                    name,
+                    encode_field(
+                        "_total",
+                        LABELNAMES,
+                        ("checkout", f"/api/items/{i}", "200"),
+                    ),
+                    float(i),
+                )
+                for i in range(per_metric)
+            ),
+        )
+    conn.commit()
+    return registry
+
+
+def timed(label: str, render, runs: int) -> None:
+    durations = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        size = len(render())
+        durations.append(time.perf_counter() - start)
+    print(
+        f"{label}: best {min(durations):.3f}s, "
+        f"first {durations[0]:.3f}s, {size} bytes"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--series", type=int, default=100000)
+    parser.add_argument("--runs", type=int, default=3)
+    args = parser.parse_args()
+
+    conn = sqlite3.connect(":memory:")
+    setup(sqlite=conn, created="disabled")
+    registry = fill(conn, args.series)
+    cache = FragmentCache(max_size=args.series)
+    timed("generate_latest", lambda: generate_latest(registry), args.runs)
+    timed(
+        "direct",
+        lambda: direct_generate_latest(registry, cache=cache),
+        args.runs,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+"""Compares scrapes reading every family with scrapes skipping unchanged ones.
+
+Fills an SQLite database with ``--families`` labelled counters of
+``--series`` label sets each, then times ``--scrapes`` scrapes, each after
+incrementing ``--changed`` of the families, once reading every family and
+once with the write generations (see generations.py):
+
+    python benchmarks/generations.py --families 500 --changed 5
+"""
+
+import argparse
+import os
+import sqlite3
+import tempfile
+import time
+from unittest import mock
+
+from prometheus_client import CollectorRegistry
+
+from prometheus_distributed_client import Backend, exposition, sqlite
+
+
+def fill(path: str, args):
+    backend = Backend(sqlite=sqlite3.connect(path))
+    registry = CollectorRegistry()
+    counters = []
+    for index in range(args.families):
+        counter = sqlite.Counter(
+            f"jobs_{index}",
+            "...",
+            ["kind"],
+            registry=registry,
+            backend=backend,
+        )
+        for series in range(args.series):
+            counter.labels(str(series)).inc()
+        counters.append(counter)
+    return registry, counters
+
+
+def run(registry, counters, generations: bool, args) -> None:
+    elapsed = 0.0
+    for scrape in range(args.scrapes):
+        for index in range(args.changed):
+            counters[(scrape * args.changed + index) % len(counters)].labels(
+                "0"
+            ).inc()
+        start = time.perf_counter()
+        exposition.generate_latest(registry)
+        elapsed += time.perf_counter() - start
+    print(
+        f"{'generations' if generations else 'every family':<13} "
+        f"{1000 * elapsed / args.scrapes:8.2f} ms/scrape"
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--families", type=int, default=500)
+    parser.add_argument("--series", type=int, default=20)
+    parser.add_argument("--changed", type=int, default=5)
+    parser.add_argument("--scrapes", type=int, default=50)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        registry, counters = fill(os.path.join(directory, "m.db"), args)
+        exposition.generate_latest(registry)  # fills the fragment cache
+        with mock.patch.object(exposition, "prefetch_generations"):
+            run(registry, counters, False, args)
+        run(registry, counters, True, args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+"""Compares HINCRBY and HINCRBYFLOAT on the count fields of histograms.
+
+Increments the ``_count`` and bucket fields of ``--series`` histogram
+series (12 buckets) ``--rounds`` times, in pipelines of one observation,
+once with each command, then reports increments per second and, per
+command, the hash encoding and the memory reported by MEMORY USAGE:
+
+    python benchmarks/integer_fields.py --port 6379 --db 11 --series 50
+
+Use a dedicated database, it is flushed before and after the run.
+"""
+
+import argparse
+import time
+
+from redis import Redis
+from redis.exceptions import ResponseError
+
+from prometheus_distributed_client.fields import labels_json
+
+BUCKETS = 12
+
+
+def fields(series: int):
+    for index in range(series):
+        endpoint = f"/api/v1/items/{index}"
+        labels = labels_json(("endpoint",), (endpoint,))
+        yield [f"_count:{labels}"] + [
+            f"_bucket:{labels_json(('endpoint', 'le'), (endpoint, str(le)))}"
+            for le in range(BUCKETS)
+        ]
+
+
+def run(conn: Redis, command: str, args) -> None:
+    key = f"bench_{command}"
+    series_fields = list(fields(args.series))
+    start = time.perf_counter()
+    for _ in range(args.rounds):
+        for observation in series_fields:
+            pipe = conn.pipeline()
+            incr = getattr(pipe, command)
+            for field in observation:
+                incr(key, field, 1)
+            pipe.execute()
+    elapsed = time.perf_counter() - start
+    increments = args.rounds * args.series * (BUCKETS + 1)
+    try:
+        encoding = conn.object("encoding", key)
+        memory = f"{conn.memory_usage(key, samples=0)}B"
+    except ResponseError:  # server without OBJECT / MEMORY commands
+        encoding, memory = "n/a", "n/a"
+    print(
+        f"{command:<13} {increments / elapsed:10.0f} increments/s "
+        f"encoding={encoding} memory={memory}"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=6379)
+    parser.add_argument("--db", type=int, default=11)
+    parser.add_argument("--series", type=int, default=8)
+    parser.add_argument("--rounds", type=int, default=200)
+    args = parser.parse_args()
+
+    conn = Redis(host=args.host, port=args.port, db=args.db)
+    conn.flushdb()
+    try:
+        for command in ("hincrbyfloat", "hincrby"):
+            run(conn, command, args)
+    finally:
+        conn.flushdb()
+
+
+if __name__ == "__main__":
+    main()
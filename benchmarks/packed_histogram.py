@@ -0,0 +1,63 @@
+"""Compares the row and packed layouts of SQLite histograms.
+
+Observes ``--observations`` values spread over ``--series`` label sets of
+a histogram with ``--buckets`` buckets, once per layout, each in its own
+database file. Reports observations per second and the size of the file:
+
+    python benchmarks/packed_histogram.py --buckets 20 --series 1000
+"""
+
+import argparse
+import os
+import random
+import sqlite3
+import tempfile
+import time
+
+from prometheus_client import CollectorRegistry
+from prometheus_distributed_client import Backend, sqlite
+
+
+def run(path: str, packed: bool, args) -> None:
+    backend = Backend(sqlite=sqlite3.connect(path))
+    histogram = sqlite.Histogram(
+        "latency",
+        "...",
+        ["path"],
+        registry=CollectorRegistry(),
+        backend=backend,
+        buckets=[2**exponent for exponent in range(args.buckets - 1)],
+        packed=packed,
+    )
+    children = [histogram.labels(str(index)) for index in range(args.series)]
+    amounts = [
+        random.expovariate(1 / 2 ** (args.buckets // 2))
+        for _ in range(args.observations)
+    ]
+    start = time.perf_counter()
+    for index, amount in enumerate(amounts):
+        children[index % args.series].observe(amount)
+    elapsed = time.perf_counter() - start
+    backend.sqlite.execute("VACUUM")
+    backend.sqlite.close()
+    print(
+        f"{'packed' if packed else 'rows':<7} "
+        f"{args.observations / elapsed:10.0f} observations/s "
+        f"file {os.path.getsize(path) / 2**10:8.0f} KiB"
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--buckets", type=int, default=12)
+    parser.add_argument("--series", type=int, default=1000)
+    parser.add_argument("--observations", type=int, default=20000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        for packed in (False, True):
+            run(os.path.join(directory, f"{packed}.db"), packed, args)
+
+
+if __name__ == "__main__":
+    main()
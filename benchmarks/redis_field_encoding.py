@@ -0,0 +1,78 @@
+"""Compares Redis memory used by the json and compact field encodings.
+
+Writes the same histogram (5 labels, 12 buckets) with both encodings and
+reports, per metric key, the hash encoding (listpack or hashtable), the
+memory reported by MEMORY USAGE and the raw size of the field names.
+
+    python benchmarks/redis_field_encoding.py --port 6379 --db 11 --series 50
+
+Use a dedicated database, it is flushed before and after the run. With a
+handful of series per metric, compact fields usually stay under
+hash-max-listpack-value (64 bytes) where json ones do not, so the compact
+hash keeps the listpack encoding.
+"""
+
+import argparse
+
+from prometheus_client import CollectorRegistry
+from redis import Redis
+from redis.exceptions import ResponseError
+
+from prometheus_distributed_client import setup
+from prometheus_distributed_client.redis import Histogram
+
+LABELNAMES = ("service", "endpoint", "method", "status", "region")
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def fill(series: int, encoding: str) -> str:
+    name = f"bench_{encoding}"
+    metric = Histogram(
+        name,
+        "field encoding benchmark",
+        LABELNAMES,
+        registry=CollectorRegistry(),
+        buckets=BUCKETS,
+    )
+    for i in range(series):
+        child = metric.labels(
+            "checkout", f"/api/v1/items/{i}", "GET", "200", "eu-west-1"
+        )
+        child.observe(0.042)
+    return f"prometheus_{name}"
+
+
+def describe(conn: Redis, key: str) -> str:
+    fields = conn.hkeys(key)
+    field_bytes = sum(len(field) for field in fields)
+    try:
+        encoding = conn.object("encoding", key)
+        memory = f"{conn.memory_usage(key, samples=0)}B"
+    except ResponseError:  # server without OBJECT / MEMORY commands
+        encoding, memory = "n/a", "n/a"
+    return (
+        f"{key}: {len(fields)} fields, encoding={encoding}, "
+        f"memory={memory}, field names={field_bytes}B"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=6379)
+    parser.add_argument("--db", type=int, default=11)
+    parser.add_argument("--series", type=int, default=8)
+    args = parser.parse_args()
+
+    conn = Redis(host=args.host, port=args.port, db=args.db)
+    conn.flushdb()
+    try:
+        for encoding in ("json", "compact"):
+            setup(redis=conn, redis_field_encoding=encoding)
+            print(describe(conn, fill(args.series, encoding)))
+    finally:
+        conn.flushdb()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+"""Measures snapshot export and import throughput on many series.
+
+Fills a SQLite database with ``--series`` counter series spread over 100
+families, then exports it to a gzipped snapshot, imports that snapshot
+into a new SQLite database (twice, the second time merging) and, with
+``--redis``, into Redis. Reports series per second and the peak resident
+memory of the process, which must not grow with the number of series:
+
+    python benchmarks/snapshot.py --series 2000000 --redis redis://localhost
+"""
+
+import argparse
+import os
+import resource
+import sqlite3
+import tempfile
+import time
+
+from prometheus_distributed_client import Backend
+from prometheus_distributed_client.fields import labels_json
+from prometheus_distributed_client.snapshot import (
+    export_snapshot,
+    import_snapshot,
+)
+
+FAMILIES = 100
+
+
+def fill(path: str, series: int) -> None:
+    backend = Backend(sqlite=path)
+    conn = backend.sqlite
+    conn.executemany(
+        "INSERT INTO metrics (metric_key, subkey, value) VALUES (?, ?, ?)",
+        (
+            (
+                f"requests_{index % FAMILIES}",
+                "_total:" + labels_json(("instance",), (str(index),)),
+                float(index),
+            )
+            for index in range(series)
+        ),
+    )
+    conn.commit()
+    conn.close()
+
+
+def timed(name: str, series: int, func) -> None:
+    start = time.perf_counter()
+    func()
+    elapsed = time.perf_counter() - start
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(
+        f"{name:<22} {elapsed:7.2f} s {series / elapsed:10.0f} series/s "
+        f"peak RSS {peak:6.0f} MiB"
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--series", type=int, default=1000000)
+    parser.add_argument("--redis", metavar="URL")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        source_path = os.path.join(directory, "source.db")
+        snapshot = os.path.join(directory, "snapshot.jsonl.gz")
+        fill(source_path, args.series)
+        source = Backend(sqlite=source_path)
+        timed("export", args.series, lambda: export_snapshot(snapshot, source))
+        print(f"snapshot size {os.path.getsize(snapshot) / 2**20:.1f} MiB")
+        target = Backend(sqlite=sqlite3.connect(":memory:"))
+        timed(
+            "import sqlite",
+            args.series,
+            lambda: import_snapshot(snapshot, target),
+        )
+        timed(
+            "import sqlite, merge",
+            args.series,
+            lambda: import_snapshot(snapshot, target, merge=True),
+        )
+        if args.redis:
+            from redis import Redis
+
+            redis_target = Backend(
+                redis=Redis.from_url(args.redis), redis_prefix="snapshot"
+            )
+            timed(
+                "import redis",
+                args.series,
+                lambda: import_snapshot(snapshot, redis_target),
+            )
+            timed(
+                "export redis",
+                args.series,
+                lambda: export_snapshot(snapshot, redis_target),
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,3 +1,3 @@
-from .config import setup, setup_sqlite
+from .config import Backend, bind_registry, route, setup, setup_sqlite
 
-__all__ = ["setup", "setup_sqlite"]
+__all__ = ["Backend", "bind_registry", "route", "setup", "setup_sqlite"]
@@ -0,0 +1,140 @@
+"""Command line entry point: python -m prometheus_distributed_client."""
+
+import argparse
+import logging
+import sqlite3
+from typing import List, Optional
+
+from .config import setup
+from .exporter import serve
+from .fields import FIELD_ENCODINGS
+from .remote_write import RemoteWritePusher
+from .snapshot import export_snapshot, import_snapshot
+
+
+def _add_backend_arguments(parser: argparse.ArgumentParser) -> None:
+    backend = parser.add_mutually_exclusive_group(required=True)
+    backend.add_argument("--redis", metavar="URL", help="redis://host:port/db")
+    backend.add_argument("--sqlite", metavar="PATH", help="database file")
+    parser.add_argument("--redis-prefix", default="prometheus")
+    parser.add_argument("--redis-expire", type=int, default=3600)
+    parser.add_argument(
+        "--redis-field-encoding", choices=FIELD_ENCODINGS, default="json"
+    )
+    parser.add_argument("--log-level", default="INFO")
+
+
+def _label(value: str):
+    name, _, label_value = value.partition("=")
+    return name, label_value
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(
+        prog="python -m prometheus_distributed_client"
+    )
+    commands = parser.add_subparsers(dest="command", required=True)
+    serve_parser = commands.add_parser(
+        "serve", help="serve every family stored in a backend over HTTP"
+    )
+    _add_backend_arguments(serve_parser)
+    serve_parser.add_argument("--addr", default="0.0.0.0")
+    serve_parser.add_argument("--port", type=int, default=9090)
+    push_parser = commands.add_parser(
+        "push", help="push every family stored in a backend (remote write)"
+    )
+    _add_backend_arguments(push_parser)
+    push_parser.add_argument("--url", required=True)
+    push_parser.add_argument("--interval", type=float, default=15.0)
+    push_parser.add_argument("--senders", type=int, default=4)
+    push_parser.add_argument(
+        "--label",
+        type=_label,
+        action="append",
+        default=[],
+        metavar="NAME=VALUE",
+        help="label added to every pushed series",
+    )
+    export_parser = commands.add_parser(
+        "export", help="write every family stored in a backend to a file"
+    )
+    _add_backend_arguments(export_parser)
+    export_parser.add_argument(
+        "--output", required=True, help="snapshot file, gzipped if .gz"
+    )
+    import_parser = commands.add_parser(
+        "import", help="write the families of a snapshot to a backend"
+    )
+    _add_backend_arguments(import_parser)
+    import_parser.add_argument("--input", required=True)
+    import_parser.add_argument(
+        "--merge",
+        action="store_true",
+        help="add to the stored values instead of replacing them",
+    )
+    aggregate_parser = commands.add_parser(
+        "aggregate",
+        help="apply the writes appended to a Redis stream, see streams.py",
+    )
+    aggregate_parser.add_argument(
+        "--redis", metavar="URL", required=True, help="redis://host:port/db"
+    )
+    aggregate_parser.add_argument("--redis-prefix", default="prometheus")
+    aggregate_parser.add_argument("--group", default="aggregator")
+    aggregate_parser.add_argument("--consumer", help="default: host-pid")
+    aggregate_parser.add_argument("--batch-size", type=int, default=1000)
+    aggregate_parser.add_argument("--log-level", default="INFO")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=args.log_level)
+    if args.command == "aggregate":
+        from redis import Redis
+
+        from .streams import StreamAggregator
+
+        StreamAggregator(
+            Redis.from_url(args.redis),
+            redis_prefix=args.redis_prefix,
+            group=args.group,
+            consumer=args.consumer,
+            batch_size=args.batch_size,
+        ).run()
+        return
+    # these commands only read, they must not store _created timestamps
+    if args.redis:
+        from redis import Redis
+
+        setup(
+            redis=Redis.from_url(args.redis),
+            redis_prefix=args.redis_prefix,
+            redis_expire=args.redis_expire,
+            redis_field_encoding=args.redis_field_encoding,
+            created="disabled",
+        )
+    else:
+        setup(
+            sqlite=sqlite3.connect(args.sqlite, check_same_thread=False),
+            created="disabled",
+        )
+    if args.command == "serve":
+        serve(args.addr, args.port)
+        return
+    if args.command == "export":
+        written = export_snapshot(args.output)
+        logging.info("exported %d values to %s", written, args.output)
+        return
+    if args.command == "import":
+        written = import_snapshot(args.input, merge=args.merge)
+        logging.info("imported %d values from %s", written, args.input)
+        return
+    pusher = RemoteWritePusher(
+        args.url,
+        interval=args.interval,
+        senders=args.senders,
+        labels=dict(args.label),
+    )
+    pusher.run()
+
+
+if __name__ == "__main__":
+    main()
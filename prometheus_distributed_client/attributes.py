@@ -0,0 +1,47 @@
+"""What the mixins use of prometheus_client's metric classes.
+
+The mixins are only ever combined with prometheus_client's
+MetricWrapperBase subclasses (see redis.py and sqlite.py), which set these
+attributes, and with BackendMixin, which resolves ``_target``.
+``MetricAttributes`` declares them for the type checker. It defines nothing
+at runtime, the methods are declared under TYPE_CHECKING only so that they
+never shadow the real ones further down the MRO.
+"""
+
+import threading
+from typing import TYPE_CHECKING, Any, Dict, Optional, Sequence, Tuple
+
+if TYPE_CHECKING:
+    from .config import Backend
+    from .rollup import RollupField
+
+
+class MetricAttributes:
+    """Attributes set by MetricWrapperBase.__init__ and BackendMixin."""
+
+    _name: str
+    _documentation: str
+    _labelnames: Tuple[str, ...]
+    _labelvalues: Tuple[str, ...]
+    _kwargs: Dict[str, Any]
+    _lock: threading.Lock
+    _metrics: Dict[Sequence[str], Any]
+    # kind of backend the metric class writes to, see BackendMixin
+    _backend: str
+
+    if TYPE_CHECKING:
+
+        @property
+        def _target(self) -> "Backend":
+            """Resolved by BackendMixin."""
+
+        def _is_parent(self) -> bool:
+            """Whether the metric has labels but no label values."""
+
+        def labels(self, *labelvalues: Any, **labelkwargs: Any) -> Any:
+            """The child of the given label values."""
+
+        def _rollup_fields(
+            self, extra: Optional[Dict[str, str]] = None
+        ) -> Tuple["RollupField", ...]:
+            """Defined by RollupMixin."""
@@ -0,0 +1,96 @@
+import threading
+from collections import OrderedDict
+from typing import Any, Optional, Tuple
+
+from .attributes import MetricAttributes
+
+OVERFLOW_LABEL_VALUE = "__overflow__"
+
+# label sets refused by the backend are remembered locally so that a hot
+# offending label set does not cost a round trip on each call
+REJECTED_CACHE_SIZE = 1024
+
+
+class CardinalityLimitMixin(MetricAttributes):
+    """Caps the number of distinct label sets a metric may create.
+
+    Label sets already known to this process are served from the parent's
+    children dict, so the hot path stays a single dict lookup. Only label
+    sets never seen before are checked against the shared series registry
+    kept in the backend (see ``_admit_series``). Once the cap is reached,
+    new label sets are folded into a single series where every label is
+    set to ``__overflow__``, and each folding is counted.
+    """
+
+    # set on the parent of internal families that must never be folded
+    _series_exempt = False
+
+    def __init__(self, *args, max_series: Optional[int] = None, **kwargs):
+        self._max_series = max_series
+        self._series_overflow = 0
+        super().__init__(*args, **kwargs)
+        if self._is_parent():
+            self._series_rejected: OrderedDict = OrderedDict()
+            self._series_rejected_lock = threading.Lock()
+        self._kwargs["max_series"] = max_series
+
+    def _admit_series(self, labelvalues: Tuple[str, ...]) -> bool:
+        raise NotImplementedError()
+
+    def _count_overflow(self) -> None:
+        raise NotImplementedError()
+
+    def _series_limited(self) -> bool:
+        if self._series_exempt:
+            return False
+        return (
+            self._max_series is not None or self._target.max_series is not None
+        )
+
+    def _normalize_labelvalues(
+        self, labelvalues, labelkwargs
+    ) -> Optional[Tuple[str, ...]]:
+        if labelvalues and labelkwargs:
+            return None
+        if labelkwargs:
+            if sorted(labelkwargs) != sorted(self._labelnames):
+                return None
+            return tuple(str(labelkwargs[name]) for name in self._labelnames)
+        if len(labelvalues) != len(self._labelnames):
+            return None
+        return tuple(str(value) for value in labelvalues)
+
+    def labels(self, *labelvalues: Any, **labelkwargs: Any):
+        if not self._labelnames or self._labelvalues:
+            return super().labels(*labelvalues, **labelkwargs)
+        values = self._normalize_labelvalues(labelvalues, labelkwargs)
+        if values is None:  # letting prometheus_client raise
+            return super().labels(*labelvalues, **labelkwargs)
+        child = self._metrics.get(values)
+        if child is not None or not self._series_limited():
+            return child or super().labels(*values)
+        overflow = (OVERFLOW_LABEL_VALUE,) * len(self._labelnames)
+        if values != overflow and not self._try_admit(values):
+            self._series_overflow += 1
+            self._count_overflow()
+            values = overflow
+        return super().labels(*values)
+
+    def _try_admit(self, labelvalues: Tuple[str, ...]) -> bool:
+        rejected = self._series_rejected
+        with self._series_rejected_lock:
+            if labelvalues in rejected:
+                rejected.move_to_end(labelvalues)
+                return False
+        if self._admit_series(labelvalues):
+            return True
+        with self._series_rejected_lock:
+            rejected[labelvalues] = True
+            if len(rejected) > REJECTED_CACHE_SIZE:
+                rejected.popitem(last=False)
+        return False
+
+    @property
+    def series_overflow(self) -> int:
+        """Label sets this process folded into the overflow series."""
+        return self._series_overflow
@@ -0,0 +1,84 @@
+"""Keeps the per label set state of a metric small.
+
+Values live in the backend, so a labelled child only holds what it needs
+to address them: its values are ``__slots__`` objects without locks (each
+update is a single atomic backend operation), histogram children share the
+bucket layout of their family, and parents may keep at most
+``max_children`` children, evicting the least recently used ones. An
+evicted child is rebuilt on its next ``labels()`` call, its values are
+untouched.
+"""
+
+from collections import OrderedDict
+from typing import Optional, Sequence, Tuple, Union
+
+from prometheus_client.utils import INF, floatToGoString
+
+from .attributes import MetricAttributes
+
+
+class BucketLayout:
+    """Upper bounds of a histogram family and their ``le`` label values,
+    computed once by the parent and shared by its children and rollups."""
+
+    __slots__ = ("bounds", "les")
+
+    def __init__(self, buckets: Sequence[Union[float, str]]):
+        bounds = [float(bound) for bound in buckets]
+        if bounds != sorted(bounds):
+            raise ValueError("Buckets not in sorted order")
+        if bounds and bounds[-1] != INF:
+            bounds.append(INF)
+        if len(bounds) < 2:
+            raise ValueError("Must have at least two buckets")
+        self.bounds: Tuple[float, ...] = tuple(bounds)
+        self.les: Tuple[str, ...] = tuple(map(floatToGoString, bounds))
+
+    def __iter__(self):
+        return iter(self.bounds)
+
+    def __len__(self) -> int:
+        return len(self.bounds)
+
+
+class BucketLayoutMixin(MetricAttributes):
+    """Histograms: hands the parent's BucketLayout to children, instead of
+    each of them parsing the buckets again."""
+
+    def _prepare_buckets(self, source_buckets) -> None:
+        if not isinstance(source_buckets, BucketLayout):
+            source_buckets = BucketLayout(source_buckets)
+        self._bucket_layout = source_buckets
+        self._upper_bounds = source_buckets.bounds
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._kwargs["buckets"] = self._bucket_layout
+
+
+class BoundedChildrenMixin(MetricAttributes):
+    """Keeps at most max_children labelled children, least recently used
+    ones are evicted (unbounded by default)."""
+
+    def __init__(self, *args, max_children: Optional[int] = None, **kwargs):
+        self._max_children = max_children
+        super().__init__(*args, **kwargs)
+        if max_children is not None and self._is_parent():
+            self._metrics = OrderedDict()
+        self._kwargs["max_children"] = max_children
+
+    def labels(self, *labelvalues, **labelkwargs):
+        child = super().labels(*labelvalues, **labelkwargs)
+        if self._max_children is not None:
+            evicted = []
+            with self._lock:
+                if child._labelvalues in self._metrics:
+                    self._metrics.move_to_end(child._labelvalues)
+                while len(self._metrics) > self._max_children:
+                    evicted.append(self._metrics.popitem(last=False)[1])
+            for evicted_child in evicted:
+                evicted_child._evicted()
+        return child
+
+    def _evicted(self) -> None:
+        """Called once this child is no longer kept by its parent."""
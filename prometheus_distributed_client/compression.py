@@ -0,0 +1,139 @@
+"""Snappy block format, as required by the remote-write protocol.
+
+``python-snappy`` is used when installed. Otherwise this pure Python
+implementation is used: a greedy matcher over 4 bytes sequences which,
+like the reference implementation, skips ahead faster and faster through
+incompressible data.
+"""
+
+from typing import Dict
+
+try:
+    import snappy as _snappy  # type: ignore[import-not-found]
+except ImportError:
+    _snappy = None
+
+MAX_OFFSET = 65535
+MAX_COPY_LENGTH = 64
+MIN_MATCH = 4
+
+
+def encode_varint(value: int) -> bytes:
+    out = bytearray()
+    while value > 0x7F:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+def _literal(out: bytearray, data: bytes) -> None:
+    length = len(data) - 1
+    if length < 60:
+        out.append(length << 2)
+    else:
+        size = (length.bit_length() + 7) // 8
+        out.append((59 + size) << 2)
+        out += length.to_bytes(size, "little")
+    out += data
+
+
+def _copy(out: bytearray, offset: int, length: int) -> None:
+    while length > 0:
+        chunk = min(length, MAX_COPY_LENGTH)
+        # keep at least MIN_MATCH bytes for the last copy
+        if 0 < length - chunk < MIN_MATCH:
+            chunk = length - MIN_MATCH
+        out.append(((chunk - 1) << 2) | 2)
+        out += offset.to_bytes(2, "little")
+        length -= chunk
+
+
+def _compress(data: bytes) -> bytes:
+    out = bytearray(encode_varint(len(data)))
+    table: Dict[bytes, int] = {}
+    size = len(data)
+    literal_start = pos = 0
+    misses = 32
+    while pos + MIN_MATCH <= size:
+        end = pos + MIN_MATCH
+        sequence = data[pos:end]
+        candidate = table.get(sequence)
+        table[sequence] = pos
+        if candidate is None or pos - candidate > MAX_OFFSET:
+            pos += misses >> 5
+            misses += 1
+            continue
+        misses = 32
+        length = MIN_MATCH
+        while (
+            pos + length < size
+            and data[candidate + length] == data[pos + length]
+        ):
+            length += 1
+        if literal_start < pos:
+            _literal(out, data[literal_start:pos])
+        _copy(out, pos - candidate, length)
+        pos += length
+        literal_start = pos
+    if literal_start < size:
+        _literal(out, data[literal_start:])
+    return bytes(out)
+
+
+def _decompress(data: bytes) -> bytes:
+    size, pos, shift = 0, 0, 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        size |= (byte & 0x7F) << shift
+        shift += 7
+        if not byte & 0x80:
+            break
+    out = bytearray()
+    while pos < len(data):
+        tag = data[pos]
+        pos += 1
+        kind = tag & 3
+        if kind == 0:
+            length = tag >> 2
+            if length >= 60:
+                end = pos + length - 59
+                length = int.from_bytes(data[pos:end], "little")
+                pos = end
+            end = pos + length + 1
+            out += data[pos:end]
+            pos = end
+            continue
+        if kind == 1:
+            length = ((tag >> 2) & 7) + 4
+            offset = ((tag >> 5) << 8) | data[pos]
+            pos += 1
+        else:
+            length = (tag >> 2) + 1
+            end = pos + (2 if kind == 2 else 4)
+            offset = int.from_bytes(data[pos:end], "little")
+            pos = end
+        start = len(out) - offset
+        # copies may overlap what they produce
+        while length > 0:
+            end = start + min(length, offset)
+            chunk = bytes(out[start:end])
+            out += chunk
+            start += len(chunk)
+            length -= len(chunk)
+    if len(out) != size:
+        raise ValueError("corrupted snappy block")
+    return bytes(out)
+
+
+def snappy_compress(data: bytes) -> bytes:
+    if _snappy is not None:
+        return _snappy.compress(data)
+    return _compress(data)
+
+
+def snappy_decompress(data: bytes) -> bytes:
+    if _snappy is not None:
+        return _snappy.uncompress(data)
+    return _decompress(data)
@@ -1,16 +1,404 @@
-import sqlite3
-from typing import Any, Dict, Optional, Union
+import threading
+import weakref
+from functools import cached_property
+from typing import TYPE_CHECKING, List, Optional, Tuple, Union
 
-from redis import Redis
+from prometheus_client.registry import REGISTRY
 
-_CONFIG: Dict[str, Any] = {}
+from .attributes import MetricAttributes
+from .fields import FIELD_ENCODINGS
+from .metadata import store_declared_metadata
+from .packed import add_packed
+from .quantiles import merge_encoded
+from .read_cache import ReadCache, start_invalidation_listener
+
+if TYPE_CHECKING:
+    # imported by configure() only, importing the package stays cheap
+    import sqlite3
+
+    from redis import ConnectionPool, Redis
+
+    from .replica import ReplicaReader
+    from .resilience import WriteGuard
+    from .streams import StreamWriter
+
+CREATED_POLICIES = ("series", "family", "disabled")
+
+SQLITE_TABLES = {
+    "metrics": """
+        CREATE TABLE IF NOT EXISTS metrics (
+            metric_key TEXT NOT NULL,
+            subkey TEXT NOT NULL,
+            -- whole numbers stored as integers, see integers.py
+            value NUMERIC NOT NULL,
+            PRIMARY KEY (metric_key, subkey)
+        )
+        """,
+    "metrics_series": """
+        CREATE TABLE IF NOT EXISTS metrics_series (
+            metric_key TEXT NOT NULL,
+            labels TEXT NOT NULL,
+            PRIMARY KEY (metric_key, labels)
+        )
+        """,
+    "metrics_metadata": """
+        CREATE TABLE IF NOT EXISTS metrics_metadata (
+            metric_key TEXT NOT NULL PRIMARY KEY,
+            metadata TEXT NOT NULL
+        )
+        """,
+    "metrics_timestamps": """
+        CREATE TABLE IF NOT EXISTS metrics_timestamps (
+            metric_key TEXT NOT NULL,
+            subkey TEXT NOT NULL,
+            timestamp REAL NOT NULL,
+            PRIMARY KEY (metric_key, subkey)
+        )
+        """,
+    "metrics_sketches": """
+        CREATE TABLE IF NOT EXISTS metrics_sketches (
+            metric_key TEXT NOT NULL,
+            labels TEXT NOT NULL,
+            sketch TEXT NOT NULL,
+            PRIMARY KEY (metric_key, labels)
+        )
+        """,
+    # histograms with packed=True, see packed.py
+    "metrics_histograms": """
+        CREATE TABLE IF NOT EXISTS metrics_histograms (
+            metric_key TEXT NOT NULL,
+            labels TEXT NOT NULL,
+            sum REAL NOT NULL,
+            count REAL NOT NULL,
+            created REAL,
+            buckets BLOB NOT NULL,
+            PRIMARY KEY (metric_key, labels)
+        )
+        """,
+    # bumped by the triggers below, see generations.py
+    "metrics_generations": """
+        CREATE TABLE IF NOT EXISTS metrics_generations (
+            metric_key TEXT NOT NULL PRIMARY KEY,
+            generation INTEGER NOT NULL
+        )
+        """,
+}
+
+
+def _generation_trigger(table: str, event: str) -> str:
+    row = "OLD" if event == "DELETE" else "NEW"
+    return f"""
+        CREATE TRIGGER IF NOT EXISTS {table}_{event.lower()}_generation
+        AFTER {event} ON {table} BEGIN
+            INSERT INTO metrics_generations (metric_key, generation)
+            VALUES ({row}.metric_key, 1)
+            ON CONFLICT(metric_key) DO UPDATE SET
+                generation = generation + 1;
+        END
+        """
+
+
+SQLITE_TRIGGERS = {
+    f"{table}_{event.lower()}_generation": _generation_trigger(table, event)
+    for table in ("metrics", "metrics_histograms")
+    for event in ("INSERT", "UPDATE", "DELETE")
+}
+
+
+def connect_sqlite(
+    sqlite: Union["sqlite3.Connection", str],
+) -> "sqlite3.Connection":
+    """Opens sqlite if it is a path and creates the missing tables and
+    triggers.
+
+    They are looked up first: once they exist, opening a database takes no
+    write lock and commits nothing.
+    """
+    import sqlite3
+
+    if isinstance(sqlite, str):
+        conn = sqlite3.connect(sqlite)
+    else:
+        conn = sqlite
+    existing = {
+        name
+        for (name,) in conn.execute(
+            "SELECT name FROM sqlite_master"
+            " WHERE type IN ('table', 'trigger')"
+        )
+    }
+    missing = [
+        statement
+        for name, statement in {**SQLITE_TABLES, **SQLITE_TRIGGERS}.items()
+        if name not in existing
+    ]
+    if missing:
+        cursor = conn.cursor()
+        for statement in missing:
+            cursor.execute(statement)
+        conn.commit()
+    # merges quantile sketches within a single upsert
+    conn.create_function("merge_sketch", 3, merge_encoded, deterministic=True)
+    # adds the bucket counts of packed histograms within a single upsert
+    conn.create_function("add_packed", 2, add_packed, deterministic=True)
+    return conn
+
+
+class Backend:
+    """A Redis or SQLite target with its own connection and settings.
+
+    setup() configures DEFAULT_BACKEND, which stores every metric not bound
+    elsewhere. Other backends take the same arguments as setup() and are
+    bound to metrics with ``backend=``, to registries with bind_registry()
+    or to metric name prefixes with route(). A metric resolves its backend
+    once, at construction (see BackendMixin).
+
+    Configuring a backend does no I/O: a SQLite database given as a path
+    is opened, and its missing tables created, on first use. The metadata
+    of the families declared so far is stored then too.
+    """
+
+    def __init__(self, **settings):
+        self.kind: Optional[str] = None
+        self._redis: Optional["Redis"] = None
+        self.redis_prefix = "prometheus"
+        self.redis_expire = 3600
+        self.redis_series_expire: Optional[int] = None
+        self.redis_field_encoding = "json"
+        self.write_guard: Optional["WriteGuard"] = None
+        self.replica_reader: Optional["ReplicaReader"] = None
+        self.stream_writer: Optional["StreamWriter"] = None
+        self.read_cache: Optional[ReadCache] = None
+        self.read_cache_listener = None
+        # whether the listener was started, by the first cached read
+        self._read_cache_listened = False
+        self._sqlite: Optional["sqlite3.Connection"] = None
+        self._sqlite_source: Union["sqlite3.Connection", str, None] = None
+        self.max_series: Optional[int] = None
+        self.created = "series"
+        # whether the connection has been used since the last configure()
+        self.connected = False
+        self._connect_lock = threading.Lock()
+        if settings:
+            self.configure(**settings)
+
+    def configure(
+        self,
+        redis: Optional["Redis"] = None,
+        sqlite: Optional[Union["sqlite3.Connection", str]] = None,
+        redis_prefix: str = "prometheus",
+        redis_expire: int = 3600,
+        max_series: Optional[int] = None,
+        redis_series_expire: Optional[int] = None,
+        read_cache_size: int = 0,
+        read_cache_max_staleness: float = 1.0,
+        created: str = "series",
+        redis_field_encoding: str = "json",
+        redis_write_timeout: Optional[float] = None,
+        redis_spool_size: int = 10000,
+        redis_spool_path: Optional[str] = None,
+        redis_read: Optional[Union["Redis", "ConnectionPool"]] = None,
+        redis_read_max_lag: float = 10.0,
+        redis_read_max_lag_bytes: Optional[int] = None,
+        redis_stream: bool = False,
+        redis_stream_batch_size: int = 1000,
+        redis_stream_flush_interval: float = 1.0,
+    ) -> None:
+        """(Re)configures this backend, see setup() for the arguments."""
+        if redis is not None and sqlite is not None:
+            raise ValueError("Cannot specify both redis and sqlite")
+        if created not in CREATED_POLICIES:
+            raise ValueError(f"created must be one of {CREATED_POLICIES}")
+        if redis_field_encoding not in FIELD_ENCODINGS:
+            raise ValueError(
+                f"redis_field_encoding must be in {FIELD_ENCODINGS}"
+            )
+
+        self.max_series = max_series
+        self.created = created
+        if self.read_cache_listener is not None:
+            self.read_cache_listener.stop()
+            self.read_cache_listener = None
+        if self.stream_writer is not None:
+            self.stream_writer.close()
+            self.stream_writer = None
+        self.read_cache = None
+        self._read_cache_listened = False
+        self.write_guard = None
+        self.replica_reader = None
+        self.connected = False
+        self._sqlite = None
+        self._sqlite_source = None
+        if read_cache_size:
+            self.read_cache = ReadCache(
+                read_cache_size, read_cache_max_staleness
+            )
+
+        if redis is not None:
+            # Setup Redis backend
+            self._redis = redis
+            self.redis_prefix = redis_prefix
+            self.redis_expire = redis_expire
+            self.redis_series_expire = redis_series_expire
+            self.redis_field_encoding = redis_field_encoding
+            self.kind = "redis"
+            if redis_write_timeout is not None:
+                from .resilience import WriteGuard
+
+                self.write_guard = WriteGuard(
+                    redis,
+                    redis_write_timeout,
+                    redis_spool_size,
+                    redis_spool_path,
+                    redis_expire,
+                )
+            if redis_read is not None:
+                from redis import ConnectionPool, Redis
+
+                from .replica import ReplicaReader
+
+                if isinstance(redis_read, ConnectionPool):
+                    redis_read = Redis(connection_pool=redis_read)
+                self.replica_reader = ReplicaReader(
+                    redis_read,
+                    redis,
+                    redis_read_max_lag,
+                    redis_read_max_lag_bytes,
+                )
+            if redis_stream:
+                from .streams import StreamWriter
+
+                self.stream_writer = StreamWriter(
+                    self,
+                    redis_stream_batch_size,
+                    redis_stream_flush_interval,
+                )
+        elif sqlite is not None:
+            # Setup SQLite backend, a path is opened by the first query
+            if isinstance(sqlite, str):
+                self._sqlite_source = sqlite
+            else:
+                self._sqlite = connect_sqlite(sqlite)
+            self.kind = "sqlite"
+        else:
+            raise ValueError("Must specify either redis or sqlite")
+
+    def connect(self) -> None:
+        """Opens the connection and stores the metadata of the families
+        declared so far, done by the first use unless called earlier."""
+        with self._connect_lock:
+            if self.connected or self.kind is None:
+                return
+            if self._sqlite_source is not None:
+                self._sqlite = connect_sqlite(
+                    self._sqlite_source  # type: ignore[arg-type]
+                )
+            self.connected = True
+        store_declared_metadata(self)
+
+    @property
+    def redis(self) -> "Redis":
+        if not self.connected:
+            self.connect()
+        if self._redis is None:
+            raise ValueError("Backend is not configured for Redis")
+        return self._redis
+
+    @property
+    def sqlite(self) -> "sqlite3.Connection":
+        if not self.connected:
+            self.connect()
+        if self._sqlite is None:
+            raise ValueError("Backend is not configured for SQLite")
+        return self._sqlite
+
+    @property
+    def redis_write_conn(self) -> "Redis":
+        """Client for writes, with the write timeout if one is set."""
+        if self.write_guard is None:
+            return self.redis
+        if not self.connected:
+            self.connect()
+        return self.write_guard.client
+
+    def listened_read_cache(self) -> Optional[ReadCache]:
+        """The read cache, with the Redis invalidation listener started by
+        its first use rather than by configure()."""
+        cache = self.read_cache
+        if cache is None or self.kind != "redis" or self._read_cache_listened:
+            return cache
+        redis = self.redis
+        with self._connect_lock:
+            if not self._read_cache_listened:
+                self.read_cache_listener = start_invalidation_listener(
+                    redis, f"{self.redis_prefix}_", cache
+                )
+                self._read_cache_listened = True
+        return cache
+
+    def redis_read(self, func):
+        """Returns func(conn) for a collection read, on the replica if one
+        is set up and in sync, see replica.py."""
+        if self.replica_reader is None:
+            return func(self.redis)
+        if not self.connected:
+            self.connect()
+        return self.replica_reader.call(func)
+
+    def redis_key(self, name) -> str:
+        return f"{self.redis_prefix}_{name}"
+
+    def redis_metadata_key(self) -> str:
+        return f"{self.redis_prefix}:metadata"
+
+    def redis_timestamps_key(self, name) -> str:
+        return f"{self.redis_prefix}_{name}:timestamps"
+
+    def redis_touched_key(self, name) -> str:
+        return f"{self.redis_prefix}_{name}:touched"
+
+    def redis_sketches_key(self, name) -> str:
+        return f"{self.redis_prefix}_{name}:sketches"
+
+    def redis_stream_key(self) -> str:
+        return f"{self.redis_prefix}:stream"
+
+    def redis_generations_key(self) -> str:
+        return f"{self.redis_prefix}:generations"
+
+    def redis_series_key(self, name: Optional[str] = None) -> str:
+        if name is None:
+            return f"{self.redis_prefix}:series"
+        return f"{self.redis_prefix}_{name}:series"
+
+
+DEFAULT_BACKEND = Backend()
+
+# (prefix, backend), longest prefixes first
+_ROUTES: List[Tuple[str, Backend]] = []
+_REGISTRY_BACKENDS: "weakref.WeakKeyDictionary" = weakref.WeakKeyDictionary()
 
 
 def setup(
-    redis: Optional[Redis] = None,
-    sqlite: Optional[Union[sqlite3.Connection, str]] = None,
+    redis: Optional["Redis"] = None,
+    sqlite: Optional[Union["sqlite3.Connection", str]] = None,
     redis_prefix: str = "prometheus",
     redis_expire: int = 3600,
+    max_series: Optional[int] = None,
+    redis_series_expire: Optional[int] = None,
+    read_cache_size: int = 0,
+    read_cache_max_staleness: float = 1.0,
+    created: str = "series",
+    redis_field_encoding: str = "json",
+    redis_write_timeout: Optional[float] = None,
+    redis_spool_size: int = 10000,
+    redis_spool_path: Optional[str] = None,
+    redis_read: Optional[Union["Redis", "ConnectionPool"]] = None,
+    redis_read_max_lag: float = 10.0,
+    redis_read_max_lag_bytes: Optional[int] = None,
+    redis_stream: bool = False,
+    redis_stream_batch_size: int = 1000,
+    redis_stream_flush_interval: float = 1.0,
 ):
     """Setup metrics backend (Redis or SQLite).
 
@@ -20,6 +408,41 @@ def setup(
             (mutually exclusive with redis)
         redis_prefix: Prefix for metric keys (Redis only)
         redis_expire: TTL in seconds for metrics (Redis only)
+        redis_series_expire: Idle time in seconds after which a single
+            label set is pruned from its metric (Redis only, disabled
+            by default)
+        max_series: Global cap on distinct label sets across all metrics,
+            label sets beyond it are folded into the overflow series
+        read_cache_size: Values read back with get() cached locally at
+            most (disabled by default)
+        read_cache_max_staleness: Seconds a cached value may be served
+            without being read again from the backend
+        created: How _created timestamps are stored: "series" (one per
+            label set), "family" (one per metric, exposed on every label
+            set) or "disabled"
+        redis_field_encoding: How hash fields are named (Redis only),
+            "json" or "compact" (label values only, see fields.py), both
+            are read whatever the setting
+        redis_write_timeout: Seconds a write may wait for Redis (Redis
+            only). Enables a circuit breaker spooling writes locally
+            while Redis is unreachable, see resilience.py
+        redis_spool_size: Distinct fields spooled at most while Redis is
+            unreachable, writes to other fields are dropped
+        redis_spool_path: Append-only file mirroring the spool, replayed
+            on the next setup() if the process died with a full spool
+        redis_read: Connection or pool (a replica) used by collection
+            reads instead of redis (Redis only), see replica.py
+        redis_read_max_lag: Seconds since the replica last heard from the
+            primary beyond which reads fall back to the primary
+        redis_read_max_lag_bytes: Replication offset delay beyond which
+            reads fall back to the primary (not checked by default)
+        redis_stream: Appends writes to a stream, applied to the hashes
+            by the aggregator, instead of updating the hashes (Redis
+            only), see streams.py
+        redis_stream_batch_size: Distinct fields written at most per
+            stream entry
+        redis_stream_flush_interval: Seconds writes may wait locally
+            before being appended to the stream
 
     Examples:
         # Redis backend
@@ -38,60 +461,173 @@ def setup(
         setup(sqlite='metrics.db')
 
     Note:
+        - Configures the default backend, see Backend to store some
+          metrics elsewhere
         - Must provide either redis or sqlite, not both
         - Redis: Uses redis_prefix and redis_expire to prevent pollution
           in shared database
         - SQLite: No prefix/expire needed - file-based and self-contained
+        - Nothing is opened or written before the first write or read,
+          see Backend
     """
-    if redis is not None and sqlite is not None:
-        raise ValueError("Cannot specify both redis and sqlite")
-
-    if redis is not None:
-        # Setup Redis backend
-        _CONFIG["redis"] = redis
-        _CONFIG["redis_prefix"] = redis_prefix
-        _CONFIG["redis_expire"] = redis_expire
-    elif sqlite is not None:
-        # Setup SQLite backend
-        if isinstance(sqlite, str):
-            conn = sqlite3.connect(sqlite)
-        else:
-            conn = sqlite
+    DEFAULT_BACKEND.configure(
+        redis=redis,
+        sqlite=sqlite,
+        redis_prefix=redis_prefix,
+        redis_expire=redis_expire,
+        max_series=max_series,
+        redis_series_expire=redis_series_expire,
+        read_cache_size=read_cache_size,
+        read_cache_max_staleness=read_cache_max_staleness,
+        created=created,
+        redis_field_encoding=redis_field_encoding,
+        redis_write_timeout=redis_write_timeout,
+        redis_spool_size=redis_spool_size,
+        redis_spool_path=redis_spool_path,
+        redis_read=redis_read,
+        redis_read_max_lag=redis_read_max_lag,
+        redis_read_max_lag_bytes=redis_read_max_lag_bytes,
+        redis_stream=redis_stream,
+        redis_stream_batch_size=redis_stream_batch_size,
+        redis_stream_flush_interval=redis_stream_flush_interval,
+    )
 
-        # Create table if it doesn't exist
-        cursor = conn.cursor()
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS metrics (
-                metric_key TEXT NOT NULL,
-                subkey TEXT NOT NULL,
-                value REAL NOT NULL,
-                PRIMARY KEY (metric_key, subkey)
+
+def route(prefix: str, backend: Backend) -> None:
+    """Stores the metrics whose name starts with prefix in backend, the
+    longest matching prefix wins. Only metrics declared afterwards are
+    affected."""
+    _ROUTES.append((prefix, backend))
+    _ROUTES.sort(key=lambda route: len(route[0]), reverse=True)
+
+
+def bind_registry(registry, backend: Backend) -> None:
+    """Stores the metrics declared in registry from now on in backend."""
+    _REGISTRY_BACKENDS[registry] = backend
+
+
+def resolve_backend(
+    name: str, registry=None, backend: Optional[Backend] = None
+) -> Backend:
+    """Backend of a metric: the one it was given, else the one of its
+    registry, else the one routing its name, else the default one."""
+    if backend is not None:
+        return backend
+    if registry is not None and registry in _REGISTRY_BACKENDS:
+        return _REGISTRY_BACKENDS[registry]
+    for prefix, routed in _ROUTES:
+        if name.startswith(prefix):
+            return routed
+    return DEFAULT_BACKEND
+
+
+class BackendMixin(MetricAttributes):
+    """Resolves the backend of a metric at construction, as ``_target``.
+
+    Children and rollups are handed the backend of their parent.
+    """
+
+    # kind of backend the metric class writes to, "redis" or "sqlite"
+    _backend = ""
+
+    def __init__(self, *args, backend: Optional[Backend] = None, **kwargs):
+        self._requested_backend = backend
+        self._registry_arg = kwargs.get("registry", REGISTRY)
+        super().__init__(*args, **kwargs)
+        self._kwargs["backend"] = self._target
+        # only needed to resolve _target
+        del self._requested_backend, self._registry_arg
+
+    @cached_property
+    def _target(self) -> Backend:
+        # first needed by _metric_init, once the full name is known
+        target = resolve_backend(
+            self._name,
+            self._registry_arg,
+            self._requested_backend,
+        )
+        if target is not DEFAULT_BACKEND and target.kind not in (
+            None,
+            self._backend,
+        ):
+            raise ValueError(
+                f"Cannot store {self._backend} metric "
+                f"{self._name} in a {target.kind} backend"
             )
-            """)
-        conn.commit()
+        return target
 
-        _CONFIG["sqlite"] = conn
-    else:
-        raise ValueError("Must specify either redis or sqlite")
+    def _backend_ready(self) -> bool:
+        target = self._target
+        return target.kind == self._backend and target.connected
 
 
 # Backward compatibility alias
-def setup_sqlite(sqlite: Union[sqlite3.Connection, str]):
+def setup_sqlite(sqlite: Union["sqlite3.Connection", str]):
     """Deprecated: Use setup() instead."""
     setup(sqlite=sqlite)
 
 
-def get_redis_conn() -> Redis:
-    return _CONFIG["redis"]
+def get_redis_conn() -> "Redis":
+    return DEFAULT_BACKEND.redis
+
+
+def get_redis_write_guard() -> Optional["WriteGuard"]:
+    return DEFAULT_BACKEND.write_guard
+
+
+def get_redis_write_conn() -> "Redis":
+    """Client for writes, with the write timeout if one is set."""
+    return DEFAULT_BACKEND.redis_write_conn
 
 
 def get_redis_expire() -> int:
-    return _CONFIG["redis_expire"]
+    return DEFAULT_BACKEND.redis_expire
 
 
 def get_redis_key(name) -> str:
-    return f"{_CONFIG['redis_prefix']}_{name}"
+    return DEFAULT_BACKEND.redis_key(name)
+
+
+def get_redis_metadata_key() -> str:
+    return DEFAULT_BACKEND.redis_metadata_key()
+
+
+def get_redis_series_expire() -> Optional[int]:
+    return DEFAULT_BACKEND.redis_series_expire
+
+
+def get_redis_field_encoding() -> str:
+    return DEFAULT_BACKEND.redis_field_encoding
+
+
+def get_redis_timestamps_key(name) -> str:
+    return DEFAULT_BACKEND.redis_timestamps_key(name)
+
+
+def get_redis_touched_key(name) -> str:
+    return DEFAULT_BACKEND.redis_touched_key(name)
+
+
+def get_redis_series_key(name: Optional[str] = None) -> str:
+    return DEFAULT_BACKEND.redis_series_key(name)
+
+
+def get_backend() -> Optional[str]:
+    """Backend of the last setup(), "redis" or "sqlite"."""
+    return DEFAULT_BACKEND.kind
+
+
+def get_max_series() -> Optional[int]:
+    return DEFAULT_BACKEND.max_series
+
+
+def get_created_policy() -> str:
+    return DEFAULT_BACKEND.created
+
+
+def get_read_cache() -> Optional[ReadCache]:
+    return DEFAULT_BACKEND.read_cache
 
 
-def get_sqlite_conn() -> sqlite3.Connection:
-    return _CONFIG["sqlite"]
+def get_sqlite_conn() -> "sqlite3.Connection":
+    return DEFAULT_BACKEND.sqlite
@@ -0,0 +1,279 @@
+"""Sparse exponential histograms, laid out as Prometheus native histograms.
+
+The buckets of ``ExponentialHistogram`` grow exponentially: with ``schema``
+s, bucket k of positive values holds ``(base^(k-1), base^k]`` where
+``base = 2^(2^-s)`` (about 9% wider per bucket with the default schema 3).
+Observations within ``zero_threshold`` of 0 go to the zero bucket, negative
+ones to buckets mirroring the positive ones. Only populated buckets are
+stored, a field (Redis) or row (SQLite) each, so an observation writes its
+count, its sum and a single bucket, whatever the range of values. The
+bucket is found with ``math.frexp`` and a lookup among the ``2^s`` bounds
+within a power of two.
+
+Scrapes render either classic cumulative ``le`` buckets (``render="classic"``,
+the default) or native histogram samples (``render="native"``, exposed by
+the OpenMetrics 2.0 format of prometheus_client only). ``render_schema``
+lowers the rendered resolution, each rendered bucket merging
+``2^(schema - render_schema)`` stored ones.
+"""
+
+import bisect
+import math
+import sys
+from functools import lru_cache
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from prometheus_client.samples import BucketSpan, NativeHistogram, Sample
+from prometheus_client.utils import floatToGoString
+
+from .attributes import MetricAttributes
+
+# schemas supported by Prometheus native histograms
+MIN_SCHEMA, MAX_SCHEMA = -4, 8
+DEFAULT_SCHEMA = 3
+# the default of the Prometheus clients
+DEFAULT_ZERO_THRESHOLD = 2.0**-128
+RENDER_MODES = ("classic", "native")
+# label holding the bucket of stored fields, "z", "p<index>" or "n<index>"
+BUCKET_LABEL = "__bucket__"
+
+
+class ExponentialLayout:
+    """Bucket of a value for a schema and zero threshold, shared by the
+    metrics using them."""
+
+    __slots__ = ("schema", "zero_threshold", "_bounds")
+
+    def __init__(
+        self,
+        schema: int = DEFAULT_SCHEMA,
+        zero_threshold: float = DEFAULT_ZERO_THRESHOLD,
+    ):
+        if not MIN_SCHEMA <= schema <= MAX_SCHEMA:
+            raise ValueError(f"schema must be in [{MIN_SCHEMA}, {MAX_SCHEMA}]")
+        if zero_threshold < 0:
+            raise ValueError("zero_threshold must not be negative")
+        self.schema = schema
+        self.zero_threshold = zero_threshold
+        # frexp fractions at which the buckets within a power of two end
+        self._bounds = [
+            2 ** (i / 2**schema - 1)
+            for i in range(2**schema if schema > 0 else 0)
+        ]
+
+    def index(self, value: float) -> int:
+        """Index of the bucket of a positive finite value."""
+        fraction, exponent = math.frexp(value)
+        if self.schema > 0:
+            return bisect.bisect_left(self._bounds, fraction) + (
+                exponent - 1
+            ) * len(self._bounds)
+        index = exponent - 1 if fraction == 0.5 else exponent
+        shift = -self.schema
+        return (index + (1 << shift) - 1) >> shift
+
+    def key(self, value: float) -> Optional[str]:
+        """Stored bucket of a value, None for NaN."""
+        if math.isnan(value):
+            return None
+        if abs(value) <= self.zero_threshold:
+            return "z"
+        magnitude = min(abs(value), sys.float_info.max)
+        return f"{'p' if value > 0 else 'n'}{self.index(magnitude)}"
+
+
+@lru_cache(maxsize=None)
+def exponential_layout(schema: int, zero_threshold: float):
+    return ExponentialLayout(schema, zero_threshold)
+
+
+def upper_bound(index: int, schema: int) -> float:
+    try:
+        return 2.0 ** (index * 2.0**-schema)
+    except OverflowError:
+        return math.inf
+
+
+def _reindexed(
+    buckets: Dict[str, float], delta: int
+) -> Tuple[float, Dict[int, float], Dict[int, float]]:
+    """Zero count, positive and negative buckets, at a schema lowered by
+    delta."""
+    zero, positive, negative = 0.0, {}, {}  # type: ignore[var-annotated]
+    for key, count in buckets.items():
+        if key == "z":
+            zero += count
+            continue
+        index = (int(key[1:]) + (1 << delta) - 1) >> delta
+        target = positive if key[0] == "p" else negative
+        target[index] = target.get(index, 0) + count
+    return zero, positive, negative
+
+
+def classic_buckets(
+    layout: ExponentialLayout, schema: int, buckets: Dict[str, float]
+) -> List[Tuple[float, float]]:
+    """Cumulative counts by upper bound, rendered at schema."""
+    zero, positive, negative = _reindexed(buckets, layout.schema - schema)
+    cumulated, result = 0.0, []
+    for index in sorted(negative, reverse=True):
+        cumulated += negative[index]
+        result.append((-upper_bound(index - 1, schema), cumulated))
+    if zero:
+        cumulated += zero
+        result.append((layout.zero_threshold, cumulated))
+    for index in sorted(positive):
+        cumulated += positive[index]
+        result.append((upper_bound(index, schema), cumulated))
+    if not result or result[-1][0] != math.inf:
+        result.append((math.inf, cumulated))
+    return result
+
+
+def _spans(
+    counts: Dict[int, float],
+) -> Tuple[Optional[List[BucketSpan]], Optional[List[int]]]:
+    spans: List[BucketSpan] = []
+    deltas: List[int] = []
+    previous_index, previous_count = 0, 0
+    for index in sorted(counts):
+        if not spans:
+            spans.append(BucketSpan(index, 1))
+        elif index == previous_index + 1:
+            spans[-1] = BucketSpan(spans[-1].offset, spans[-1].length + 1)
+        else:
+            spans.append(BucketSpan(index - previous_index - 1, 1))
+        count = round(counts[index])
+        deltas.append(count - previous_count)
+        previous_index, previous_count = index, count
+    return spans or None, deltas or None
+
+
+def native_histogram(
+    layout: ExponentialLayout,
+    schema: int,
+    count: float,
+    total: float,
+    buckets: Dict[str, float],
+) -> NativeHistogram:
+    zero, positive, negative = _reindexed(buckets, layout.schema - schema)
+    pos_spans, pos_deltas = _spans(positive)
+    neg_spans, neg_deltas = _spans(negative)
+    return NativeHistogram(
+        count_value=count,
+        sum_value=total,
+        schema=schema,
+        zero_threshold=layout.zero_threshold,
+        zero_count=zero,
+        pos_spans=pos_spans,
+        neg_spans=neg_spans,
+        pos_deltas=pos_deltas,
+        neg_deltas=neg_deltas,
+    )
+
+
+class ExponentialMixin(MetricAttributes):
+    """Adds the schema, zero_threshold, render and render_schema arguments
+    to ExponentialHistogram, see the module docstring."""
+
+    # buckets are not stored as one field per le
+    _direct_rendering = False
+
+    def __init__(
+        self,
+        *args,
+        schema: int = DEFAULT_SCHEMA,
+        zero_threshold: float = DEFAULT_ZERO_THRESHOLD,
+        render: str = "classic",
+        render_schema: Optional[int] = None,
+        **kwargs,
+    ):
+        if render not in RENDER_MODES:
+            raise ValueError(f"render must be one of {RENDER_MODES}")
+        if render_schema is None:
+            render_schema = schema
+        if not MIN_SCHEMA <= render_schema <= schema:
+            raise ValueError(
+                f"render_schema must be in [{MIN_SCHEMA}, schema]"
+            )
+        self._layout = exponential_layout(schema, zero_threshold)
+        self._render = render
+        self._render_schema = render_schema
+        # values of the buckets written by this child, by stored bucket
+        self._bucket_values: Dict[str, object] = {}
+        super().__init__(*args, **kwargs)
+        self._kwargs.update(
+            schema=schema,
+            zero_threshold=zero_threshold,
+            render=render,
+            render_schema=render_schema,
+        )
+
+    def _prepare_buckets(self, source_buckets) -> None:
+        pass  # no fixed buckets
+
+    def _new_bucket_value(self, key: str):
+        raise NotImplementedError()
+
+    def _observe_bucket(self, amount: float, scale: float) -> None:
+        key = self._layout.key(amount)
+        if key is None:
+            return
+        value = self._bucket_values.get(key)
+        if value is None:
+            value = self._bucket_values.setdefault(
+                key, self._new_bucket_value(key)
+            )
+        value.inc(scale)  # type: ignore[attr-defined]
+
+    def _samples(self) -> Iterable[Sample]:
+        series: Dict[tuple, Dict] = {}
+        created = []
+        for sample in super()._samples():  # type: ignore[misc]
+            if sample.name == "_created":
+                created.append(sample)
+                continue
+            labels = dict(sample.labels)
+            key = labels.pop(BUCKET_LABEL, None)
+            entry = series.setdefault(
+                tuple(sorted(labels.items())),
+                {"labels": labels, "buckets": {}},
+            )
+            if key is None:
+                entry[sample.name] = sample.value
+            else:
+                entry["buckets"][key] = sample.value
+        for identity in sorted(series):
+            entry = series[identity]
+            # buckets increased while their label set was being pruned
+            if "_count" not in entry:
+                continue
+            labels = entry["labels"]
+            if self._render == "native":
+                yield Sample(
+                    "",
+                    labels,
+                    entry["_count"],
+                    native_histogram=native_histogram(
+                        self._layout,
+                        self._render_schema,
+                        entry["_count"],
+                        entry.get("_sum", 0.0),
+                        entry["buckets"],
+                    ),
+                )
+                continue
+            for bound, cumulated in classic_buckets(
+                self._layout, self._render_schema, entry["buckets"]
+            ):
+                yield Sample(
+                    "_bucket",
+                    {**labels, "le": floatToGoString(bound)},
+                    cumulated,
+                )
+            yield Sample("_count", labels, entry["_count"])
+            yield Sample("_sum", labels, entry.get("_sum", 0.0))
+        yield from created
+
+    _child_samples = _samples
+    _multi_samples = _samples
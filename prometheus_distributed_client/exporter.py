@@ -0,0 +1,238 @@
+"""Standalone exporter serving every family stored in a backend.
+
+Families are rebuilt from the metadata stored at declaration (see
+``metadata.py``), so the exporter needs none of the application code:
+
+    python -m prometheus_distributed_client serve --redis redis://host:6379/0
+
+Each scrape lists the families which still hold values, then streams their
+exposition (Prometheus text, or OpenMetrics when accepted) one family at a
+time, gzipped when accepted. Scrapes can be restricted to some families with
+``name[]`` query parameters, and to some label sets with ``match[]`` ones
+(``label=value``): ``/metrics?name[]=jobs_total&match[]=kind=cron``.
+"""
+
+import importlib
+import json
+import logging
+import threading
+import zlib
+from contextlib import nullcontext
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Iterable, Iterator, Optional, Tuple
+from urllib.parse import parse_qs, urlparse
+
+from prometheus_client import CollectorRegistry
+
+from .config import DEFAULT_BACKEND, Backend
+from .exposition import (
+    CONTENT_TYPE_LATEST,
+    FRAGMENT_CACHE,
+    OPENMETRICS_CONTENT_TYPE_LATEST,
+    FragmentCache,
+    stream_latest,
+)
+from .selection import parse_matchers
+
+logger = logging.getLogger(__name__)
+
+METRIC_CLASSES = {
+    "counter": "Counter",
+    "gauge": "Gauge",
+    "summary": "Summary",
+    "histogram": "Histogram",
+}
+
+# stored metadata of exponential histograms, see exponential.py
+EXPONENTIAL_KWARGS = ("schema", "zero_threshold", "render", "render_schema")
+
+
+def declare_family(backend: Backend, name: str, metadata: Dict):
+    """Builds an unregistered metric of backend from its stored metadata,
+    which it does not write back. Reading it does not refresh the TTL of
+    the family on Redis."""
+    module = importlib.import_module(f"{__package__}.{backend.kind}")
+    class_name = METRIC_CLASSES[metadata["type"]]
+    kwargs = {}
+    if "schema" in metadata:
+        class_name = "ExponentialHistogram"
+        for key in EXPONENTIAL_KWARGS:
+            kwargs[key] = metadata[key]
+    cls = getattr(module, class_name)
+    if "buckets" in metadata:
+        kwargs["buckets"] = metadata["buckets"]
+    if metadata.get("integer"):
+        kwargs["integer"] = True
+    if metadata.get("packed") and backend.kind == "sqlite":
+        kwargs["packed"] = True
+    if "multiprocess_mode" in metadata:
+        kwargs["multiprocess_mode"] = metadata["multiprocess_mode"]
+    if "quantiles" in metadata:
+        kwargs["quantiles"] = metadata["quantiles"]
+        kwargs["relative_accuracy"] = metadata["relative_accuracy"]
+        if "max_bins" in metadata:  # not stored by earlier versions
+            kwargs["max_bins"] = metadata["max_bins"]
+    family = cls(
+        name,
+        metadata["help"],
+        metadata["labelnames"],
+        unit=metadata["unit"],
+        registry=None,
+        backend=backend,
+        store_metadata=False,
+        **kwargs,
+    )
+    if backend.kind == "redis":
+        # only the application keeps its families alive
+        family._expire_on_collect = False
+    return family
+
+
+class Exporter:
+    """Keeps the families rebuilt from a backend, by default the one set
+    up with setup().
+
+    A family is only rebuilt when its stored metadata changed. SQLite
+    connections are not shared between threads, so scrapes of a SQLite
+    backend are serialized.
+    """
+
+    def __init__(
+        self,
+        cache: FragmentCache = FRAGMENT_CACHE,
+        backend: Backend = DEFAULT_BACKEND,
+    ):
+        if backend.kind is None:
+            raise ValueError("setup() must be called before exporting")
+        self.target = backend
+        self.backend = backend.kind
+        self.cache = cache
+        self._families: Dict[str, Tuple[str, object]] = {}
+        self._lock = threading.Lock()
+        self._scrape_lock = (
+            threading.Lock() if self.backend == "sqlite" else nullcontext()
+        )
+
+    def registry(self) -> CollectorRegistry:
+        module = importlib.import_module(f"{__package__}.{self.backend}")
+        stored = module.stored_metadata(self.target)
+        registry = CollectorRegistry(auto_describe=False)
+        with self._lock:
+            for name in list(self._families):
+                if name not in stored:
+                    del self._families[name]
+            for name, raw in sorted(stored.items()):
+                family = self._families.get(name)
+                if family is None or family[0] != raw:
+                    metadata = json.loads(raw)
+                    if metadata["type"] not in METRIC_CLASSES:
+                        logger.warning("cannot export %s %s", name, raw)
+                        continue
+                    family = self._families[name] = (
+                        raw,
+                        declare_family(self.target, name, metadata),
+                    )
+                registry.register(family[1])  # type: ignore[arg-type]
+        return registry
+
+    def stream(
+        self,
+        openmetrics_format: bool = False,
+        names: Optional[Iterable[str]] = None,
+        matchers: Optional[Dict[str, str]] = None,
+    ) -> Iterator[bytes]:
+        """Exposition of the stored families, restricted to names and
+        matchers if given, see stream_latest()."""
+        with self._scrape_lock:
+            registry = self.registry()
+            chunks = stream_latest(
+                registry, self.cache, openmetrics_format, names, matchers
+            )
+            if self.backend == "sqlite":
+                chunks = iter(list(chunks))
+        return chunks
+
+
+def accepts(header: Optional[str], value: str) -> bool:
+    return any(
+        accepted.split(";")[0].strip() == value
+        for accepted in (header or "").split(",")
+    )
+
+
+class ExporterHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # for chunked transfer encoding
+    exporter: Exporter
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        url = urlparse(self.path)
+        if url.path not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        openmetrics_format = accepts(
+            self.headers.get("Accept"), "application/openmetrics-text"
+        )
+        # name[] as prometheus_client's exposition, match[] as label=value
+        query = parse_qs(url.query)
+        try:
+            matchers = parse_matchers(query.get("match[]", ()))
+        except ValueError as error:
+            self.send_error(400, str(error))
+            return
+        try:
+            chunks = self.exporter.stream(
+                openmetrics_format, query.get("name[]"), matchers
+            )
+        except Exception:
+            logger.exception("could not list stored families")
+            self.send_error(500)
+            return
+        self.send_response(200)
+        self.send_header(
+            "Content-Type",
+            (
+                OPENMETRICS_CONTENT_TYPE_LATEST
+                if openmetrics_format
+                else CONTENT_TYPE_LATEST
+            ),
+        )
+        compressor = None
+        if accepts(self.headers.get("Accept-Encoding"), "gzip"):
+            self.send_header("Content-Encoding", "gzip")
+            compressor = zlib.compressobj(wbits=zlib.MAX_WBITS | 16)
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        for chunk in chunks:
+            self._write_chunk(
+                compressor.compress(chunk) if compressor else chunk
+            )
+        if compressor is not None:
+            self._write_chunk(compressor.flush())
+        self.wfile.write(b"0\r\n\r\n")
+
+    def _write_chunk(self, chunk: bytes) -> None:
+        if chunk:
+            self.wfile.write(b"%x\r\n%s\r\n" % (len(chunk), chunk))
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        logger.debug(format, *args)
+
+
+def make_server(
+    addr: str, port: int, exporter: Optional[Exporter] = None
+) -> ThreadingHTTPServer:
+    handler = type(
+        "Handler", (ExporterHandler,), {"exporter": exporter or Exporter()}
+    )
+    server = ThreadingHTTPServer((addr, port), handler)
+    server.daemon_threads = True
+    return server
+
+
+def serve(addr: str = "0.0.0.0", port: int = 9090) -> None:
+    server = make_server(addr, port)
+    logger.info("serving metrics on %s:%d", addr, server.server_port)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
@@ -0,0 +1,388 @@
+"""Renders the exposition formats straight from the stored fields.
+
+``prometheus_client.generate_latest`` decodes each field into a ``Sample``
+before formatting it back into text. Fields rarely change between scrapes,
+so these renderers translate each raw field into its ready-to-write label
+fragment once, memoized in a bounded LRU, and on each scrape only render
+the values that changed. Collectors not backed by this library, or whose
+samples are not one per field (``_direct_rendering`` false: summaries with
+quantiles, exponential histograms), are rendered by prometheus_client.
+Scrapes can be restricted to some families and label sets, see
+selection.py.
+"""
+
+import threading
+from collections import OrderedDict
+from typing import (
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+    Union,
+)
+
+from prometheus_client import exposition
+from prometheus_client.openmetrics import exposition as openmetrics
+from prometheus_client.metrics_core import Metric
+from prometheus_client.registry import REGISTRY
+from prometheus_client.utils import floatToGoString
+
+from .fields import decode_field, merge_values
+from .generations import prefetch_generations
+from .selection import Selection
+
+CONTENT_TYPE_LATEST = exposition.CONTENT_TYPE_LATEST
+OPENMETRICS_CONTENT_TYPE_LATEST = openmetrics.CONTENT_TYPE_LATEST
+
+DEFAULT_FRAGMENT_CACHE_SIZE = 100000
+
+# position of each suffix within the samples of a label set
+SUFFIX_ORDER = {
+    "_bucket": 0,
+    "": 1,
+    "_total": 1,
+    "_count": 2,
+    "_sum": 3,
+    "_created": 4,
+}
+# OpenMetrics types exposed under another name in the Prometheus format
+TEXT_TYPES = {"unknown": "untyped"}
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", r"\\").replace("\n", r"\n").replace('"', r"\"")
+
+
+def _labelstr(labels: Dict[str, str]) -> str:
+    if not labels:
+        return ""
+    return (
+        "{"
+        + ",".join(f'{k}="{_escape(v)}"' for k, v in sorted(labels.items()))
+        + "}"
+    )
+
+
+class Fragment:
+    """What rendering the sample of a raw field needs.
+
+    ``last`` holds the last raw value seen with its rendered line, most
+    values being unchanged from one scrape to the next.
+    """
+
+    __slots__ = ("suffix", "group", "prefix", "order", "family_wide", "last")
+
+    def __init__(
+        self, name: str, field: Union[bytes, str], labelnames: Sequence[str]
+    ):
+        if isinstance(field, bytes):
+            field = field.decode("utf8")
+        self.suffix, labels = decode_field(field, labelnames)
+        self.prefix = f"{name}{self.suffix}{_labelstr(labels)} "
+        self.family_wide = (
+            self.suffix == "_created" and bool(labelnames) and not labels
+        )
+        bound = 0.0
+        if self.suffix == "_bucket":
+            labels = dict(labels)
+            bound = float(labels.pop("le"))
+        # labels of the label set, without le for buckets
+        self.group = _labelstr(labels)
+        self.order = (self.group, SUFFIX_ORDER[self.suffix], bound)
+        self.last: Tuple[Union[bytes, float, None], str] = (None, "")
+
+    def line(self, raw: Union[bytes, float]) -> str:
+        last = self.last
+        if last[0] == raw:
+            return last[1]
+        line = f"{self.prefix}{floatToGoString(raw)}\n"
+        self.last = (raw, line)
+        return line
+
+
+class FragmentCache:
+    """Bounded LRU of translated fields, keyed by metric, label names and
+    raw field."""
+
+    def __init__(self, max_size: int = DEFAULT_FRAGMENT_CACHE_SIZE):
+        self.max_size = max_size
+        self._entries: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def translate(
+        self, name: str, labelnames: Sequence[str], fields
+    ) -> List[Fragment]:
+        fragments = []
+        entries = self._entries
+        # a family may be declared again with other label names
+        family = (name, tuple(labelnames))
+        with self._lock:
+            for field in fields:
+                key = (family, field)
+                fragment = entries.get(key)
+                if fragment is None:
+                    fragment = entries[key] = Fragment(name, field, labelnames)
+                    if len(entries) > self.max_size:
+                        entries.popitem(last=False)
+                else:
+                    entries.move_to_end(key)
+                fragments.append(fragment)
+        return fragments
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+
+FRAGMENT_CACHE = FragmentCache()
+
+# sort key, whether it is a _created sample, line
+Line = Tuple[tuple, bool, str]
+
+
+def _metric_lines(
+    metric, cache: FragmentCache, selection: Optional[Selection] = None
+) -> List[Line]:
+    """Lines of a family's samples, in storage order."""
+    if selection is not None and selection.matchers:
+        items = list(metric._raw_fields(selection.matchers))
+    else:
+        items = list(metric._raw_fields())
+    fragments = cache.translate(
+        metric._name, metric._labelnames, [field for field, _ in items]
+    )
+    family_created = None
+    anchor, anchors = metric._created_anchor, []
+    lines: Dict[str, Line] = {}
+    raws: Dict[str, Union[bytes, float]] = {}
+    for (_, raw), fragment in zip(items, fragments):
+        if fragment.family_wide:
+            family_created = merge_values(
+                "_created", family_created, float(raw)
+            )
+            continue
+        if selection is not None and not selection.keeps_sample(
+            metric._name, metric._name + fragment.suffix
+        ):
+            if fragment.suffix == anchor and fragment.prefix not in raws:
+                anchors.append(fragment.group)
+            raws[fragment.prefix] = raw
+            continue
+        prefix = fragment.prefix
+        if prefix in raws:  # the same value held by fields in two encodings
+            raw = merge_values(
+                fragment.suffix, float(raws[prefix]), float(raw)
+            )
+            line = f"{prefix}{floatToGoString(raw)}\n"
+        else:
+            line = fragment.line(raw)
+            if fragment.suffix == anchor:
+                anchors.append(fragment.group)
+        raws[prefix] = raw
+        lines[prefix] = (
+            fragment.order,
+            fragment.suffix == "_created",
+            line,
+        )
+    if family_created is not None and (
+        selection is None
+        or selection.keeps_sample(metric._name, f"{metric._name}_created")
+    ):
+        value = floatToGoString(family_created)
+        for group in anchors:
+            lines[f"{metric._name}_created{group} "] = (
+                (group, SUFFIX_ORDER["_created"], 0.0),
+                True,
+                f"{metric._name}_created{group} {value}\n",
+            )
+    return list(lines.values())
+
+
+def _render_text(
+    metric,
+    cache: FragmentCache,
+    output: List[str],
+    selection: Optional[Selection] = None,
+) -> None:
+    lines = _metric_lines(metric, cache, selection)
+    if selection is not None and not lines:
+        return
+    name, typ = metric._name, metric._type
+    documentation = metric._documentation.replace("\\", r"\\").replace(
+        "\n", r"\n"
+    )
+    header = name + "_total" if typ == "counter" else name
+    output.append(f"# HELP {header} {documentation}\n")
+    output.append(f"# TYPE {header} {TEXT_TYPES.get(typ, typ)}\n")
+    created = []
+    for _, is_created, line in lines:
+        if is_created:
+            created.append(line)
+        else:
+            output.append(line)
+    if created:
+        output.append(f"# HELP {name}_created {documentation}\n")
+        output.append(f"# TYPE {name}_created gauge\n")
+        output.extend(created)
+
+
+def _render_openmetrics(
+    metric,
+    cache: FragmentCache,
+    output: List[str],
+    selection: Optional[Selection] = None,
+) -> None:
+    lines = _metric_lines(metric, cache, selection)
+    if selection is not None and not lines:
+        return
+    name = metric._name
+    output.append(f"# HELP {name} {_escape(metric._documentation)}\n")
+    output.append(f"# TYPE {name} {metric._type}\n")
+    if metric._unit:
+        output.append(f"# UNIT {name} {metric._unit}\n")
+    # samples of a label set must be contiguous, buckets by increasing le
+    for _, _, line in sorted(lines):
+        output.append(line)
+
+
+class _Families:
+    """Registry like wrapper around already collected families."""
+
+    def __init__(self, families):
+        self._families = families
+
+    def collect(self):
+        return self._families
+
+
+def _collectors(registry) -> Optional[list]:
+    """Collectors of registry with the names they are registered under,
+    None if it does not expose them."""
+    if not hasattr(registry, "_collector_to_names"):
+        return None
+    with registry._lock:
+        collectors = list(registry._collector_to_names.items())
+        if getattr(registry, "_target_info", None):
+            collectors.insert(
+                0,
+                (
+                    _Families([registry._target_info_metric()]),
+                    {"target_info"},
+                ),
+            )
+    return collectors
+
+
+def _restricted(metrics, selection: Selection) -> list:
+    """Collected families restricted to the samples selection keeps."""
+    restricted = []
+    for metric in metrics:
+        samples = [
+            sample
+            for sample in metric.samples
+            if selection.keeps_sample(metric.name, sample.name)
+            and selection.matches(sample.labels)
+        ]
+        if samples:
+            copy = Metric(
+                metric.name, metric.documentation, metric.type, metric.unit
+            )
+            copy.samples = samples
+            restricted.append(copy)
+    return restricted
+
+
+def _iter_rendered(
+    registry, cache, render, fallback, selection: Optional[Selection]
+) -> Iterator[bytes]:
+    collectors = _collectors(registry)
+    if collectors is None:
+        if selection is None:
+            yield fallback(registry)
+        else:
+            yield fallback(
+                _Families(_restricted(registry.collect(), selection))
+            )
+        return
+    collectors = [
+        (collector, names)
+        for collector, names in collectors
+        if selection is None or selection.selects_family(names)
+    ]
+    if selection is None or not selection.matchers:
+        # one batch per backend, see generations.py
+        prefetch_generations(collector for collector, _ in collectors)
+    for collector, names in collectors:
+        if hasattr(collector, "_raw_fields") and getattr(
+            collector, "_direct_rendering", True
+        ):
+            output: List[str] = []
+            render(collector, cache, output, selection)
+            yield "".join(output).encode("utf8")
+        elif selection is None:
+            yield fallback(_Families(collector.collect()))
+        else:
+            yield fallback(
+                _Families(_restricted(collector.collect(), selection))
+            )
+
+
+def _openmetrics_without_eof(registry) -> bytes:
+    return openmetrics.generate_latest(registry).removesuffix(b"# EOF\n")
+
+
+def stream_latest(
+    registry=REGISTRY,
+    cache: FragmentCache = FRAGMENT_CACHE,
+    openmetrics_format: bool = False,
+    names: Optional[Iterable[str]] = None,
+    matchers: Optional[Dict[str, str]] = None,
+) -> Iterator[bytes]:
+    """Yields the exposition one collector at a time, restricted to the
+    families or samples called names and the label sets matching matchers
+    (label values by name), if given (see selection.py)."""
+    selection = (
+        None if names is None and not matchers else Selection(names, matchers)
+    )
+    if not openmetrics_format:
+        yield from _iter_rendered(
+            registry,
+            cache,
+            _render_text,
+            exposition.generate_latest,
+            selection,
+        )
+        return
+    yield from _iter_rendered(
+        registry,
+        cache,
+        _render_openmetrics,
+        _openmetrics_without_eof,
+        selection,
+    )
+    yield b"# EOF\n"
+
+
+def generate_latest(
+    registry=REGISTRY,
+    cache: FragmentCache = FRAGMENT_CACHE,
+    names: Optional[Iterable[str]] = None,
+    matchers: Optional[Dict[str, str]] = None,
+) -> bytes:
+    """Drop-in replacement for ``prometheus_client.generate_latest``."""
+    return b"".join(
+        stream_latest(registry, cache, names=names, matchers=matchers)
+    )
+
+
+def generate_openmetrics(
+    registry=REGISTRY,
+    cache: FragmentCache = FRAGMENT_CACHE,
+    names: Optional[Iterable[str]] = None,
+    matchers: Optional[Dict[str, str]] = None,
+) -> bytes:
+    """Drop-in replacement for the OpenMetrics ``generate_latest``."""
+    return b"".join(stream_latest(registry, cache, True, names, matchers))
@@ -0,0 +1,112 @@
+"""Encoding of the fields holding each value of a metric.
+
+Two encodings coexist and are always both readable:
+
+- ``json``: ``{suffix}:{labels as sorted compact JSON}``, for instance
+  ``_total:{"method":"GET","status":"200"}``,
+- ``compact`` (version 1, marked by a leading ``~``): a one letter suffix code
+  followed by the label values in label names order, each preceded by ``|``,
+  for instance ``~t|GET|200``. ``\\`` and ``|`` within values are escaped
+  with ``\\``. Label names are not stored, they are taken from the metric
+  (plus ``le`` for buckets) when decoding.
+"""
+
+import json
+from typing import Dict, Optional, Sequence, Tuple
+
+FIELD_ENCODINGS = ("json", "compact")
+COMPACT_MARKER = "~"
+
+SUFFIX_CODES = {
+    "": "g",
+    "_total": "t",
+    "_created": "c",
+    "_count": "n",
+    "_sum": "s",
+    "_bucket": "b",
+    "_ebucket": "e",
+}
+CODE_SUFFIXES = {code: suffix for suffix, code in SUFFIX_CODES.items()}
+# suffixes carrying extra labels after the metric ones
+EXTRA_LABELNAMES = {"_bucket": ("le",), "_ebucket": ("__bucket__",)}
+
+
+def labels_json(labelnames, labelvalues) -> str:
+    return json.dumps(
+        dict(zip(labelnames, labelvalues)),
+        sort_keys=True,
+        separators=(",", ":"),
+    )
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("|", "\\|")
+
+
+def _split_values(encoded: str) -> list:
+    values, current, escaped = [], [], False
+    for char in encoded[1:]:
+        if escaped:
+            current.append(char)
+            escaped = False
+        elif char == "\\":
+            escaped = True
+        elif char == "|":
+            values.append("".join(current))
+            current = []
+        else:
+            current.append(char)
+    values.append("".join(current))
+    return values
+
+
+def encode_field(
+    suffix: str,
+    labelnames: Sequence[str],
+    labelvalues: Sequence[str],
+    encoding: str = "json",
+) -> str:
+    if encoding == "compact":
+        return (
+            COMPACT_MARKER
+            + SUFFIX_CODES[suffix]
+            + "".join("|" + _escape(value) for value in labelvalues)
+        )
+    return f"{suffix}:{labels_json(labelnames, labelvalues)}"
+
+
+def decode_field(
+    field: str, labelnames: Sequence[str]
+) -> Tuple[str, Dict[str, str]]:
+    """Returns suffix and labels of a field in either encoding.
+
+    A compact field without any value carries no labels at all, as the
+    family wide _created does.
+    """
+    if not field.startswith(COMPACT_MARKER):
+        suffix, labels_str = field.split(":", 1)
+        return suffix, json.loads(labels_str)
+    suffix = CODE_SUFFIXES[field[1]]
+    encoded = field[2:]
+    if not encoded:
+        return suffix, {}
+    names = tuple(labelnames) + EXTRA_LABELNAMES.get(suffix, ())
+    values = _split_values(encoded)
+    if len(values) != len(names):
+        raise ValueError(
+            f"field {field!r} does not match label names {names!r}"
+        )
+    return suffix, dict(zip(names, values))
+
+
+def merge_values(
+    suffix: str, previous: Optional[float], value: float
+) -> float:
+    """Combines two fields holding the same value in different encodings."""
+    if previous is None:
+        return value
+    if suffix == "_created":
+        return min(previous, value)
+    if suffix == "":  # gauges, no way to tell which one is the latest
+        return value
+    return previous + value
@@ -0,0 +1,99 @@
+"""Write generations of the families, so scrapes skip unchanged families.
+
+Every write of a family bumps its generation within the same atomic update:
+Redis increments the family's field of the ``{prefix}:generations`` hash
+after the write, in the same pipeline (the write guard, the stream
+aggregator and snapshot imports queue it as a ``generation`` op), and
+SQLite triggers on the tables holding values bump the family's row of
+``metrics_generations``. Redis hashes expire without any write, so the
+generation of a Redis family comes with whether its hash still exists.
+
+Before a scrape, the exposition (see exposition.py) reads the generations
+of all its families in one batch per backend. Each family keeps the fields
+it last read along with their generation, and the samples decoded from
+them, and only reads them again once its generation moved. Redis reads the
+generation again with the fields, in one transaction on the same
+connection, as the batch may have been read from another server (see
+replica.py); SQLite keeps the generation read before them.
+A family scraped without a prefetched generation, by prometheus_client's
+``generate_latest`` for instance, is read as before.
+"""
+
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from .attributes import MetricAttributes
+from .read_cache import MISS
+
+# families whose generations are read per query (SQLite variables)
+GENERATIONS_BATCH_SIZE = 500
+
+
+def prefetch_generations(collectors: Iterable) -> None:
+    """Reads the generations of the families of collectors, one batch per
+    backend, for their next read of their fields."""
+    batches: Dict[Tuple[int, Callable], List] = {}
+    for collector in collectors:
+        if isinstance(collector, GenerationCacheMixin):
+            batches.setdefault(
+                (id(collector._target), collector._read_generations), []
+            ).append(collector)
+    for batch in batches.values():
+        first = batch[0]
+        for start in range(0, len(batch), GENERATIONS_BATCH_SIZE):
+            end = start + GENERATIONS_BATCH_SIZE
+            chunk = batch[start:end]
+            generations = first._read_generations(
+                first._target, [collector._name for collector in chunk]
+            )
+            for collector in chunk:
+                collector._prefetched_generation = generations.get(
+                    collector._name
+                )
+
+
+class GenerationCacheMixin(MetricAttributes):
+    """Keeps the fields of a family until its generation moves."""
+
+    # read by prefetch_generations(), MISS once used
+    _prefetched_generation = MISS
+    # generation, fields read after it, samples decoded from them
+    _generation_cache: Optional[list] = None
+
+    @staticmethod
+    def _read_generations(backend, names: List[str]) -> Dict:
+        """Generations of the families called names, by name, None (or
+        missing) for those which cannot be cached."""
+        raise NotImplementedError()
+
+    def _cached_fields(self, read, read_generation=None) -> list:
+        """Fields returned by read(), or the ones last read if the family's
+        generation did not move since.
+
+        read_generation(), if given, returns the generation along with the
+        fields, both read from the same connection at once: the fields are
+        cached under it rather than under the prefetched generation, which
+        may have been read from another server, or before a write.
+        """
+        generation = self._prefetched_generation
+        self._prefetched_generation = MISS
+        if generation is MISS or generation is None:
+            return list(read())
+        cached = self._generation_cache
+        if cached is not None and cached[0] == generation:
+            return cached[1]
+        if read_generation is None:
+            fields = list(read())
+        else:
+            generation, read_fields = read_generation()
+            fields = list(read_fields)
+        self._generation_cache = [generation, fields, None]
+        return fields
+
+    def _cached_samples(self, fields, decode) -> list:
+        """Samples decoded from fields, only once for cached fields."""
+        cached = self._generation_cache
+        if cached is None or cached[1] is not fields:
+            return list(decode(fields))
+        if cached[2] is None:
+            cached[2] = list(decode(fields))
+        return cached[2]
@@ -0,0 +1,70 @@
+"""Fields only ever incremented by whole numbers.
+
+Counts of histograms and summaries, their buckets and the counters declared
+with ``integer=True`` hold whole numbers as long as no event is scaled by
+sampling. Redis increments them with HINCRBY rather than HINCRBYFLOAT,
+which spares the server parsing and formatting long doubles. SQLite stores
+whole numbers with INTEGER storage class, the ``value`` column of the
+``metrics`` table having NUMERIC affinity. Values are always read back as
+floats, whichever way they were written.
+
+The fields a process increments as whole numbers may still hold fractions
+written by others, sampled processes for instance. Redis rejects HINCRBY
+on them, ``execute_increments`` then sends those again as HINCRBYFLOAT.
+"""
+
+from typing import List
+
+from .attributes import MetricAttributes
+
+
+def whole_counts(metric) -> bool:
+    """Whether the counts of metric are incremented by whole numbers only,
+    none of its events being scaled by sampling (see sampling.py)."""
+    sampler = metric._sampler
+    return sampler.base_rate >= 1 and sampler.max_write_rate is None
+
+
+class IntegerCounterMixin(MetricAttributes):
+    """Adds the integer argument to counters, see the module docstring."""
+
+    def __init__(self, *args, integer: bool = False, **kwargs):
+        self._integer = integer
+        super().__init__(*args, **kwargs)
+        if integer and not whole_counts(self):
+            raise ValueError("integer counters cannot be sampled")
+        self._kwargs["integer"] = integer
+
+    def inc(self, amount: float = 1, exemplar=None) -> None:
+        if self._integer and not float(amount).is_integer():
+            raise ValueError(
+                f"integer counter {self._name} incremented by {amount}"
+            )
+        super().inc(amount, exemplar)  # type: ignore[misc]
+
+
+def execute_increments(pipe, raise_on_error: bool = True) -> List:
+    """Runs pipe, sending again as HINCRBYFLOAT the HINCRBY rejected as
+    the field holds a fraction, returns the results of pipe's commands.
+    Other errors are raised once the increments are sent, or left among
+    the results without raise_on_error."""
+    # imported here as the sqlite backend does not need redis
+    from redis.exceptions import ResponseError
+
+    commands = [args for args, _ in pipe.command_stack]
+    results = pipe.execute(raise_on_error=False)
+    retried, error = [], None
+    for index, (args, result) in enumerate(zip(commands, results)):
+        if not isinstance(result, ResponseError):
+            continue
+        if args[0] == "HINCRBY" and "not an integer" in str(result):
+            pipe.hincrbyfloat(*args[1:])
+            retried.append(index)
+        elif error is None:
+            error = result
+    if retried:
+        for index, result in zip(retried, pipe.execute()):
+            results[index] = result
+    if error is not None and raise_on_error:
+        raise error
+    return results
@@ -0,0 +1,93 @@
+"""Family metadata stored in the backend next to the values.
+
+Type, help, label names and buckets of each family are stored when it is
+declared, so that a process serving ``/metrics`` (see ``exporter.py``) can
+rebuild every family without importing the application code. Metrics are
+often declared at import time, before ``setup()``, which does no I/O: the
+metadata of the families declared before the first use of a backend is
+stored by that first use.
+"""
+
+import json
+import logging
+import weakref
+from typing import Any, Dict
+
+from prometheus_client.utils import floatToGoString
+
+from .attributes import MetricAttributes
+
+logger = logging.getLogger(__name__)
+
+# parents and unlabelled metrics declared in this process
+_DECLARED: "weakref.WeakSet" = weakref.WeakSet()
+
+
+def family_metadata(metric) -> Dict[str, Any]:
+    metadata: Dict[str, Any] = {
+        "type": metric._type,
+        "help": metric._documentation,
+        "labelnames": list(metric._labelnames),
+        "unit": metric._unit,
+    }
+    if hasattr(metric, "_upper_bounds"):
+        metadata["buckets"] = [
+            floatToGoString(bound) for bound in metric._upper_bounds
+        ]
+    if getattr(metric, "_integer", False):
+        metadata["integer"] = True
+    if getattr(metric, "_packed", False):
+        metadata["packed"] = True
+    if getattr(metric, "_multiprocess_mode", None):
+        metadata["multiprocess_mode"] = metric._multiprocess_mode
+    if hasattr(metric, "_layout"):
+        metadata["schema"] = metric._layout.schema
+        metadata["zero_threshold"] = metric._layout.zero_threshold
+        metadata["render"] = metric._render
+        metadata["render_schema"] = metric._render_schema
+    if getattr(metric, "_quantiles", ()):
+        metadata["quantiles"] = list(metric._quantiles)
+        metadata["relative_accuracy"] = metric._relative_accuracy
+        metadata["max_bins"] = metric._max_bins
+    return metadata
+
+
+def dump_metadata(metric) -> str:
+    return json.dumps(family_metadata(metric), sort_keys=True)
+
+
+class MetadataMixin(MetricAttributes):
+    """Stores the metadata of parents and unlabelled metrics on declaration,
+    or on the first use of their backend, unless store_metadata is False
+    (families rebuilt from the stored metadata, see exporter.py)."""
+
+    def __init__(self, *args, store_metadata: bool = True, **kwargs):
+        super().__init__(*args, **kwargs)
+        if store_metadata and not self._labelvalues:
+            _DECLARED.add(self)
+            if self._backend_ready():
+                self._try_store_metadata()
+
+    def _backend_ready(self) -> bool:
+        raise NotImplementedError()
+
+    def _store_metadata(self) -> None:
+        raise NotImplementedError()
+
+    def _try_store_metadata(self) -> None:
+        # an unreachable backend must not break declarations at import time
+        try:
+            self._store_metadata()
+        except Exception:
+            logger.warning(
+                "could not store metadata of %s, will retry after setup()",
+                self._name,
+                exc_info=True,
+            )
+
+
+def store_declared_metadata(backend) -> None:
+    """Stores the metadata of every family bound to backend."""
+    for metric in list(_DECLARED):
+        if metric._target is backend and metric._backend_ready():
+            metric._try_store_metadata()
@@ -0,0 +1,76 @@
+"""Bucket counts of a histogram series packed in a single value (SQLite).
+
+With ``packed=True``, a SQLite Histogram keeps the whole state of a label
+set in one row of ``metrics_histograms``: its sum, count and ``_created``
+in columns and the count of each bucket (not cumulated) in a blob of
+little endian doubles. An observation is then a single upsert adding a
+blob counting 1 in its bucket to the stored one, through the
+``add_packed()`` SQL function registered on the connection, instead of one
+upsert per bucket. Scrapes unpack the blob into cumulative ``le`` buckets.
+"""
+
+import json
+import struct
+from functools import lru_cache
+from typing import Iterator, Optional, Sequence, Tuple
+
+from .fields import labels_json
+
+
+def pack_counts(counts: Sequence[float]) -> bytes:
+    return struct.pack(f"<{len(counts)}d", *counts)
+
+
+def unpack_counts(packed: Optional[bytes]) -> Tuple[float, ...]:
+    if not packed:
+        return ()
+    return struct.unpack(f"<{len(packed) // 8}d", packed)
+
+
+@lru_cache(maxsize=1024)
+def packed_delta(size: int, index: int, amount: float) -> bytes:
+    """size bucket counts, all zero but amount in bucket index."""
+    counts = [0.0] * size
+    counts[index] = amount
+    return pack_counts(counts)
+
+
+def add_packed(stored: Optional[bytes], delta: Optional[bytes]):
+    """Bucket-wise sum of two packed counts, as an SQL function."""
+    if stored is None:
+        return delta
+    if delta is None:
+        return stored
+    first, second = unpack_counts(stored), unpack_counts(delta)
+    if len(first) < len(second):
+        first, second = second, first
+    return pack_counts(
+        [
+            count + (second[index] if index < len(second) else 0.0)
+            for index, count in enumerate(first)
+        ]
+    )
+
+
+def packed_fields(
+    labels: str,
+    sum_value: float,
+    count: float,
+    created: Optional[float],
+    buckets: bytes,
+    les: Sequence[str],
+) -> Iterator[Tuple[str, float]]:
+    """Subkeys and values of a packed row, as the row layout stores them."""
+    decoded = json.loads(labels)
+    bucket_labelnames = tuple(decoded) + ("le",)
+    cumulative = 0.0
+    for le, bucket_count in zip(les, unpack_counts(buckets)):
+        cumulative += bucket_count
+        bucket_labels = labels_json(
+            bucket_labelnames, tuple(decoded.values()) + (le,)
+        )
+        yield f"_bucket:{bucket_labels}", cumulative
+    yield f"_count:{labels}", count
+    yield f"_sum:{labels}", sum_value
+    if created is not None:
+        yield f"_created:{labels}", created
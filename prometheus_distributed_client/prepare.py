@@ -0,0 +1,66 @@
+"""Initializes known label sets in bulk, at startup.
+
+Without it, the first write of each label set also stores its ``_created``
+timestamp (and, on SQLite, creating the child commits it), so the first
+requests after a deploy pay for it and a whole fleet starting at once sends
+a burst of small writes. ``metric.prepare(label_sets)`` creates the
+children and stores their zero values and ``_created`` timestamps in a
+single pipeline (Redis) or transaction (SQLite); ``prepare_registry()``
+does so for several families, in one batch per backend. Values already
+stored are left untouched.
+"""
+
+from contextlib import nullcontext
+from typing import Dict, Iterable, List, Mapping, Sequence, Tuple
+
+from .attributes import MetricAttributes
+
+
+class PrepareMixin(MetricAttributes):
+
+    def _zero_values(self) -> List:
+        """Values of this child stored as 0 by prepare()."""
+        raise NotImplementedError()
+
+    @staticmethod
+    def _prepare_children(backend, children: List) -> None:
+        """Stores zero values and _created of children in one batch."""
+        raise NotImplementedError()
+
+    def _preparing(self):
+        """Context in which prepare() creates the children."""
+        return nullcontext()
+
+    def _children_for(self, label_sets: Iterable[Sequence[str]]) -> List:
+        if not self._labelnames:
+            return [self]
+        with self._preparing():
+            return [self.labels(*values) for values in label_sets]
+
+    def prepare(self, label_sets: Iterable[Sequence[str]] = ()) -> List:
+        """Creates the children of label_sets (the metric itself if it has
+        no labels) and initializes them in one batch, returns them."""
+        children = self._children_for(label_sets)
+        self._prepare_children(self._target, children)
+        return children
+
+
+def prepare_registry(
+    registry, label_sets: Mapping[str, Iterable[Sequence[str]]]
+) -> None:
+    """Prepares the families of registry: labelled ones for the label sets
+    given under their name, unlabelled ones always. Families stored in the
+    same backend are initialized in a single batch."""
+    with registry._lock:
+        collectors = list(registry._collector_to_names)
+    batches: Dict[Tuple[str, object], Tuple[PrepareMixin, List]] = {}
+    for collector in collectors:
+        if not isinstance(collector, PrepareMixin):
+            continue
+        if collector._labelnames and collector._name not in label_sets:
+            continue
+        children = collector._children_for(label_sets.get(collector._name, ()))
+        key = (collector._backend, collector._target)
+        batches.setdefault(key, (collector, []))[1].extend(children)
+    for collector, children in batches.values():
+        collector._prepare_children(collector._target, children)
@@ -0,0 +1,306 @@
+"""Quantiles of Summary, merged across processes.
+
+With ``quantiles=(0.5, 0.99)``, a Summary also keeps a DDSketch per label
+set: observations are counted in logarithmic bins, narrow enough for any
+quantile to be estimated within ``relative_accuracy`` of its true value.
+Sketches are mergeable by adding their bins, so each process counts its
+observations in a local sketch and merges it into the stored one every
+``quantile_flush_interval`` seconds, atomically (a script on Redis, a
+single upsert on SQLite), from a background thread. SQLite connections
+which cannot be shared between threads are left to the next observation
+or scrape of the child. Sketches hold at most ``max_bins`` bins, the
+lowest ones being collapsed beyond, so that memory and write cost do not
+depend on the observation rate. Scrapes emit the ``quantile`` samples of
+the stored sketches.
+
+The sketch sees every observation, even those skipped by sampling, and
+ignores infinite and NaN ones. Local sketches are also flushed when their
+family is scraped, when their child is evicted (see ``max_children``), by
+``flush_sketches()`` and at interpreter exit.
+"""
+
+import atexit
+import json
+import logging
+import math
+import threading
+import time
+import weakref
+from typing import Dict, Iterable, Mapping, Optional, Sequence, Tuple
+
+from prometheus_client.samples import Sample
+from prometheus_client.utils import floatToGoString
+
+from .attributes import MetricAttributes
+from .fields import labels_json
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_RELATIVE_ACCURACY = 0.01
+DEFAULT_MAX_BINS = 2048
+# seconds between two merges of a local sketch into the stored one
+QUANTILE_FLUSH_INTERVAL = 10.0
+
+# children holding a local sketch
+_SKETCHED: "weakref.WeakSet" = weakref.WeakSet()
+_flusher: Optional[threading.Thread] = None
+_flusher_lock = threading.Lock()
+# set when a child starts a sketch, which may be due before the others
+_flusher_wakeup = threading.Event()
+
+
+def _bin_order(key: str) -> Tuple[int, int]:
+    """Sort key of bins by increasing values: negative, zero, positive."""
+    if key == "z":
+        return 0, 0
+    index = int(key[1:])
+    return (1, index) if key[0] == "p" else (-1, -index)
+
+
+class DDSketch:
+    """Weighted counts of observations by bin. Bin ``p<i>`` holds positive
+    values in ``(gamma^(i-1), gamma^i]``, ``n<i>`` their negative
+    counterparts and ``z`` zeros."""
+
+    __slots__ = ("relative_accuracy", "max_bins", "bins", "_gamma")
+
+    def __init__(
+        self,
+        relative_accuracy: float = DEFAULT_RELATIVE_ACCURACY,
+        max_bins: int = DEFAULT_MAX_BINS,
+        bins: Optional[Mapping[str, float]] = None,
+    ):
+        if not 0 < relative_accuracy < 1:
+            raise ValueError("relative_accuracy must be in (0, 1)")
+        if max_bins < 1:
+            raise ValueError("max_bins must be positive")
+        self.relative_accuracy = relative_accuracy
+        self.max_bins = max_bins
+        self.bins: Dict[str, float] = dict(bins or {})
+        self._gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+
+    def _key(self, value: float) -> str:
+        if value == 0:
+            return "z"
+        index = math.ceil(math.log(abs(value), self._gamma))
+        return f"{'p' if value > 0 else 'n'}{index}"
+
+    def _value(self, key: str) -> float:
+        """Value of a bin, within relative_accuracy of all it holds."""
+        if key == "z":
+            return 0.0
+        value = 2 * self._gamma ** int(key[1:]) / (self._gamma + 1)
+        return value if key[0] == "p" else -value
+
+    def add(self, value: float, weight: float = 1) -> None:
+        if not math.isfinite(value):
+            return
+        key = self._key(value)
+        self.bins[key] = self.bins.get(key, 0) + weight
+        if len(self.bins) > self.max_bins:
+            self._collapse()
+
+    def merge(self, bins: Mapping[str, float]) -> None:
+        for key, count in bins.items():
+            self.bins[key] = self.bins.get(key, 0) + count
+        self._collapse()
+
+    def _collapse(self) -> None:
+        excess = len(self.bins) - self.max_bins
+        if excess <= 0:
+            return
+        keys = sorted(self.bins, key=_bin_order)
+        for key, into in zip(keys[:excess], keys[1:]):
+            self.bins[into] += self.bins.pop(key)
+
+    def quantile(self, q: float) -> Optional[float]:
+        total = sum(self.bins.values())
+        if total <= 0:
+            return None
+        rank, cumulated = q * (total - 1), 0.0
+        keys = sorted(self.bins, key=_bin_order)
+        for key in keys:
+            cumulated += self.bins[key]
+            if cumulated > rank:
+                return self._value(key)
+        return self._value(keys[-1])
+
+    def encode(self) -> str:
+        return json.dumps(self.bins, separators=(",", ":"))
+
+
+def merge_encoded(stored: str, pending: str, max_bins: int) -> str:
+    """Merges two encoded sketches, the SQLite merge_sketch() function."""
+    # bins only, no accuracy is needed to add and collapse them
+    sketch = DDSketch(max_bins=max_bins, bins=json.loads(stored))
+    sketch.merge(json.loads(pending))
+    return sketch.encode()
+
+
+class QuantileMixin(MetricAttributes):
+    """Adds the quantiles, relative_accuracy, max_bins and
+    quantile_flush_interval arguments to Summary."""
+
+    _quantiles: Tuple[float, ...] = ()
+    # observations of this child not merged into the stored sketch yet
+    _sketch: Optional[DDSketch] = None
+
+    def __init__(
+        self,
+        *args,
+        quantiles: Sequence[float] = (),
+        relative_accuracy: float = DEFAULT_RELATIVE_ACCURACY,
+        max_bins: int = DEFAULT_MAX_BINS,
+        quantile_flush_interval: float = QUANTILE_FLUSH_INTERVAL,
+        **kwargs,
+    ):
+        if any(not 0 <= q <= 1 for q in quantiles):
+            raise ValueError("quantiles must be in [0, 1]")
+        self._quantiles = tuple(sorted(quantiles))
+        self._relative_accuracy = relative_accuracy
+        self._max_bins = max_bins
+        self._flush_interval = quantile_flush_interval
+        super().__init__(*args, **kwargs)
+        if self._quantiles and not self._is_parent():
+            self._sketch = DDSketch(relative_accuracy, max_bins)
+            self._sketch_lock = threading.Lock()
+            self._next_flush = time.monotonic() + quantile_flush_interval
+            _SKETCHED.add(self)
+            _start_flusher()
+        self._kwargs.update(
+            quantiles=self._quantiles,
+            relative_accuracy=relative_accuracy,
+            max_bins=max_bins,
+            quantile_flush_interval=quantile_flush_interval,
+        )
+
+    def _merge_sketch(
+        self, targets: Sequence[Tuple[str, str]], encoded: str
+    ) -> bool:
+        """Merges encoded into the stored sketches of targets, (metric
+        name, labels) pairs, in one atomic write. False if the backend is
+        unreachable."""
+        raise NotImplementedError()
+
+    def _stored_sketches(self) -> Iterable[Tuple[str, str]]:
+        """Labels and encoded sketch of each stored label set."""
+        raise NotImplementedError()
+
+    def _observe_quantile(self, amount: float) -> None:
+        if self._sketch is None:
+            return
+        with self._sketch_lock:
+            self._sketch.add(amount)
+        if time.monotonic() >= self._next_flush:
+            self.flush_quantiles()
+
+    def _flush_sketch(self) -> None:
+        with self._sketch_lock:
+            sketch = self._sketch
+            self._sketch = DDSketch(self._relative_accuracy, self._max_bins)
+            self._next_flush = time.monotonic() + self._flush_interval
+        if not sketch.bins:  # type: ignore[union-attr]
+            return
+        targets = [
+            (self._name, labels_json(self._labelnames, self._labelvalues))
+        ]
+        targets.extend(
+            (rollup_metric, labels_json(names, values))
+            for rollup_metric, names, values in self._rollup_fields()
+        )
+        if not self._merge_sketch(
+            targets, sketch.encode()  # type: ignore[union-attr]
+        ):
+            with self._sketch_lock:  # kept for the next flush
+                self._sketch.merge(sketch.bins)  # type: ignore[union-attr]
+
+    def flush_quantiles(self) -> None:
+        """Merges the observations counted locally since the last flush
+        into the stored sketches, those of every child for parents."""
+        if self._is_parent():
+            with self._lock:
+                children = list(self._metrics.values())
+            for child in children:
+                child.flush_quantiles()
+        elif self._sketch is not None:
+            self._flush_sketch()
+
+    def _evicted(self) -> None:
+        self.flush_quantiles()
+
+    @property
+    def _direct_rendering(self) -> bool:
+        # quantiles are not stored as fields, see exposition.py
+        return not self._quantiles
+
+    def _quantile_samples(self) -> Iterable[Sample]:
+        for labels, encoded in self._stored_sketches():
+            sketch = DDSketch(
+                self._relative_accuracy, self._max_bins, json.loads(encoded)
+            )
+            for q in self._quantiles:
+                value = sketch.quantile(q)
+                if value is not None:
+                    yield Sample(
+                        "",
+                        {**json.loads(labels), "quantile": floatToGoString(q)},
+                        value,
+                    )
+
+    def _samples(self) -> Iterable[Sample]:
+        if self._quantiles:
+            # the observations of this process are scraped as well
+            self.flush_quantiles()
+            yield from self._quantile_samples()
+        yield from super()._samples()  # type: ignore[misc]
+
+    _child_samples = _samples
+    _multi_samples = _samples
+
+
+def flush_sketches() -> None:
+    """Flushes the local sketch of every child of this process."""
+    for metric in list(_SKETCHED):
+        try:
+            metric.flush_quantiles()
+        except Exception:
+            logger.warning(
+                "could not flush the quantiles of %s",
+                metric._name,
+                exc_info=True,
+            )
+
+
+def _flush_periodically() -> None:
+    while True:
+        _flusher_wakeup.clear()
+        now = time.monotonic()
+        next_flush = now + QUANTILE_FLUSH_INTERVAL
+        for metric in list(_SKETCHED):
+            if metric._next_flush <= now:
+                try:
+                    metric.flush_quantiles()
+                except Exception:
+                    logger.warning(
+                        "could not flush the quantiles of %s",
+                        metric._name,
+                        exc_info=True,
+                    )
+            next_flush = min(next_flush, metric._next_flush)
+        _flusher_wakeup.wait(max(0.0, next_flush - time.monotonic()))
+
+
+def _start_flusher() -> None:
+    global _flusher  # pylint: disable=global-statement
+    _flusher_wakeup.set()
+    with _flusher_lock:
+        if _flusher is None:
+            _flusher = threading.Thread(
+                target=_flush_periodically,
+                name="prometheus-distributed-quantiles",
+                daemon=True,
+            )
+            _flusher.start()
+
+
+atexit.register(flush_sketches)
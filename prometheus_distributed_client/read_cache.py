@@ -0,0 +1,179 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Set, Tuple
+
+logger = logging.getLogger(__name__)
+
+MISS = object()
+INVALIDATE_CHANNEL = "__redis__:invalidate"
+
+
+class ReadCache:
+    """Bounded LRU of values read back from the backend.
+
+    Entries live at most ``max_staleness`` seconds. On top of that they are
+    dropped when this process writes the same field, when the backend
+    reports the key changed (Redis key tracking, see
+    ``RedisInvalidationListener``) or when the version they were read at is
+    outdated (SQLite ``PRAGMA data_version``).
+    """
+
+    def __init__(self, max_size: int, max_staleness: float):
+        self.max_size = max_size
+        self.max_staleness = max_staleness
+        self._entries: OrderedDict = OrderedDict()
+        self._subkeys: Dict[str, Set[str]] = {}
+        # bumped by clear(), and per key by invalidate()
+        self._clears = 0
+        self._invalidations: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def token(self, key: str) -> Tuple[int, int]:
+        """To take before reading key from the backend and pass to put, so
+        that a value invalidated while being read is not cached. Writes to
+        other keys do not affect it."""
+        return self._clears, self._invalidations.get(key, 0)
+
+    def get(self, key: str, subkey: str, version: Any = None) -> Any:
+        with self._lock:
+            entry = self._entries.get((key, subkey))
+            if entry is None:
+                return MISS
+            value, expires_at, entry_version = entry
+            if expires_at < time.monotonic() or entry_version != version:
+                self._drop(key, subkey)
+                return MISS
+            self._entries.move_to_end((key, subkey))
+            return value
+
+    def put(
+        self,
+        key: str,
+        subkey: str,
+        value: Any,
+        token: Tuple[int, int],
+        version: Any = None,
+    ) -> None:
+        with self._lock:
+            if token != self.token(key):
+                return
+            self._entries[(key, subkey)] = (
+                value,
+                time.monotonic() + self.max_staleness,
+                version,
+            )
+            self._entries.move_to_end((key, subkey))
+            self._subkeys.setdefault(key, set()).add(subkey)
+            while len(self._entries) > self.max_size:
+                self._drop(*next(iter(self._entries)))
+
+    def _drop(self, key: str, subkey: str) -> None:
+        self._entries.pop((key, subkey), None)
+        subkeys = self._subkeys.get(key)
+        if subkeys is not None:
+            subkeys.discard(subkey)
+            if not subkeys:
+                del self._subkeys[key]
+
+    def invalidate(self, key: str, subkey: Optional[str] = None) -> None:
+        """Drops one field, or every field of key if subkey is None."""
+        with self._lock:
+            self._invalidations[key] = self._invalidations.get(key, 0) + 1
+            if subkey is not None:
+                self._drop(key, subkey)
+                return
+            for known_subkey in self._subkeys.pop(key, ()):
+                self._entries.pop((key, known_subkey), None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._clears += 1
+            self._invalidations.clear()
+            self._entries.clear()
+            self._subkeys.clear()
+
+
+class RedisInvalidationListener(threading.Thread):
+    """Drops cache entries as Redis reports keys under prefix changed.
+
+    Uses broadcasting key tracking (``CLIENT TRACKING ... BCAST``) redirected
+    to a connection subscribed to the invalidation channel, so invalidations
+    are received for every write, whichever process made it. If the server
+    does not support tracking, the cache only relies on max_staleness.
+    """
+
+    def __init__(self, redis, prefix: str, cache: ReadCache):
+        super().__init__(name="prometheus-distributed-invalidation")
+        self.daemon = True
+        self._cache = cache
+        self._stopped = threading.Event()
+        pool = redis.connection_pool
+        self._listener = pool.make_connection()
+        # tracking lasts as long as the connection enabling it is open
+        self._tracking = pool.make_connection()
+        try:
+            self._listener.send_command("CLIENT", "ID")
+            client_id = self._listener.read_response()
+            self._listener.send_command("SUBSCRIBE", INVALIDATE_CHANNEL)
+            self._listener.read_response()
+            self._tracking.send_command(
+                "CLIENT",
+                "TRACKING",
+                "ON",
+                "REDIRECT",
+                client_id,
+                "BCAST",
+                "PREFIX",
+                prefix,
+            )
+            self._tracking.read_response()
+        except Exception:
+            self._listener.disconnect()
+            self._tracking.disconnect()
+            raise
+
+    def handle(self, message) -> None:
+        if message[0] not in (b"message", "message"):
+            return
+        keys = message[2]
+        if keys is None:  # the server flushed its tracking table
+            self._cache.clear()
+            return
+        for key in keys:
+            self._cache.invalidate(
+                key.decode("utf8") if isinstance(key, bytes) else key
+            )
+
+    def run(self) -> None:
+        try:
+            while not self._stopped.is_set():
+                if self._listener.can_read(timeout=1.0):
+                    self.handle(self._listener.read_response())
+        except Exception:
+            logger.exception("lost Redis invalidations, clearing read cache")
+            self._cache.clear()
+        finally:
+            self._listener.disconnect()
+            self._tracking.disconnect()
+
+    def stop(self) -> None:
+        self._stopped.set()
+
+
+def start_invalidation_listener(
+    redis, prefix: str, cache: ReadCache
+) -> Optional[RedisInvalidationListener]:
+    try:
+        listener = RedisInvalidationListener(redis, prefix, cache)
+    except Exception as error:
+        logger.warning(
+            "Redis key tracking unavailable (%s), read cache entries will "
+            "only expire after %ss",
+            error,
+            cache.max_staleness,
+        )
+        return None
+    listener.start()
+    return listener
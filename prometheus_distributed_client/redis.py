@@ -1,16 +1,190 @@
 import json
 import time
-from typing import Dict, Iterable, Optional
+import weakref
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
 
 import prometheus_client
 from prometheus_client.samples import Sample
-from prometheus_client.utils import floatToGoString
-from prometheus_client.values import MutexValue
 
-from .config import get_redis_conn, get_redis_expire, get_redis_key
+from .cardinality import CardinalityLimitMixin
+from .children import BoundedChildrenMixin, BucketLayoutMixin
+from .config import DEFAULT_BACKEND, Backend, BackendMixin
+from .exponential import BUCKET_LABEL, ExponentialMixin
+from .fields import (
+    FIELD_ENCODINGS,
+    decode_field,
+    encode_field,
+    labels_json,
+    merge_values,
+)
+from .generations import GenerationCacheMixin
+from .integers import (
+    IntegerCounterMixin,
+    execute_increments,
+    whole_counts,
+)
+from .metadata import MetadataMixin, dump_metadata
+from .prepare import PrepareMixin
+from .quantiles import QuantileMixin
+from .read_cache import MISS
+from .resilience import Op
+from .rollup import RollupMixin
+from .sampling import SamplingMixin
+from .selection import Selection, field_patterns, matchable
 
+# gauge modes for which set() is an atomic compare-and-set
+GAUGE_SET_MODES = ("max", "min", "mostrecent")
+
+# KEYS: metric hash, timestamps hash
+# ARGV: field, value, mode (max, min or mostrecent), timestamp, expire
+SET_GAUGE_SCRIPT = """
+local value = tonumber(ARGV[2])
+if ARGV[3] == 'mostrecent' then
+    local timestamp = redis.call('HGET', KEYS[2], ARGV[1])
+    if timestamp and tonumber(timestamp) > tonumber(ARGV[4]) then
+        return 0
+    end
+    redis.call('HSET', KEYS[2], ARGV[1], ARGV[4])
+    if ARGV[5] ~= '' then
+        redis.call('EXPIRE', KEYS[2], ARGV[5])
+    end
+else
+    local current = redis.call('HGET', KEYS[1], ARGV[1])
+    if current then
+        current = tonumber(current)
+        if (ARGV[3] == 'max' and value <= current)
+                or (ARGV[3] == 'min' and value >= current) then
+            return 0
+        end
+    end
+end
+redis.call('HSET', KEYS[1], ARGV[1], ARGV[2])
+return 1
+"""
+
+# label sets pruned at most per call, prune_stale runs on each scrape
+PRUNE_BATCH_SIZE = 500
+
+# fields returned per HSCAN call of a filtered scrape
+SCAN_COUNT = 1000
+
+# KEYS: family series set, global series set
+# ARGV: member, family cap, global cap, expire, global member (-1: no cap)
+ADMIT_SERIES_SCRIPT = """
+if redis.call('SISMEMBER', KEYS[1], ARGV[1]) == 1 then
+    redis.call('EXPIRE', KEYS[1], ARGV[4])
+    return 1
+end
+local cap = tonumber(ARGV[2])
+if cap >= 0 and redis.call('SCARD', KEYS[1]) >= cap then
+    return 0
+end
+local global_cap = tonumber(ARGV[3])
+if global_cap >= 0 then
+    if redis.call('SCARD', KEYS[2]) >= global_cap then
+        return 0
+    end
+    redis.call('SADD', KEYS[2], ARGV[5])
+    redis.call('EXPIRE', KEYS[2], ARGV[4])
+end
+redis.call('SADD', KEYS[1], ARGV[1])
+redis.call('EXPIRE', KEYS[1], ARGV[4])
+return 1
+"""
+
+# KEYS: metric hash, touched sorted set, series set, sketches hash,
+#       generations hash
+# ARGV: cutoff, then for each series: member, field count, fields...
+PRUNE_SERIES_SCRIPT = """
+local pruned = 0
+local i = 2
+while i <= #ARGV do
+    local member = ARGV[i]
+    local count = tonumber(ARGV[i + 1])
+    local score = redis.call('ZSCORE', KEYS[2], member)
+    if score and tonumber(score) <= tonumber(ARGV[1]) then
+        for j = i + 2, i + 1 + count do
+            redis.call('HDEL', KEYS[1], ARGV[j])
+        end
+        redis.call('ZREM', KEYS[2], member)
+        redis.call('SREM', KEYS[3], member)
+        redis.call('HDEL', KEYS[4], member)
+        pruned = pruned + 1
+    end
+    i = i + 2 + count
+end
+if pruned > 0 then
+    redis.call('HINCRBY', KEYS[5], KEYS[1], 1)
+end
+return pruned
+"""
+
+# KEYS: sketches hash
+# ARGV: field (labels of the series), encoded sketch, max bins, expire
+MERGE_SKETCH_SCRIPT = """
+local stored = redis.call('HGET', KEYS[1], ARGV[1])
+local bins = stored and cjson.decode(stored) or {}
+local keys = {}
+for key, count in pairs(cjson.decode(ARGV[2])) do
+    bins[key] = (bins[key] or 0) + count
+end
+for key in pairs(bins) do
+    table.insert(keys, key)
+end
+local excess = #keys - tonumber(ARGV[3])
+if excess > 0 then
+    -- collapses the lowest bins, in the order of quantiles._bin_order
+    local function order(key)
+        local kind = key:sub(1, 1)
+        if kind == 'z' then
+            return 0, 0
+        elseif kind == 'p' then
+            return 1, tonumber(key:sub(2))
+        end
+        return -1, -tonumber(key:sub(2))
+    end
+    table.sort(keys, function(a, b)
+        local kind_a, index_a = order(a)
+        local kind_b, index_b = order(b)
+        return kind_a < kind_b or (kind_a == kind_b and index_a < index_b)
+    end)
+    for i = 1, excess do
+        bins[keys[i + 1]] = bins[keys[i + 1]] + bins[keys[i]]
+        bins[keys[i]] = nil
+    end
+end
+redis.call('HSET', KEYS[1], ARGV[1], cjson.encode(bins))
+redis.call('EXPIRE', KEYS[1], ARGV[4])
+return 1
+"""
+
+
+def _write(backend: Backend, func, default=None):
+    """Runs func(conn) with the write guard of backend, if any."""
+    if backend.write_guard is None:
+        return func(backend.redis)
+    return backend.write_guard.call(func, default)
+
+
+class ValueClass:
+    """A value stored in a field of the family hash. Redis applies each
+    update atomically, so unlike prometheus_client values no local value
+    or lock is kept (see children.py)."""
+
+    __slots__ = (
+        "__metric_name",
+        "__suffix",
+        "__labelnames",
+        "__labelvalues",
+        "__le",
+        "__series",
+        "__mode",
+        "__integer",
+        "__rollups",
+        "__backend",
+        "__fields",
+    )
 
-class ValueClass(MutexValue):
     def __init__(
         self,
         typ,
@@ -19,110 +193,578 @@ class ValueClass(MutexValue):
         labelvalues,
         **kwargs,
     ):
-        super().__init__(
-            typ,
-            metric_name,
-            metric_name + kwargs.get("suffix", ""),
-            labelnames,
-            labelvalues,
-            **kwargs,
-        )
         self.__metric_name = metric_name
         self.__suffix = kwargs.get("suffix", "")
         self.__labelnames = labelnames
         self.__labelvalues = labelvalues
+        # bucket bound, the last label value, kept apart to share the tuple
+        # of label values between the buckets of a child
+        self.__le = kwargs.get("le")
+        self.__series = kwargs.get("series")
+        self.__mode = kwargs.get("multiprocess_mode", "").removeprefix("live")
+        # incremented with HINCRBY, see integers.py
+        self.__integer = kwargs.get("integer", False)
+        self.__rollups = tuple(kwargs.get("rollups", ()))
+        self.__backend: Backend = kwargs.get("backend", DEFAULT_BACKEND)
+        # encoding and field names, they do not change once computed
+        self.__fields: Optional[Tuple[str, tuple]] = None
+
+    def __all_labelvalues(self):
+        if self.__le is None:
+            return self.__labelvalues
+        return self.__labelvalues + (self.__le,)
+
+    def __encoded_fields(self):
+        encoding = self.__backend.redis_field_encoding
+        if self.__fields is None or self.__fields[0] != encoding:
+            self.__fields = (
+                encoding,
+                encode_field(
+                    self.__suffix,
+                    self.__labelnames,
+                    self.__all_labelvalues(),
+                    encoding,
+                ),
+                tuple(
+                    (
+                        rollup_metric,
+                        encode_field(self.__suffix, names, values, encoding),
+                    )
+                    for rollup_metric, names, values in self.__rollups
+                ),
+            )
+        return self.__fields[1:]
 
     @property
     def _redis_key(self):
-        return get_redis_key(self.__metric_name)
+        return self.__backend.redis_key(self.__metric_name)
 
     @property
     def _redis_subkey(self):
-        labels_json = json.dumps(
-            dict(zip(self.__labelnames, self.__labelvalues)),
-            sort_keys=True,
-            separators=(",", ":"),
+        return self.__encoded_fields()[0]
+
+    @property
+    def _redis_rollups(self):
+        """Metric names and fields mirroring this value in rollups."""
+        return self.__encoded_fields()[1]
+
+    def _touch(self, pipe, now: float):
+        """Records the series as alive, for per-series staleness expiry."""
+        if self.__series is None or self.__backend.redis_series_expire is None:
+            return
+        touched_key = self.__backend.redis_touched_key(self.__metric_name)
+        pipe.zadd(touched_key, {self.__series: now})
+        pipe.expire(touched_key, self.__backend.redis_expire)
+
+    def _spool_ops(self, op: str, value, now: float) -> List[Op]:
+        """What pipe does, in a form the write guard can spool."""
+        backend = self.__backend
+        keys: Tuple[str, ...] = (self._redis_key,)
+        if op in GAUGE_SET_MODES:
+            keys += (backend.redis_timestamps_key(self.__metric_name),)
+        ops: List[Op] = [(op, keys, self._redis_subkey, value)]
+        if op in ("inc", "setnx"):
+            ops.extend(
+                (op, (backend.redis_key(rollup_metric),), rollup_subkey, value)
+                for rollup_metric, rollup_subkey in self._redis_rollups
+            )
+        # see _queue_generations()
+        generations_key = backend.redis_generations_key()
+        ops.extend(
+            [
+                ("generation", (generations_key,), written[1][0], 1)
+                for written in ops
+            ]
         )
-        return f"{self.__suffix}:{labels_json}"
+        if op != "setnx":
+            ops.extend(self._touch_ops(now))
+        return ops
+
+    def _touch_ops(self, now: float) -> List[Op]:
+        """What _touch does, in a form the write guard can spool."""
+        backend = self.__backend
+        if self.__series is None or backend.redis_series_expire is None:
+            return []
+        touched_key = backend.redis_touched_key(self.__metric_name)
+        return [("touch", (touched_key,), self.__series, now)]
+
+    def _queue_generations(self, pipe, rollups: bool) -> None:
+        """Bumps the generations of the families written, after the writes,
+        see generations.py."""
+        backend = self.__backend
+        keys = [self._redis_key]
+        if rollups:
+            keys.extend(
+                backend.redis_key(rollup_metric)
+                for rollup_metric, _ in self._redis_rollups
+            )
+        for key in keys:
+            pipe.hincrby(backend.redis_generations_key(), key, 1)
+
+    def _execute(self, pipe, op: str, value, now: float):
+        backend = self.__backend
+        if backend.stream_writer is not None:
+            backend.stream_writer.add(self._spool_ops(op, value, now))
+        elif backend.write_guard is None:
+            execute_increments(pipe)
+        else:
+            backend.write_guard.execute(pipe, self._spool_ops(op, value, now))
+        self._invalidate_cache()
 
     def inc(self, amount):
-        conn = get_redis_conn()
-        conn.hincrbyfloat(self._redis_key, self._redis_subkey, amount)
-        conn.expire(self._redis_key, get_redis_expire())
+        now = time.time()
+        # the type of amount picks the command, here and in queue_ops()
+        amount = int(amount) if self.__integer else float(amount)
+        pipe = self.__backend.redis_write_conn.pipeline()
+        incr = pipe.hincrby if self.__integer else pipe.hincrbyfloat
+        incr(self._redis_key, self._redis_subkey, amount)
+        pipe.expire(self._redis_key, self.__backend.redis_expire)
+        for rollup_metric, rollup_subkey in self._redis_rollups:
+            rollup_key = self.__backend.redis_key(rollup_metric)
+            incr(rollup_key, rollup_subkey, amount)
+            pipe.expire(rollup_key, self.__backend.redis_expire)
+        self._touch(pipe, now)
+        self._queue_generations(pipe, rollups=True)
+        self._execute(pipe, "inc", amount, now)
 
     def set(self, value, timestamp=None):
-        conn = get_redis_conn()
-        conn.hset(self._redis_key, self._redis_subkey, value)
+        now = time.time()
+        conn = self.__backend.redis_write_conn
+        pipe = conn.pipeline()
+        if self.__mode in GAUGE_SET_MODES:
+            timestamp = now if timestamp is None else timestamp
+            conn.register_script(SET_GAUGE_SCRIPT)(
+                keys=[
+                    self._redis_key,
+                    self.__backend.redis_timestamps_key(self.__metric_name),
+                ],
+                args=[
+                    self._redis_subkey,
+                    value,
+                    self.__mode,
+                    timestamp,
+                    self.__backend.redis_expire,
+                ],
+                client=pipe,
+            )
+            if self.__mode == "mostrecent":
+                value = (value, timestamp)
+            self._touch(pipe, now)
+            self._queue_generations(pipe, rollups=False)
+            self._execute(pipe, self.__mode, value, now)
+            return
+        pipe.hset(self._redis_key, self._redis_subkey, value)
+        self._touch(pipe, now)
+        self._queue_generations(pipe, rollups=False)
+        self._execute(pipe, "set", value, now)
 
     def set_exemplar(self, exemplar):
         raise NotImplementedError()
 
+    def _queue_setnx(self, pipe, value):
+        pipe.hsetnx(self._redis_key, self._redis_subkey, value)
+        for rollup_metric, rollup_subkey in self._redis_rollups:
+            pipe.hsetnx(
+                self.__backend.redis_key(rollup_metric), rollup_subkey, value
+            )
+        self._queue_generations(pipe, rollups=True)
+
     def setnx(self, value):
-        conn = get_redis_conn()
-        conn.hsetnx(self._redis_key, self._redis_subkey, value)
+        pipe = self.__backend.redis_write_conn.pipeline(
+            transaction=bool(self.__rollups)
+        )
+        self._queue_setnx(pipe, value)
+        self._execute(pipe, "setnx", value, time.time())
 
-    def get(self) -> Optional[float]:
-        bvalue = get_redis_conn().hget(self._redis_key, self._redis_subkey)
+    def _invalidate_cache(self):
+        cache = self.__backend.read_cache
+        if cache is None:
+            return
+        cache.invalidate(self._redis_key, self._redis_subkey)
+        for rollup_metric, rollup_subkey in self._redis_rollups:
+            cache.invalidate(
+                self.__backend.redis_key(rollup_metric), rollup_subkey
+            )
+
+    def _fetch(self) -> Optional[float]:
+        bvalue = self.__backend.redis.hget(self._redis_key, self._redis_subkey)
         if not bvalue:
             return None
         return float(bvalue.decode("utf8"))  # type: ignore[union-attr]
 
+    def get(self) -> Optional[float]:
+        cache = self.__backend.listened_read_cache()
+        if cache is None:
+            return self._fetch()
+        key, subkey = self._redis_key, self._redis_subkey
+        value = cache.get(key, subkey)
+        if value is MISS:
+            token = cache.token(key)
+            value = self._fetch()
+            cache.put(key, subkey, value, token)
+        return value
+
+
+class RedisMetricMixin(
+    BackendMixin,
+    BoundedChildrenMixin,
+    PrepareMixin,
+    MetadataMixin,
+    CardinalityLimitMixin,
+    GenerationCacheMixin,
+):
+    _backend = "redis"
+    # field suffixes written for each label set
+    _series_suffixes: Tuple[str, ...] = ()
+    # whether scraping refreshes the metric TTL
+    _expire_on_collect = False
+    # suffix of the fields whose label sets get a family wide _created
+    _created_anchor = "_total"
+    # last write of this child, see _ensure_created
+    _last_write = float("-inf")
+    _redis_created: Optional[ValueClass] = None
+
+    @staticmethod
+    def _prepare_children(backend: Backend, children: List) -> None:
+        now = time.time()
+        pipe = backend.redis_write_conn.pipeline()
+        ops: List[Op] = []
+        written: List[ValueClass] = []
+        for child in children:
+            values: List[Tuple[ValueClass, float]] = [
+                (value, 0) for value in child._zero_values()
+            ]
+            if child._redis_created is not None:
+                values.append((child._redis_created, now))
+            for value, initial in values:
+                value._queue_setnx(pipe, initial)
+                ops.extend(value._spool_ops("setnx", initial, now))
+                written.append(value)
+            if values:
+                values[0][0]._touch(pipe, now)
+                ops.extend(values[0][0]._touch_ops(now))
+            child._last_write = time.monotonic()
+        for key in sorted({op[1][0] for op in ops if op[0] == "setnx"}):
+            pipe.expire(key, backend.redis_expire)
+        if backend.write_guard is None:
+            pipe.execute()
+        else:
+            backend.write_guard.execute(pipe, ops)
+        for value in written:
+            value._invalidate_cache()
+
+    def _store_metadata(self) -> None:
+        key, metadata = self._target.redis_metadata_key(), dump_metadata(self)
+        pipe = self._target.redis_write_conn.pipeline()
+        pipe.hset(key, self._name, metadata)
+        guard = self._target.write_guard
+        if guard is None:
+            pipe.execute()
+        else:
+            guard.execute(pipe, [("metadata", (key,), self._name, metadata)])
 
-class RedisMetricMixin:
     def _refresh_expire(self):
-        get_redis_conn().expire(get_redis_key(self._name), get_redis_expire())
+        backend = self._target
+        keys = [backend.redis_key(self._name)]
+        if self._series_limited():
+            # admitted label sets are kept as long as the family is written
+            keys.append(backend.redis_series_key(self._name))
+            if backend.max_series is not None:
+                keys.append(backend.redis_series_key())
 
+        def refresh(conn):
+            pipe = conn.pipeline(transaction=False)
+            for key in keys:
+                pipe.expire(key, backend.redis_expire)
+            return pipe.execute()
 
-class Counter(RedisMetricMixin, prometheus_client.Counter):
-    def _metric_init(self):
-        self._value = ValueClass(
-            self._type,
+        _write(backend, refresh)
+
+    @property
+    def _redis_series(self) -> str:
+        return labels_json(self._labelnames, self._labelvalues)
+
+    def _created_value(self) -> Optional[ValueClass]:
+        policy = self._target.created
+        if policy == "disabled":
+            return None
+        if policy == "family":
+            return ValueClass(
+                "gauge",
+                self._name,
+                (),
+                (),
+                help_text=self._documentation,
+                backend=self._target,
+                suffix="_created",
+                rollups=tuple(
+                    (rollup, (), ()) for rollup, _, _ in self._rollup_fields()
+                ),
+            )
+        return ValueClass(
+            "gauge",
             self._name,
             self._labelnames,
             self._labelvalues,
             help_text=self._documentation,
-            suffix="_total",
+            backend=self._target,
+            suffix="_created",
+            series=self._redis_series,
+            rollups=self._rollup_fields(),
         )
-        self._redis_created = ValueClass(
-            "gauge",
+
+    def _ensure_created(self):
+        """Sends _created at most once per child, unless the backend may
+        have expired it since this child last wrote."""
+        now = time.monotonic()
+        created_ttl = min(
+            self._target.redis_expire,
+            self._target.redis_series_expire or float("inf"),
+        )
+        if self._redis_created is not None:
+            if now - self._last_write >= created_ttl:
+                self._redis_created.setnx(time.time())
+        self._last_write = now
+
+    def _admit_series(self, labelvalues) -> bool:
+        member = labels_json(self._labelnames, labelvalues)
+        global_cap = self._target.max_series
+
+        def admit(conn) -> bool:
+            script = conn.register_script(ADMIT_SERIES_SCRIPT)
+            return bool(
+                script(
+                    keys=[
+                        self._target.redis_series_key(self._name),
+                        self._target.redis_series_key(),
+                    ],
+                    args=[
+                        member,
+                        -1 if self._max_series is None else self._max_series,
+                        -1 if global_cap is None else global_cap,
+                        self._target.redis_expire,
+                        f"{self._name}:{member}",
+                    ],
+                )
+            )
+
+        # while Redis is unreachable, label sets are admitted
+        return _write(self._target, admit, default=True)
+
+    def _count_overflow(self) -> None:
+        _overflow_counter(self._target).labels(self._name).inc()
+
+    def _series_subkeys(self, labels: Dict[str, str]) -> List[str]:
+        """Fields of a label set, in every encoding as both may coexist."""
+        values = [labels[name] for name in self._labelnames]
+        return [
+            encode_field(suffix, self._labelnames, values, encoding)
+            for suffix in self._series_suffixes
+            for encoding in FIELD_ENCODINGS
+        ]
+
+    def prune_stale(self, batch_size: int = PRUNE_BATCH_SIZE) -> int:
+        """Removes up to batch_size label sets idle for longer than
+        redis_series_expire, returns the number of label sets removed."""
+        series_expire = self._target.redis_series_expire
+        if series_expire is None:
+            return 0
+        conn = self._target.redis
+        cutoff = time.time() - series_expire
+        touched_key = self._target.redis_touched_key(self._name)
+        members: list = conn.zrangebyscore(
+            touched_key, "-inf", cutoff, start=0, num=batch_size
+        )
+        if not members:
+            return 0
+        args: List = [cutoff]
+        for member in members:
+            subkeys = self._series_subkeys(json.loads(member))
+            args.extend([member, len(subkeys), *subkeys])
+        script = conn.register_script(PRUNE_SERIES_SCRIPT)
+        return int(
+            script(
+                keys=[
+                    self._target.redis_key(self._name),
+                    touched_key,
+                    self._target.redis_series_key(self._name),
+                    self._target.redis_sketches_key(self._name),
+                    self._target.redis_generations_key(),
+                ],
+                args=args,
+            )
+        )
+
+    def _raw_fields(
+        self, matchers: Optional[Dict[str, str]] = None
+    ) -> Iterable[Tuple[bytes, bytes]]:
+        """Fields and values of the whole family, as stored, or of the label
+        sets matching matchers (see selection.py)."""
+        if self.prune_stale():
+            # the prefetched generation predates the pruning
+            self._prefetched_generation = MISS
+        key = self._target.redis_key(self._name)
+        if not matchers:
+            fields = self._cached_fields(
+                lambda: self._target.redis_read(
+                    lambda conn: conn.hgetall(key)
+                ).items(),
+                lambda: self._target.redis_read(self._read_with_generation),
+            )
+        elif matchable(self._labelnames, matchers):
+            fields = list(
+                self._target.redis_read(
+                    lambda conn: self._matching_fields(conn, key, matchers)
+                ).items()
+            )
+        else:
+            fields = []
+        if self._expire_on_collect:
+            self._target.redis.expire(key, self._target.redis_expire)
+        return fields
+
+    @staticmethod
+    def _read_generations(
+        backend: Backend, names: List[str]
+    ) -> Dict[str, Optional[tuple]]:
+        keys = [backend.redis_key(name) for name in names]
+
+        def read(conn):
+            pipe = conn.pipeline(transaction=False)
+            pipe.hmget(backend.redis_generations_key(), keys)
+            for key in keys:
+                pipe.exists(key)
+            return pipe.execute()
+
+        generations, *exists = backend.redis_read(read)
+        return {
+            # hashes expire without their generation moving
+            name: None if generation is None else (generation, key_exists)
+            for name, generation, key_exists in zip(names, generations, exists)
+        }
+
+    def _read_with_generation(
+        self, conn
+    ) -> Tuple[Optional[tuple], Iterable[Tuple[bytes, bytes]]]:
+        """Generation and fields of the family, read in one transaction."""
+        backend = self._target
+        key = backend.redis_key(self._name)
+        pipe = conn.pipeline(transaction=True)
+        pipe.hget(backend.redis_generations_key(), key)
+        pipe.exists(key)
+        pipe.hgetall(key)
+        generation, key_exists, fields = pipe.execute()
+        if generation is None:
+            return None, fields.items()
+        return (generation, key_exists), fields.items()
+
+    def _matching_fields(
+        self, conn, key: str, matchers: Dict[str, str]
+    ) -> Dict[bytes, bytes]:
+        selection = Selection(matchers=matchers)
+        fields = {}
+        for pattern in field_patterns(self._labelnames, matchers):
+            for field, bvalue in conn.hscan_iter(
+                key, match=pattern, count=SCAN_COUNT
+            ):
+                _, labels = decode_field(
+                    field.decode("utf8"), self._labelnames
+                )
+                if selection.matches(labels):
+                    fields[field] = bvalue
+        # the family wide _created applies to the matching label sets
+        family_created = [
+            encode_field("_created", (), (), encoding)
+            for encoding in FIELD_ENCODINGS
+        ]
+        for field, bvalue in zip(
+            family_created, conn.hmget(key, family_created)
+        ):
+            if bvalue is not None and self._labelnames:
+                fields[field.encode("utf8")] = bvalue
+        return fields
+
+    def _samples(self) -> Iterable[Sample]:
+        return self._cached_samples(self._raw_fields(), self._decode_samples)
+
+    def _decode_samples(self, fields) -> Iterable[Sample]:
+        family_created, anchors = None, []
+        # during an encoding migration a value may be held by two fields
+        merged: Dict[tuple, Tuple[str, Dict[str, str], float]] = {}
+        for field, bvalue in fields:
+            suffix, labels = decode_field(
+                field.decode("utf8"), self._labelnames
+            )
+            value = float(bvalue)
+            if suffix == "_created" and self._labelnames and not labels:
+                family_created = merge_values(suffix, family_created, value)
+                continue
+            identity = (suffix, tuple(sorted(labels.items())))
+            if identity in merged:
+                value = merge_values(suffix, merged[identity][2], value)
+            merged[identity] = (suffix, labels, value)
+        for identity in sorted(merged):
+            suffix, labels, value = merged[identity]
+            if suffix == self._created_anchor:
+                anchors.append(labels)
+            yield Sample(suffix, labels, value)
+        if family_created is not None:
+            for labels in anchors:
+                yield Sample("_created", labels, family_created)
+
+    _child_samples = _samples
+    _multi_samples = _samples
+
+
+class Counter(
+    RollupMixin,
+    IntegerCounterMixin,
+    SamplingMixin,
+    RedisMetricMixin,
+    prometheus_client.Counter,
+):
+    _series_suffixes = ("_total", "_created")
+
+    def _metric_init(self):
+        self._value = ValueClass(
+            self._type,
             self._name,
             self._labelnames,
             self._labelvalues,
             help_text=self._documentation,
-            suffix="_created",
+            backend=self._target,
+            suffix="_total",
+            integer=self._integer,
+            series=self._redis_series,
+            rollups=self._rollup_fields(),
         )
+        self._redis_created = self._created_value()
+
+    def _zero_values(self) -> List[ValueClass]:
+        return [self._value]
 
     def inc(
         self, amount: float = 1, exemplar: Optional[Dict[str, str]] = None
     ) -> None:
-        if self._redis_created.setnx(time.time()):
-            self._value.set(0)
-        return super().inc(amount, exemplar)
+        scale = self._sampler.sample()
+        if not scale:
+            return None
+        self._ensure_created()
+        if self._series_limited():
+            self._refresh_expire()
+        return super().inc(amount * scale, exemplar)
 
     def reset(self) -> None:
         self._value.set(0)
-        self._redis_created.set(time.time())
+        if self._redis_created is not None:
+            self._redis_created.set(time.time())
         self._refresh_expire()
 
-    def _samples(self) -> Iterable[Sample]:
-        conn = get_redis_conn()
-        key = get_redis_key(self._name)
-        for field, value in sorted(
-            conn.hgetall(key).items()  # type: ignore[union-attr]
-        ):
-            field_str = field.decode("utf8")
-            suffix, labels_json = field_str.split(":", 1)
-            yield Sample(
-                suffix,
-                json.loads(labels_json),
-                float(value.decode("utf8")),
-            )
-
-    _child_samples = _samples
-    _multi_samples = _samples
-
 
 class Gauge(RedisMetricMixin, prometheus_client.Gauge):
+    _series_suffixes = ("",)
+    _expire_on_collect = True
+
     def _metric_init(self):
         self._value = ValueClass(
             self._type,
@@ -130,41 +772,60 @@ class Gauge(RedisMetricMixin, prometheus_client.Gauge):
             self._labelnames,
             self._labelvalues,
             help_text=self._documentation,
+            backend=self._target,
             suffix="",
+            series=self._redis_series,
+            multiprocess_mode=self._multiprocess_mode,
         )
 
     def set(self, value):
         self._refresh_expire()
         return super().set(value)
 
-    def _samples(self) -> Iterable[Sample]:
-        conn = get_redis_conn()
-        key = get_redis_key(self._name)
-        for field, value in sorted(
-            conn.hgetall(key).items()  # type: ignore[union-attr]
-        ):
-            field_str = field.decode("utf8")
-            suffix, labels_json = field_str.split(":", 1)
-            yield Sample(
-                suffix,
-                json.loads(labels_json),
-                float(value.decode("utf8")),
-            )
-        conn.expire(key, get_redis_expire())
+    def inc(self, amount: float = 1) -> None:
+        if self._series_limited():
+            self._refresh_expire()
+        return super().inc(amount)
 
-    _child_samples = _samples
-    _multi_samples = _samples
+    def dec(self, amount: float = 1) -> None:
+        if self._series_limited():
+            self._refresh_expire()
+        return super().dec(amount)
+
+    def _zero_values(self) -> List[ValueClass]:
+        # 0 would win every later min/max/mostrecent comparison
+        if self._multiprocess_mode.removeprefix("live") in GAUGE_SET_MODES:
+            return []
+        return [self._value]
+
+    def get(self) -> Optional[float]:
+        return self._value.get()
 
 
-class Summary(RedisMetricMixin, prometheus_client.Summary):
+class Summary(
+    RollupMixin,
+    SamplingMixin,
+    QuantileMixin,
+    RedisMetricMixin,
+    prometheus_client.Summary,
+):
+    _series_suffixes = ("_count", "_sum", "_created")
+    _created_anchor = "_count"
+    _expire_on_collect = True
+
     def _metric_init(self):
+        series, rollups = self._redis_series, self._rollup_fields()
         self._count = ValueClass(
             self._type,
             self._name,
             self._labelnames,
             self._labelvalues,
             help_text=self._documentation,
+            backend=self._target,
             suffix="_count",
+            integer=whole_counts(self),
+            series=series,
+            rollups=rollups,
         )
         self._sum = ValueClass(
             self._type,
@@ -172,52 +833,74 @@ class Summary(RedisMetricMixin, prometheus_client.Summary):
             self._labelnames,
             self._labelvalues,
             help_text=self._documentation,
+            backend=self._target,
             suffix="_sum",
+            series=series,
+            rollups=rollups,
         )
-        self._redis_created = ValueClass(
-            "gauge",
-            self._name,
-            self._labelnames,
-            self._labelvalues,
-            help_text=self._documentation,
-            suffix="_created",
-        )
+        self._redis_created = self._created_value()
+
+    def _zero_values(self) -> List[ValueClass]:
+        return [self._count, self._sum]
 
     def observe(self, amount: float) -> None:
-        self._redis_created.setnx(time.time())
+        self._raise_if_not_observable()
+        self._observe_quantile(amount)
+        scale = self._sampler.sample()
+        if not scale:
+            return
+        self._ensure_created()
         self._refresh_expire()
-        return super().observe(amount)
+        self._count.inc(scale)
+        self._sum.inc(amount * scale)
 
-    def _samples(self) -> Iterable[Sample]:
-        conn = get_redis_conn()
-        key = get_redis_key(self._name)
-        for field, value in sorted(
-            conn.hgetall(key).items()  # type: ignore[union-attr]
-        ):
-            field_str = field.decode("utf8")
-            suffix, labels_json = field_str.split(":", 1)
-            yield Sample(
-                suffix,
-                json.loads(labels_json),
-                float(value.decode("utf8")),
-            )
-        conn.expire(key, get_redis_expire())
+    def _merge_sketch(
+        self, targets: Sequence[Tuple[str, str]], encoded: str
+    ) -> bool:
+        backend = self._target
 
-    _child_samples = _samples
-    _multi_samples = _samples
+        def merge(conn) -> bool:
+            script = conn.register_script(MERGE_SKETCH_SCRIPT)
+            pipe = conn.pipeline()
+            for name, labels in targets:
+                script(
+                    keys=[backend.redis_sketches_key(name)],
+                    args=[
+                        labels,
+                        encoded,
+                        self._max_bins,
+                        backend.redis_expire,
+                    ],
+                    client=pipe,
+                )
+            pipe.execute()
+            return True
+
+        return _write(backend, merge, default=False)
+
+    def _stored_sketches(self) -> Iterable[Tuple[str, str]]:
+        key = self._target.redis_sketches_key(self._name)
+        sketches = self._target.redis_read(lambda conn: conn.hgetall(key))
+        return [
+            (labels.decode("utf8"), encoded.decode("utf8"))
+            for labels, encoded in sketches.items()  # type: ignore[union-attr]
+        ]
 
 
-class Histogram(RedisMetricMixin, prometheus_client.Histogram):
+class Histogram(
+    RollupMixin,
+    SamplingMixin,
+    BucketLayoutMixin,
+    RedisMetricMixin,
+    prometheus_client.Histogram,
+):
+    _series_suffixes = ("_count", "_sum", "_created")
+    _created_anchor = "_count"
+
     def _metric_init(self):
-        self._buckets = []
-        self._redis_created = ValueClass(
-            "gauge",
-            self._name,
-            self._labelnames,
-            self._labelvalues,
-            help_text=self._documentation,
-            suffix="_created",
-        )
+        self._redis_created = self._created_value()
+        # shared by the values of this child
+        series, rollups = self._redis_series, self._rollup_fields()
         bucket_labelnames = self._labelnames + ("le",)
         self._count = ValueClass(
             self._type,
@@ -225,7 +908,11 @@ class Histogram(RedisMetricMixin, prometheus_client.Histogram):
             self._labelnames,
             self._labelvalues,
             help_text=self._documentation,
+            backend=self._target,
             suffix="_count",
+            integer=whole_counts(self),
+            series=series,
+            rollups=rollups,
         )
         self._sum = ValueClass(
             self._type,
@@ -233,19 +920,43 @@ class Histogram(RedisMetricMixin, prometheus_client.Histogram):
             self._labelnames,
             self._labelvalues,
             help_text=self._documentation,
+            backend=self._target,
             suffix="_sum",
+            series=series,
+            rollups=rollups,
         )
-        for b in self._upper_bounds:
-            self._buckets.append(
-                ValueClass(
-                    self._type,
-                    self._name,
-                    bucket_labelnames,
-                    self._labelvalues + (floatToGoString(b),),
-                    help_text=self._documentation,
-                    suffix="_bucket",
-                )
+        self._buckets = tuple(
+            ValueClass(
+                self._type,
+                self._name,
+                bucket_labelnames,
+                self._labelvalues,
+                help_text=self._documentation,
+                backend=self._target,
+                suffix="_bucket",
+                integer=whole_counts(self),
+                le=le,
+                series=series,
+                rollups=self._rollup_fields({"le": le}),
             )
+            for le in self._bucket_layout.les
+        )
+
+    def _zero_values(self) -> List[ValueClass]:
+        return [self._count, self._sum, *self._buckets]
+
+    def _series_subkeys(self, labels: Dict[str, str]) -> List[str]:
+        subkeys = super()._series_subkeys(labels)
+        bucket_labelnames = self._labelnames + ("le",)
+        values = [labels[name] for name in self._labelnames]
+        for le in self._bucket_layout.les:
+            for encoding in FIELD_ENCODINGS:
+                subkeys.append(
+                    encode_field(
+                        "_bucket", bucket_labelnames, values + [le], encoding
+                    )
+                )
+        return subkeys
 
     def reset(self):
         self._sum.set(0)
@@ -257,27 +968,148 @@ class Histogram(RedisMetricMixin, prometheus_client.Histogram):
         self, amount: float, exemplar: Optional[Dict[str, str]] = None
     ) -> None:
         """Observe the given amount."""
-        if self._redis_created.setnx(time.time()):
-            self.reset()
-        self._sum.inc(amount)
+        scale = self._sampler.sample()
+        if not scale:
+            return
+        self._ensure_created()
+        self._sum.inc(amount * scale)
         for i, bound in enumerate(self._upper_bounds):
-            self._buckets[i].inc(1 if amount <= bound else 0)
-        self._count.inc(1)
+            self._buckets[i].inc(scale if amount <= bound else 0)
+        self._count.inc(scale)
         self._refresh_expire()
 
-    def _samples(self) -> Iterable[Sample]:
-        conn = get_redis_conn()
-        key = get_redis_key(self._name)
-        for field, value in sorted(
-            conn.hgetall(key).items()  # type: ignore[union-attr]
-        ):
-            field_str = field.decode("utf8")
-            suffix, labels_json = field_str.split(":", 1)
-            yield Sample(
-                suffix,
-                json.loads(labels_json),
-                float(value.decode("utf8")),
-            )
 
-    _child_samples = _samples
-    _multi_samples = _samples
+class ExponentialHistogram(
+    RollupMixin,
+    SamplingMixin,
+    ExponentialMixin,
+    RedisMetricMixin,
+    prometheus_client.Histogram,
+):
+    """Histogram with sparse exponential buckets, see exponential.py."""
+
+    _series_suffixes = ("_count", "_sum", "_created")
+    _created_anchor = "_count"
+
+    def _metric_init(self):
+        self._redis_created = self._created_value()
+        series, rollups = self._redis_series, self._rollup_fields()
+        self._count = ValueClass(
+            self._type,
+            self._name,
+            self._labelnames,
+            self._labelvalues,
+            help_text=self._documentation,
+            backend=self._target,
+            suffix="_count",
+            integer=whole_counts(self),
+            series=series,
+            rollups=rollups,
+        )
+        self._sum = ValueClass(
+            self._type,
+            self._name,
+            self._labelnames,
+            self._labelvalues,
+            help_text=self._documentation,
+            backend=self._target,
+            suffix="_sum",
+            series=series,
+            rollups=rollups,
+        )
+
+    def _new_bucket_value(self, key: str) -> ValueClass:
+        return ValueClass(
+            self._type,
+            self._name,
+            self._labelnames + (BUCKET_LABEL,),
+            self._labelvalues,
+            help_text=self._documentation,
+            backend=self._target,
+            suffix="_ebucket",
+            integer=whole_counts(self),
+            le=key,
+            series=self._redis_series,
+            rollups=self._rollup_fields({BUCKET_LABEL: key}),
+        )
+
+    def _zero_values(self) -> List[ValueClass]:
+        return [self._count, self._sum]
+
+    def _series_subkeys(self, labels: Dict[str, str]) -> List[str]:
+        """Also the buckets of the label set, found among the stored
+        fields as only the written ones exist."""
+        subkeys = super()._series_subkeys(labels)
+        conn = self._target.redis
+        key = self._target.redis_key(self._name)
+        for pattern in field_patterns(self._labelnames, labels):
+            for bfield, _ in conn.hscan_iter(key, match=pattern):
+                field = bfield.decode("utf8")
+                suffix, field_labels = decode_field(field, self._labelnames)
+                if suffix != "_ebucket" or field in subkeys:
+                    continue
+                field_labels.pop(BUCKET_LABEL)
+                if field_labels == labels:
+                    subkeys.append(field)
+        return subkeys
+
+    def observe(
+        self, amount: float, exemplar: Optional[Dict[str, str]] = None
+    ) -> None:
+        """Observe the given amount."""
+        scale = self._sampler.sample()
+        if not scale:
+            return
+        self._ensure_created()
+        self._sum.inc(amount * scale)
+        self._observe_bucket(amount, scale)
+        self._count.inc(scale)
+        self._refresh_expire()
+
+
+def stored_metadata(backend: Backend = DEFAULT_BACKEND) -> Dict[str, str]:
+    """Metadata of the families declared under the prefix of backend which
+    still hold values, by family name."""
+
+    def read(conn) -> Dict[str, str]:
+        metadata = {
+            name.decode("utf8"): value.decode("utf8")
+            for name, value in conn.hgetall(
+                backend.redis_metadata_key()
+            ).items()
+        }
+        names = sorted(metadata)
+        pipe = conn.pipeline(transaction=False)
+        for name in names:
+            pipe.exists(backend.redis_key(name))
+        return {
+            name: metadata[name]
+            for name, exists in zip(names, pipe.execute())
+            if exists
+        }
+
+    return backend.redis_read(read)
+
+
+# counters of the foldings because of max_series, by backend
+_OVERFLOW_COUNTERS: "weakref.WeakKeyDictionary" = weakref.WeakKeyDictionary()
+
+
+def _overflow_counter(backend: Backend = DEFAULT_BACKEND) -> Counter:
+    """Counts the foldings of the metrics stored in backend, in backend."""
+    counter = _OVERFLOW_COUNTERS.get(backend)
+    if counter is None:
+        counter = Counter(
+            "prometheus_distributed_series_overflow",
+            "Label sets folded into the overflow series because of "
+            "max_series",
+            ["metric"],
+            registry=None,
+            backend=backend,
+        )
+        counter._series_exempt = True
+        _OVERFLOW_COUNTERS[backend] = counter
+    return counter
+
+
+SERIES_OVERFLOW = _overflow_counter()
@@ -0,0 +1,186 @@
+"""Pushes the stored families to a Prometheus remote-write endpoint.
+
+Values in the backend are already aggregated across processes, so a single
+pusher replaces the pushes of every process. Each push reads the families
+one at a time, encodes their samples as remote-write ``TimeSeries``, cuts
+them into requests of at most ``max_request_bytes`` (before compression)
+and hands each request, snappy compressed, to a pool of concurrent senders
+which retry with exponential backoff.
+"""
+
+import logging
+import struct
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+from urllib.error import HTTPError, URLError
+from urllib.request import Request, urlopen
+
+from .compression import encode_varint, snappy_compress
+from .exporter import Exporter
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_REQUEST_BYTES = 1 << 20
+REMOTE_WRITE_HEADERS = {
+    "Content-Encoding": "snappy",
+    "Content-Type": "application/x-protobuf",
+    "User-Agent": "prometheus-distributed-client",
+    "X-Prometheus-Remote-Write-Version": "0.1.0",
+}
+
+
+def _length_delimited(number: int, payload: bytes) -> bytes:
+    return (
+        encode_varint(number << 3 | 2) + encode_varint(len(payload)) + payload
+    )
+
+
+def encode_timeseries(
+    labels: Sequence[Tuple[str, str]], value: float, timestamp_ms: int
+) -> bytes:
+    """Encodes a single sample as a ``WriteRequest.timeseries`` field."""
+    body = b"".join(
+        _length_delimited(
+            1,
+            _length_delimited(1, name.encode("utf8"))
+            + _length_delimited(2, label_value.encode("utf8")),
+        )
+        for name, label_value in labels
+    )
+    # Sample: double value = 1 (64 bits), int64 timestamp = 2 (varint)
+    sample = b"\x09" + struct.pack("<d", value) + b"\x10"
+    sample += encode_varint(timestamp_ms)
+    return _length_delimited(1, body + _length_delimited(2, sample))
+
+
+def iter_timeseries(
+    registry, timestamp_ms: int, labels: Optional[Dict[str, str]] = None
+) -> Iterator[bytes]:
+    """Encoded samples of registry, read one family at a time."""
+    for family in registry.collect():
+        for sample in family.samples:
+            series_labels = {**(labels or {}), **sample.labels}
+            series_labels["__name__"] = sample.name
+            yield encode_timeseries(
+                sorted(series_labels.items()), sample.value, timestamp_ms
+            )
+
+
+def iter_requests(
+    timeseries: Iterable[bytes], max_request_bytes: int
+) -> Iterator[Tuple[bytes, int]]:
+    """Groups encoded samples into WriteRequest bodies, with their count."""
+    chunk: List[bytes] = []
+    size = 0
+    for series in timeseries:
+        if chunk and size + len(series) > max_request_bytes:
+            yield b"".join(chunk), len(chunk)
+            chunk, size = [], 0
+        chunk.append(series)
+        size += len(series)
+    if chunk:
+        yield b"".join(chunk), len(chunk)
+
+
+class RemoteWritePusher(threading.Thread):
+    """Pushes a registry every interval seconds until stopped.
+
+    Without registry, pushes every family stored in the backend set up with
+    setup(), as the exporter serves them. A request refused with a 4xx
+    status other than 429 is dropped, others are retried up to max_retries
+    times, waiting from min_backoff to max_backoff seconds in between.
+    """
+
+    def __init__(
+        self,
+        url: str,
+        registry=None,
+        interval: float = 15.0,
+        senders: int = 4,
+        max_request_bytes: int = DEFAULT_MAX_REQUEST_BYTES,
+        max_retries: int = 5,
+        min_backoff: float = 0.5,
+        max_backoff: float = 30.0,
+        timeout: float = 10.0,
+        labels: Optional[Dict[str, str]] = None,
+        headers: Optional[Dict[str, str]] = None,
+    ):
+        super().__init__(name="prometheus-distributed-remote-write")
+        self.daemon = True
+        self.url = url
+        self.registry = registry
+        self.interval = interval
+        self.senders = senders
+        self.max_request_bytes = max_request_bytes
+        self.max_retries = max_retries
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+        self.labels = labels or {}
+        self.headers = {**REMOTE_WRITE_HEADERS, **(headers or {})}
+        self._exporter: Optional[Exporter] = None
+        self._stopped = threading.Event()
+
+    def _registry(self):
+        if self.registry is not None:
+            return self.registry
+        if self._exporter is None:
+            self._exporter = Exporter()
+        return self._exporter.registry()
+
+    def _send(self, body: bytes) -> bool:
+        data = snappy_compress(body)
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                backoff = self.min_backoff * 2 ** (attempt - 1)
+                if self._stopped.wait(min(backoff, self.max_backoff)):
+                    break
+            request = Request(
+                self.url, data=data, headers=self.headers, method="POST"
+            )
+            try:
+                with urlopen(request, timeout=self.timeout):
+                    return True
+            except HTTPError as error:
+                if 400 <= error.code < 500 and error.code != 429:
+                    logger.error("remote write refused: %s", error)
+                    return False
+                logger.warning("remote write failed: %s", error)
+            except (URLError, OSError) as error:
+                logger.warning("remote write failed: %s", error)
+        logger.error("remote write dropped %d bytes", len(body))
+        return False
+
+    def push(self) -> int:
+        """Pushes the registry once, returns the number of samples sent."""
+        timestamp_ms = int(time.time() * 1000)
+        timeseries = iter_timeseries(
+            self._registry(), timestamp_ms, self.labels
+        )
+        # bounds what is read ahead of the senders
+        in_flight = threading.BoundedSemaphore(2 * self.senders)
+        futures = []
+        with ThreadPoolExecutor(self.senders) as pool:
+            for body, count in iter_requests(
+                timeseries, self.max_request_bytes
+            ):
+                in_flight.acquire()
+                future = pool.submit(self._send, body)
+                future.add_done_callback(lambda _: in_flight.release())
+                futures.append((future, count))
+        return sum(count for future, count in futures if future.result())
+
+    def run(self) -> None:
+        while not self._stopped.is_set():
+            started = time.monotonic()
+            try:
+                self.push()
+            except Exception:
+                logger.exception("could not push metrics")
+            elapsed = time.monotonic() - started
+            self._stopped.wait(max(0.0, self.interval - elapsed))
+
+    def stop(self) -> None:
+        self._stopped.set()
@@ -0,0 +1,102 @@
+"""Scrapes served by a Redis replica.
+
+With ``setup(redis=primary, redis_read=replica)``, collection (reading
+the families, their sketches and the stored metadata) goes to the replica
+while writes, and the pruning of stale series, stay on the primary. The
+replica may be any client, for instance ``sentinel.slave_for(...)``.
+
+Every ``REPLICA_CHECK_INTERVAL`` seconds, ``INFO replication`` tells whether
+the replica is in sync: reads fall back to the primary while its link to
+the primary is down, it is resyncing, it last heard from the primary more
+than ``redis_read_max_lag`` seconds ago or, if set, it is more than
+``redis_read_max_lag_bytes`` behind the replication offset of the primary.
+They also fall back when the replica is unreachable.
+"""
+
+import logging
+import math
+import threading
+import time
+from typing import Optional
+
+from redis import Redis
+from redis.exceptions import RedisError
+
+logger = logging.getLogger(__name__)
+
+# seconds between two checks of the replication lag
+REPLICA_CHECK_INTERVAL = 1.0
+
+
+class ReplicaReader:
+    """Picks the connection collection reads from, see the module
+    docstring."""
+
+    def __init__(
+        self,
+        replica: Redis,
+        primary: Redis,
+        max_lag: float = 10.0,
+        max_lag_bytes: Optional[int] = None,
+        check_interval: float = REPLICA_CHECK_INTERVAL,
+    ):
+        self.replica = replica
+        self.primary = primary
+        self.max_lag = max_lag
+        self.max_lag_bytes = max_lag_bytes
+        self.check_interval = check_interval
+        self._in_sync = False
+        self._next_check = -math.inf
+        self._lock = threading.Lock()
+
+    def _check(self) -> bool:
+        info = self.replica.info("replication")
+        if info.get("role") == "master":  # a primary used for reads
+            return True
+        if info.get("master_link_status") != "up" or info.get(
+            "master_sync_in_progress"
+        ):
+            return False
+        if float(info.get("master_last_io_seconds_ago", -1)) > self.max_lag:
+            return False
+        if self.max_lag_bytes is None:
+            return True
+        primary_offset = self.primary.info("replication").get(
+            "master_repl_offset", 0
+        )
+        behind = primary_offset - info.get("slave_repl_offset", 0)
+        return behind <= self.max_lag_bytes
+
+    def in_sync(self) -> bool:
+        """Whether reads go to the replica, checked at most once per
+        check_interval."""
+        now = time.monotonic()
+        if now < self._next_check:
+            return self._in_sync
+        with self._lock:
+            if now >= self._next_check:
+                try:
+                    in_sync = self._check()
+                except RedisError:
+                    in_sync = False
+                if in_sync != self._in_sync:
+                    logger.info(
+                        "reading from the %s",
+                        "replica" if in_sync else "primary",
+                    )
+                self._in_sync = in_sync
+                self._next_check = now + self.check_interval
+        return self._in_sync
+
+    def call(self, func):
+        """Returns func(conn), on the primary if the replica is lagging or
+        fails."""
+        if self.in_sync():
+            try:
+                return func(self.replica)
+            except RedisError:
+                logger.warning("replica read failed", exc_info=True)
+                with self._lock:
+                    self._in_sync = False
+                    self._next_check = time.monotonic() + self.check_interval
+        return func(self.primary)
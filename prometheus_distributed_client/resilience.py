@@ -0,0 +1,372 @@
+"""Keeps Redis outages out of the instrumented code path.
+
+Writes go through a ``WriteGuard``: a dedicated client with tight socket
+timeouts and no retries, behind a per-process circuit breaker. When a write
+fails, or while the breaker is open, its deltas are aggregated in a bounded
+local ``Spool`` (optionally mirrored to an append-only file, reloaded on
+start). A background thread replays the spool in batches, one transaction
+each, once Redis answers again. Until the spool is drained, new writes are
+spooled too so that replayed values never overwrite newer ones.
+
+Delivery is at least once: a write timing out after Redis applied it is
+spooled all the same, and replayed. The spool file is compacted after
+each replayed batch, a process crashing mid-replay only sends again the
+batch in flight. Increments may then be counted twice, around outages.
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from redis import Redis
+from redis.backoff import NoBackoff
+from redis.exceptions import ConnectionError as RedisConnectionError
+from redis.exceptions import RedisError
+from redis.exceptions import TimeoutError as RedisTimeoutError
+from redis.retry import Retry
+
+from .integers import execute_increments
+
+logger = logging.getLogger(__name__)
+
+FAILURE_THRESHOLD = 3
+RESET_TIMEOUT = 5.0
+REPLAY_BATCH_SIZE = 1000
+# errors meaning Redis is unreachable, others are raised as before
+OUTAGE_ERRORS = (RedisConnectionError, RedisTimeoutError, OSError)
+
+# operation, keys, field
+SpoolKey = Tuple[str, Tuple[str, ...], str]
+# one write: operation, keys, field, value. Operations: inc, set, setnx,
+# the gauge modes (mostrecent values are [value, timestamp]), touch (zadd)
+# and metadata (set, without expiry)
+Op = Tuple[str, Tuple[str, ...], str, Any]
+
+
+def _aggregate(op: str, older: Any, newer: Any) -> Any:
+    if op in ("inc", "generation"):
+        return older + newer
+    if op == "setnx":
+        return older
+    if op in ("max", "touch"):
+        return max(older, newer)
+    if op == "min":
+        return min(older, newer)
+    if op == "mostrecent":  # value and timestamp
+        return max(older, newer, key=lambda value: value[1])
+    return newer  # set, last write wins
+
+
+class CircuitBreaker:
+    """Opens after failure_threshold consecutive failures. Once open, a
+    single trial is let through every reset_timeout seconds."""
+
+    def __init__(
+        self,
+        failure_threshold: int = FAILURE_THRESHOLD,
+        reset_timeout: float = RESET_TIMEOUT,
+    ):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._failures = 0
+        self._opened_at: Optional[float] = None
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self) -> bool:
+        return self._opened_at is not None
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if time.monotonic() - self._opened_at < self.reset_timeout:
+                return False
+            # half open: the next trial decides, others wait for it
+            self._opened_at = time.monotonic()
+            return True
+
+    def record_success(self) -> None:
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self._failures += 1
+            if self._failures >= self.failure_threshold:
+                if self._opened_at is None:
+                    logger.warning("Redis unreachable, spooling writes")
+                self._opened_at = time.monotonic()
+
+
+class Spool:
+    """Bounded aggregation of the writes Redis did not get yet.
+
+    Writes to a field already spooled are aggregated, only new fields
+    beyond max_entries are dropped (and counted). With a path, each write
+    is also appended to that file, compacted as it grows.
+    """
+
+    def __init__(self, max_entries: int, path: Optional[str] = None):
+        self.max_entries = max_entries
+        self.path = path
+        self.dropped = 0
+        self._entries: Dict[SpoolKey, Any] = {}
+        self._file_lines = 0
+        self._lock = threading.Lock()
+        if path is not None and os.path.exists(path):
+            with open(path, encoding="utf8") as fd:
+                self._add(self._load(fd))
+            self._compact()
+
+    @staticmethod
+    def _load(lines: Iterable[str]) -> List[Op]:
+        ops = []
+        for line in lines:
+            try:
+                op, keys, field, value = json.loads(line)
+            except ValueError:  # torn last line of a crashed process
+                continue
+            ops.append((op, tuple(keys), field, value))
+        return ops
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _add(self, ops: Iterable[Op], older: bool = False) -> None:
+        for op, keys, field, value in ops:
+            spool_key = (op, keys, field)
+            if spool_key in self._entries:
+                spooled = self._entries[spool_key]
+                self._entries[spool_key] = (
+                    _aggregate(op, value, spooled)
+                    if older
+                    else _aggregate(op, spooled, value)
+                )
+            elif len(self._entries) < self.max_entries:
+                self._entries[spool_key] = value
+            else:
+                self.dropped += 1
+
+    def add(self, ops: List[Op]) -> None:
+        with self._lock:
+            self._add(ops)
+            if self.path is None:
+                return
+            with open(self.path, "a", encoding="utf8") as fd:
+                for op in ops:
+                    fd.write(json.dumps(op) + "\n")
+            self._file_lines += len(ops)
+            if self._file_lines > 2 * self.max_entries:
+                self._compact()
+
+    def _compact(self) -> None:
+        if self.path is None:
+            return
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w", encoding="utf8") as fd:
+            for (op, keys, field), value in self._entries.items():
+                fd.write(json.dumps((op, keys, field, value)) + "\n")
+        os.replace(tmp_path, self.path)
+        self._file_lines = len(self._entries)
+
+    def take(self, count: int) -> List[Op]:
+        """Removes and returns up to count aggregated writes."""
+        with self._lock:
+            taken = []
+            for spool_key in list(self._entries)[:count]:
+                op, keys, field = spool_key
+                taken.append((op, keys, field, self._entries.pop(spool_key)))
+            return taken
+
+    def restore(self, ops: List[Op]) -> None:
+        """Puts back taken writes which did not reach Redis, they are older
+        than any write spooled since. The file still holds them."""
+        with self._lock:
+            self._add(ops, older=True)
+
+    def done(self) -> None:
+        """To call once taken writes reached Redis, syncs the file."""
+        with self._lock:
+            self._compact()
+
+
+def queue_ops(
+    client: Redis, pipe, ops: Iterable[Op], expire: Optional[int]
+) -> None:
+    """Queues ops on pipe, then the expiry of the keys they write and the
+    generations they bump."""
+    # imported here as the redis backend module depends on config
+    from .redis import SET_GAUGE_SCRIPT
+
+    keys, generations = set(), []
+    for op, op_keys, field, value in ops:
+        if op == "generation":  # after the writes, see generations.py
+            generations.append((op_keys[0], field, value))
+            continue
+        if op == "inc" and isinstance(value, int):  # see integers.py
+            pipe.hincrby(op_keys[0], field, value)
+        elif op == "inc":
+            pipe.hincrbyfloat(op_keys[0], field, value)
+        elif op == "setnx":
+            pipe.hsetnx(op_keys[0], field, value)
+        elif op == "touch":
+            pipe.zadd(op_keys[0], {field: value})
+        elif op in ("max", "min", "mostrecent"):
+            value, timestamp = value if op == "mostrecent" else (value, 0)
+            ttl = "" if expire is None else expire  # no TTL
+            client.register_script(SET_GAUGE_SCRIPT)(
+                keys=list(op_keys),
+                args=[field, value, op, timestamp, ttl],
+                client=pipe,
+            )
+        else:
+            pipe.hset(op_keys[0], field, value)
+        if op != "metadata":  # family metadata never expires
+            keys.add(op_keys[0])
+    if expire is not None:
+        for key in keys:
+            pipe.expire(key, expire)
+    for key, field, value in generations:
+        pipe.hincrby(key, field, value)
+
+
+def write_client(redis: Redis, timeout: float) -> Redis:
+    """A client sharing redis' settings, with timeout and no retries."""
+    pool = redis.connection_pool
+    kwargs = {
+        name: value
+        for name, value in pool.connection_kwargs.items()
+        # set by redis-py from the other settings, or bound to the pool
+        if not name.startswith(("orig_", "maint_notifications_pool"))
+    }
+    kwargs.update(
+        socket_timeout=timeout,
+        socket_connect_timeout=timeout,
+        retry=Retry(NoBackoff(), 0),
+    )
+    return Redis(
+        connection_pool=pool.__class__(
+            connection_class=pool.connection_class, **kwargs
+        )
+    )
+
+
+class WriteGuard:
+    def __init__(
+        self,
+        redis: Redis,
+        timeout: float,
+        spool_size: int,
+        spool_path: Optional[str] = None,
+        expire: Optional[int] = None,
+    ):
+        self.client = write_client(redis, timeout)
+        self.breaker = CircuitBreaker()
+        self.spool = Spool(spool_size, spool_path)
+        self.expire = expire
+        # commands of spooled writes Redis answered with an error, dropped
+        self.rejected = 0
+        self._replayer: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+        if len(self.spool):
+            self._start_replay()
+
+    def available(self) -> bool:
+        """Whether a call to Redis may be attempted right now."""
+        return not len(self.spool) and self.breaker.allow()
+
+    def call(self, func, default=None):
+        """Returns func(client) or default if Redis is unreachable."""
+        if not self.available():
+            return default
+        try:
+            result = func(self.client)
+        except OUTAGE_ERRORS:
+            self.breaker.record_failure()
+            return default
+        self.breaker.record_success()
+        return result
+
+    def execute(self, pipe, ops: List[Op]) -> None:
+        """Runs pipe, or spools ops if Redis is or just went unreachable."""
+        if self.available():
+            try:
+                execute_increments(pipe)
+            except OUTAGE_ERRORS:
+                self.breaker.record_failure()
+            else:
+                self.breaker.record_success()
+                return
+        self.spool.add(ops)
+        self._start_replay()
+
+    def _start_replay(self) -> None:
+        with self._lock:
+            if self._replayer is None:
+                self._replayer = threading.Thread(
+                    target=self.replay,
+                    name="prometheus-distributed-replay",
+                    daemon=True,
+                )
+                self._replayer.start()
+
+    def _replay_batch(self, ops: List[Op]) -> List[RedisError]:
+        """Sends ops, returns the errors of the commands Redis rejected,
+        the others being applied."""
+        pipe = self.client.pipeline()
+        queue_ops(self.client, pipe, ops, self.expire)
+        commands = len(pipe.command_stack)
+        try:
+            results = execute_increments(pipe, raise_on_error=False)
+        except OUTAGE_ERRORS:
+            raise
+        except RedisError as error:
+            # the transaction was aborted, none of its commands applied
+            return [error] * commands
+        return [result for result in results if isinstance(result, RedisError)]
+
+    def replay(self) -> None:
+        """Sends the spool to Redis in batches, until drained."""
+        try:
+            self._replay()
+        finally:
+            with self._lock:
+                # a replay stopped by an error lets the next write retry
+                if self._replayer is threading.current_thread():
+                    self._replayer = None
+
+    def _replay(self) -> None:
+        while True:
+            while len(self.spool):
+                if not self.breaker.allow():
+                    time.sleep(min(1.0, self.breaker.reset_timeout))
+                    continue
+                ops = self.spool.take(REPLAY_BATCH_SIZE)
+                try:
+                    errors = self._replay_batch(ops)
+                except OUTAGE_ERRORS:
+                    self.breaker.record_failure()
+                    self.spool.restore(ops)
+                    continue
+                if errors:
+                    # Redis answered, they would be rejected again
+                    self.rejected += len(errors)
+                    logger.error(
+                        "Redis rejected %d spooled commands, dropped: %s",
+                        len(errors),
+                        errors[0],
+                    )
+                # a crash from now on does not send the batch again
+                self.spool.done()
+                self.breaker.record_success()
+            with self._lock:
+                # writes spooled from now on start another replay
+                if not len(self.spool):
+                    self._replayer = None
+                    break
+        logger.info("spooled writes replayed to Redis")
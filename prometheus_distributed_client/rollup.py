@@ -0,0 +1,79 @@
+from types import MappingProxyType
+from typing import Dict, Iterable, Mapping, Optional, Sequence, Tuple
+
+from prometheus_client.registry import REGISTRY
+
+from .attributes import MetricAttributes
+
+RollupField = Tuple[str, Tuple[str, ...], Tuple[str, ...]]
+
+# default for rollup_registry: register rollups next to the raw metric
+_SAME_REGISTRY = object()
+
+
+def rollup_name(name: str, labelnames: Sequence[str]) -> str:
+    """Names a rollup after the recording rules convention level:metric."""
+    return f"{'_'.join(labelnames) or 'all'}:{name}"
+
+
+class RollupMixin(MetricAttributes):
+    """Maintains pre-aggregated views of a metric over subsets of its labels.
+
+    Each rollup is summed at write time: every increment of a labelled child
+    is mirrored onto the matching field of the rollup family, within the same
+    atomic update. Rollup families are regular metrics of the same type named
+    ``<labels>:<name>`` (for instance ``endpoint:http_requests``), registered
+    in ``rollup_registry`` (the metric's registry by default). Registering
+    the raw metric elsewhere (or nowhere) only exposes the reduced series.
+    """
+
+    # rollup families by label names, only set on parents
+    rollups: Mapping[Tuple[str, ...], "RollupMixin"] = MappingProxyType({})
+
+    def __init__(
+        self,
+        *args,
+        rollups: Iterable[Sequence[str]] = (),
+        rollup_registry=_SAME_REGISTRY,
+        **kwargs,
+    ):
+        self._rollups = tuple(tuple(names) for names in rollups)
+        super().__init__(*args, **kwargs)
+        if self._rollups and not self._labelvalues:
+            if rollup_registry is _SAME_REGISTRY:
+                rollup_registry = kwargs.get("registry", REGISTRY)
+            self._declare_rollups(rollup_registry)
+        self._kwargs["rollups"] = self._rollups
+
+    def _declare_rollups(self, registry) -> None:
+        rollups = {}
+        for names in self._rollups:
+            unknown = set(names) - set(self._labelnames)
+            if unknown:
+                raise ValueError(
+                    f"Cannot rollup {self._name} by unknown labels "
+                    f"{sorted(unknown)}"
+                )
+            rollups[names] = self.__class__(
+                rollup_name(self._name, names),
+                f"{self._documentation} (sum by {', '.join(names)})",
+                names,
+                registry=registry,
+                **self._kwargs,
+            )
+        self.rollups = rollups
+
+    def _rollup_fields(
+        self, extra: Optional[Dict[str, str]] = None
+    ) -> Tuple[RollupField, ...]:
+        """Target fields mirroring a value of this child in each rollup."""
+        labels = dict(zip(self._labelnames, self._labelvalues))
+        extra = extra or {}
+        return tuple(
+            (
+                rollup_name(self._name, names),
+                names + tuple(extra),
+                tuple(labels[name] for name in names) + tuple(extra.values()),
+            )
+            for names in self._rollups
+        )
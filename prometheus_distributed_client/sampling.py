@@ -0,0 +1,112 @@
+"""Probabilistic sampling of extreme-rate observations.
+
+With ``sample_rate=r``, ``Counter.inc`` and ``Histogram.observe`` /
+``Summary.observe`` only write an event with probability ``r``, scaling
+what they write (increment, count, sum and buckets) by ``1 / r``: stored
+values stay unbiased estimates, their relative error growing like
+``1 / sqrt(r * events)``. With ``max_write_rate``, the rate is lowered
+(never above ``sample_rate``) to keep the events written per second and
+per family under that bound, and raised again as the traffic drops.
+The rate in effect is ``metric.sample_rate``.
+"""
+
+import random
+import threading
+import time
+from typing import Optional, Union
+
+from .attributes import MetricAttributes
+
+# seconds over which the event rate is measured for adaptive sampling
+ADAPT_WINDOW = 1.0
+
+_LOCAL = threading.local()
+
+
+def _random() -> float:
+    """Thread-local PRNG, sparing the lock of the shared one."""
+    try:
+        return _LOCAL.random()
+    except AttributeError:
+        _LOCAL.random = random.Random().random
+        return _LOCAL.random()
+
+
+class Sampler:
+    """Decides which events of a family are written, shared by the parent
+    and its children."""
+
+    __slots__ = (
+        "base_rate",
+        "max_write_rate",
+        "rate",
+        "_events",
+        "_window_start",
+        "_lock",
+    )
+
+    def __init__(
+        self, rate: float = 1.0, max_write_rate: Optional[float] = None
+    ):
+        if not 0 < rate <= 1:
+            raise ValueError("sample_rate must be in (0, 1]")
+        if max_write_rate is not None and max_write_rate <= 0:
+            raise ValueError("max_write_rate must be positive")
+        self.base_rate = rate
+        self.max_write_rate = max_write_rate
+        self.rate = rate
+        self._events = 0
+        self._window_start = time.monotonic()
+        self._lock = threading.Lock()
+
+    def sample(self) -> float:
+        """0 to skip the event, else the factor scaling what it writes."""
+        if self.max_write_rate is not None:
+            self._adapt()
+        rate = self.rate
+        if rate >= 1:
+            return 1
+        if _random() >= rate:
+            return 0
+        return 1 / rate
+
+    def _adapt(self) -> None:
+        # unlocked: a few events lost by concurrent updates do not matter
+        self._events += 1
+        now = time.monotonic()
+        if now - self._window_start < ADAPT_WINDOW:
+            return
+        with self._lock:
+            elapsed = now - self._window_start
+            if elapsed < ADAPT_WINDOW:  # adapted by another thread
+                return
+            events_rate = self._events / elapsed
+            self.rate = min(
+                self.base_rate,
+                self.max_write_rate / events_rate,  # type: ignore[operator]
+            )
+            self._events = 0
+            self._window_start = now
+
+
+class SamplingMixin(MetricAttributes):
+    """Adds the sample_rate and max_write_rate arguments, see Sampler."""
+
+    def __init__(
+        self,
+        *args,
+        sample_rate: Union[float, Sampler] = 1.0,
+        max_write_rate: Optional[float] = None,
+        **kwargs,
+    ):
+        if isinstance(sample_rate, Sampler):  # children get their parent's
+            self._sampler = sample_rate
+        else:
+            self._sampler = Sampler(sample_rate, max_write_rate)
+        super().__init__(*args, **kwargs)
+        self._kwargs["sample_rate"] = self._sampler
+
+    @property
+    def sample_rate(self) -> float:
+        """Probability for an event to be written, as currently in effect."""
+        return self._sampler.rate
@@ -0,0 +1,99 @@
+"""Scrapes restricted to some families and label sets.
+
+A ``Selection`` holds the requested names, family names or sample names as
+the ``name[]`` parameter of prometheus_client's exposition, and label
+equality matchers. The exposition only reads the selected families, and
+pushes the matchers down to the backend: Redis scans the family hash for
+the fields matching them (``HSCAN MATCH``), SQLite adds a condition on the
+labels of the family's rows, looked up by their indexed ``metric_key``.
+Both verify the labels of what they return, the field patterns being
+wider than the matchers. Families not rendered from their fields
+(summaries with quantiles, exponential histograms) are read whole and
+filtered after collection.
+"""
+
+import json
+import re
+from typing import Dict, Iterable, List, Mapping, Optional, Sequence
+
+from .fields import EXTRA_LABELNAMES, _escape
+
+# positions of extra labels in compact fields, after the metric ones
+_EXTRA_NAMES = tuple(
+    name for names in EXTRA_LABELNAMES.values() for name in names
+)
+
+
+class Selection:
+    """Families and label sets a scrape is restricted to."""
+
+    __slots__ = ("names", "matchers")
+
+    def __init__(
+        self,
+        names: Optional[Iterable[str]] = None,
+        matchers: Optional[Mapping[str, str]] = None,
+    ):
+        self.names = None if names is None else frozenset(names)
+        self.matchers: Dict[str, str] = dict(matchers or {})
+
+    def selects_family(self, names: Iterable[str]) -> bool:
+        """Whether a collector registered under names is read at all."""
+        return self.names is None or not self.names.isdisjoint(names)
+
+    def keeps_sample(self, family: str, sample_name: str) -> bool:
+        return (
+            self.names is None
+            or family in self.names
+            or sample_name in self.names
+        )
+
+    def matches(self, labels: Mapping[str, str]) -> bool:
+        return all(
+            labels.get(name) == value for name, value in self.matchers.items()
+        )
+
+
+def parse_matchers(matchers: Iterable[str]) -> Dict[str, str]:
+    """Label matchers from ``name=value`` strings, quotes being optional."""
+    parsed = {}
+    for matcher in matchers:
+        name, sep, value = matcher.partition("=")
+        name = name.strip()
+        if not sep or not name:
+            raise ValueError(f"invalid label matcher {matcher!r}")
+        value = value.strip()
+        if len(value) >= 2 and value[0] == value[-1] == '"':
+            value = json.loads(value)
+        parsed[name] = value
+    return parsed
+
+
+def matchable(labelnames: Sequence[str], matchers: Mapping[str, str]) -> bool:
+    """Whether fields of a family with labelnames can match at all."""
+    return set(matchers) <= set(labelnames) | set(_EXTRA_NAMES)
+
+
+def _glob_escape(value: str) -> str:
+    return re.sub(r"([*?\[\]\\])", r"\\\1", value)
+
+
+def field_patterns(
+    labelnames: Sequence[str], matchers: Mapping[str, str]
+) -> List[str]:
+    """HSCAN patterns, one per field encoding, of the fields matching
+    matchers, and possibly others."""
+    # labels of json fields are sorted by name
+    json_pattern = "*".join(
+        _glob_escape(
+            json.dumps({name: matchers[name]}, separators=(",", ":"))[1:-1]
+        )
+        for name in sorted(matchers)
+    )
+    # compact fields hold the values in label names order, then le
+    compact_pattern = "".join(
+        "*|" + _glob_escape(_escape(matchers[name]))
+        for name in tuple(labelnames) + _EXTRA_NAMES
+        if name in matchers
+    )
+    return [f"*{json_pattern}*", f"~?{compact_pattern}*"]
@@ -0,0 +1,492 @@
+"""Snapshots of every family stored in a backend, to move them elsewhere.
+
+``export_snapshot()`` streams the families of a backend to a file (gzipped
+if its name ends with ``.gz``), ``import_snapshot()`` streams them into
+another backend, of either kind and with any prefix or field encoding, and
+``migrate()`` does both without a file. Memory does not depend on the size
+of the backend: Redis families are listed with ``SCAN`` and read with
+``HSCAN``, SQLite rows through a cursor, and imports are written in
+batches of ``SNAPSHOT_BATCH_SIZE`` values, one transaction each.
+
+A snapshot is a JSON line header followed by JSON line records of at most
+``SNAPSHOT_BATCH_SIZE`` entries, each for a single family::
+
+    {"format": "prometheus-distributed-client", "version": 1, ...}
+    {"family": "jobs", "metadata": {"type": "counter", ...}}
+    {"family": "jobs", "values": [["_total:{\\"kind\\":\\"cron\\"}", 3.0]]}
+    {"family": "size", "sketches": [["{}", "{\\"p12\\": 4}"]]}
+
+Values are keyed as ``suffix:labels`` (the SQLite subkeys and json Redis
+fields). Gauges in ``mostrecent`` mode carry their timestamp as a third
+item.
+
+By default, imported values replace the stored ones. With ``merge=True``
+they are combined as the values of several processes are: counts and sums
+are added, ``_created`` keeps the earliest timestamp, quantile sketches
+are merged and gauges follow their ``multiprocess_mode`` (the last import
+wins for the ``all`` and ``liveall`` modes), so that snapshots of several
+sources can be imported into one backend.
+"""
+
+import gzip
+import json
+import logging
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+from .config import DEFAULT_BACKEND, Backend
+from .fields import (
+    COMPACT_MARKER,
+    EXTRA_LABELNAMES,
+    decode_field,
+    encode_field,
+)
+from .integers import execute_increments
+from .packed import packed_fields
+from .quantiles import DEFAULT_MAX_BINS
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_FORMAT = "prometheus-distributed-client"
+SNAPSHOT_VERSION = 1
+# values per record and per import transaction
+SNAPSHOT_BATCH_SIZE = 1000
+
+Record = Dict
+
+
+@contextmanager
+def _open(path: str, mode: str) -> Iterator:
+    if path.endswith(".gz"):
+        with gzip.open(path, mode + "t", encoding="utf8") as fd:
+            yield fd
+    else:
+        with open(path, mode, encoding="utf8") as fd:
+            yield fd
+
+
+def _chunked(name: str, kind: str, entries: Iterable) -> Iterator[Record]:
+    chunk: List = []
+    for entry in entries:
+        chunk.append(entry)
+        if len(chunk) >= SNAPSHOT_BATCH_SIZE:
+            yield {"family": name, kind: chunk}
+            chunk = []
+    if chunk:
+        yield {"family": name, kind: chunk}
+
+
+def _gauge_mode(metadata: Optional[Dict]) -> str:
+    if not metadata:
+        return ""
+    return metadata.get("multiprocess_mode", "").removeprefix("live")
+
+
+def _max_bins(metadata: Optional[Dict]) -> int:
+    """Bins the merged sketches of a family are collapsed to."""
+    return (metadata or {}).get("max_bins", DEFAULT_MAX_BINS)
+
+
+def _merge_op(suffix: str, metadata: Optional[Dict], timestamped: bool):
+    """How merging writes a value: inc, min, max, mostrecent or set."""
+    if suffix == "_created":
+        return "min"
+    if suffix != "":
+        return "inc"
+    mode = _gauge_mode(metadata)
+    if mode == "sum":
+        return "inc"
+    if mode in ("max", "min") or (mode == "mostrecent" and timestamped):
+        return mode
+    return "set"
+
+
+# Reading
+
+
+def _redis_records(backend: Backend) -> Iterator[Record]:
+    conn = backend.redis
+    prefix = f"{backend.redis_prefix}_"
+    stored: dict = conn.hgetall(backend.redis_metadata_key())
+    metadata = {
+        name.decode("utf8"): json.loads(value)
+        for name, value in stored.items()
+    }
+    for bkey in conn.scan_iter(
+        match=f"{prefix}*", count=SNAPSHOT_BATCH_SIZE, _type="HASH"
+    ):
+        key = bkey.decode("utf8")
+        name = key.removeprefix(prefix)
+        if name.endswith((":timestamps", ":sketches")):
+            continue
+        family_metadata = metadata.get(name)
+        if family_metadata is not None:
+            yield {"family": name, "metadata": family_metadata}
+        labelnames = (family_metadata or {}).get("labelnames", ())
+        timestamped = _gauge_mode(family_metadata) == "mostrecent"
+        yield from _chunked(
+            name,
+            "values",
+            _redis_values(backend, key, name, labelnames, timestamped),
+        )
+        yield from _chunked(
+            name,
+            "sketches",
+            (
+                [labels.decode("utf8"), sketch.decode("utf8")]
+                for labels, sketch in conn.hscan_iter(
+                    backend.redis_sketches_key(name),
+                    count=SNAPSHOT_BATCH_SIZE,
+                )
+            ),
+        )
+
+
+def _redis_values(
+    backend: Backend, key: str, name: str, labelnames, timestamped: bool
+) -> Iterator[list]:
+    conn = backend.redis
+    batch: List[Tuple[str, list]] = []
+
+    def entries() -> Iterator[list]:
+        if timestamped:
+            timestamps = conn.hmget(
+                backend.redis_timestamps_key(name),
+                [field for field, _ in batch],
+            )
+            for (_, entry), timestamp in zip(batch, timestamps):
+                if timestamp is not None:
+                    entry.append(float(timestamp))
+        for _, entry in batch:
+            yield entry
+
+    for bfield, bvalue in conn.hscan_iter(key, count=SNAPSHOT_BATCH_SIZE):
+        field = bfield.decode("utf8")
+        subkey = field
+        if field.startswith(COMPACT_MARKER):
+            try:
+                suffix, labels = decode_field(field, labelnames)
+            except ValueError:  # no metadata to name its labels
+                logger.warning("skipping field %s of %s", field, name)
+                continue
+            subkey = encode_field(suffix, list(labels), list(labels.values()))
+        batch.append((field, [subkey, float(bvalue)]))
+        if len(batch) >= SNAPSHOT_BATCH_SIZE:
+            yield from entries()
+            batch = []
+    yield from entries()
+
+
+def _sqlite_records(backend: Backend) -> Iterator[Record]:
+    conn = backend.sqlite
+    les = {}
+    for name, metadata in conn.execute(
+        "SELECT metric_key, metadata FROM metrics_metadata"
+    ).fetchall():
+        decoded = json.loads(metadata)
+        les[name] = decoded.get("buckets", ())
+        yield {"family": name, "metadata": decoded}
+    family, chunk = None, []  # type: ignore[var-annotated]
+    rows = conn.execute("""
+        SELECT metric_key, subkey, value, timestamp
+        FROM metrics LEFT JOIN metrics_timestamps USING (metric_key, subkey)
+        ORDER BY metric_key
+        """)
+    for name, subkey, value, timestamp in rows:
+        if chunk and (name != family or len(chunk) >= SNAPSHOT_BATCH_SIZE):
+            yield {"family": family, "values": chunk}
+            chunk = []
+        family = name
+        entry = [subkey, value]
+        if timestamp is not None:
+            entry.append(timestamp)
+        chunk.append(entry)
+    if chunk:
+        yield {"family": family, "values": chunk}
+    # packed histograms are exported in the row layout
+    family, chunk = None, []
+    rows = conn.execute("""
+        SELECT metric_key, labels, sum, count, created, buckets
+        FROM metrics_histograms ORDER BY metric_key
+        """)
+    for name, labels, sum_value, count, created, buckets in rows:
+        if chunk and (name != family or len(chunk) >= SNAPSHOT_BATCH_SIZE):
+            yield {"family": family, "values": chunk}
+            chunk = []
+        family = name
+        chunk.extend(
+            [subkey, value]
+            for subkey, value in packed_fields(
+                labels, sum_value, count, created, buckets, les.get(name, ())
+            )
+        )
+    if chunk:
+        yield {"family": family, "values": chunk}
+    family, chunk = None, []
+    rows = conn.execute("""
+        SELECT metric_key, labels, sketch FROM metrics_sketches
+        ORDER BY metric_key
+        """)
+    for name, labels, sketch in rows:
+        if chunk and (name != family or len(chunk) >= SNAPSHOT_BATCH_SIZE):
+            yield {"family": family, "sketches": chunk}
+            chunk = []
+        family = name
+        chunk.append([labels, sketch])
+    if chunk:
+        yield {"family": family, "sketches": chunk}
+
+
+def read_backend(backend: Backend = DEFAULT_BACKEND) -> Iterator[Record]:
+    """Snapshot records of every family stored in backend."""
+    if backend.kind == "redis":
+        return _redis_records(backend)
+    if backend.kind == "sqlite":
+        return _sqlite_records(backend)
+    raise ValueError("backend is not set up")
+
+
+# Writing
+
+
+class _RedisWriter:
+
+    def __init__(self, backend: Backend, merge: bool):
+        self.backend = backend
+        self.merge = merge
+        self.conn = backend.redis
+
+    def _field(self, subkey: str, metadata: Optional[Dict]) -> str:
+        encoding = self.backend.redis_field_encoding
+        if encoding == "json":
+            return subkey
+        suffix, labels = decode_field(subkey, ())
+        names = tuple((metadata or {}).get("labelnames", ()))
+        names += EXTRA_LABELNAMES.get(suffix, ())
+        if labels and set(labels) != set(names):
+            return subkey  # unknown label names, both encodings are read
+        values = [labels[name] for name in names] if labels else []
+        return encode_field(suffix, names, values, encoding)
+
+    def write(self, record: Record, metadata: Optional[Dict]) -> None:
+        # imported here as the redis backend module depends on config
+        from .redis import MERGE_SKETCH_SCRIPT
+        from .resilience import queue_ops
+
+        backend, name = self.backend, record["family"]
+        key = backend.redis_key(name)
+        timestamps_key = backend.redis_timestamps_key(name)
+        ops: List = []
+        if "metadata" in record:
+            ops.append(
+                (
+                    "metadata",
+                    (backend.redis_metadata_key(),),
+                    name,
+                    json.dumps(record["metadata"], sort_keys=True),
+                )
+            )
+        for subkey, value, *timestamp in record.get("values", ()):
+            field = self._field(subkey, metadata)
+            suffix = subkey.split(":", 1)[0]
+            op = "set"
+            if self.merge:
+                op = _merge_op(suffix, metadata, bool(timestamp))
+            if op == "mostrecent":
+                value = [value, timestamp[0]]
+            ops.append((op, (key, timestamps_key), field, value))
+            if timestamp and op == "set":
+                ops.append(("set", (timestamps_key,), field, timestamp[0]))
+        if "values" in record:  # see generations.py
+            ops.append(
+                ("generation", (backend.redis_generations_key(),), key, 1)
+            )
+        pipe = self.conn.pipeline(transaction=True)
+        queue_ops(self.conn, pipe, ops, backend.redis_expire)
+        sketches_key = backend.redis_sketches_key(name)
+        for labels, sketch in record.get("sketches", ()):
+            if self.merge:
+                self.conn.register_script(MERGE_SKETCH_SCRIPT)(
+                    keys=[sketches_key],
+                    args=[
+                        labels,
+                        sketch,
+                        _max_bins(metadata),
+                        backend.redis_expire,
+                    ],
+                    client=pipe,
+                )
+            else:
+                pipe.hset(sketches_key, labels, sketch)
+                pipe.expire(sketches_key, backend.redis_expire)
+        execute_increments(pipe)
+
+
+# SQLite upsert of merged values, by merge operation
+_SQLITE_UPDATES = {
+    "set": "excluded.value",
+    "inc": "value + excluded.value",
+    "min": "MIN(value, excluded.value)",
+    "max": "MAX(value, excluded.value)",
+}
+
+
+class _SqliteWriter:
+
+    def __init__(self, backend: Backend, merge: bool):
+        self.merge = merge
+        self.conn = backend.sqlite
+
+    def _upsert(self, cursor, op: str, rows: List[tuple]) -> None:
+        cursor.executemany(
+            f"""
+            INSERT INTO metrics (metric_key, subkey, value)
+            VALUES (?, ?, ?)
+            ON CONFLICT(metric_key, subkey) DO UPDATE SET
+                value = {_SQLITE_UPDATES[op]}
+            """,
+            rows,
+        )
+
+    def _most_recent(self, cursor, name, subkey, value, timestamp) -> None:
+        # as the mostrecent gauges of sqlite.py do
+        cursor.execute(
+            """
+            INSERT INTO metrics_timestamps (metric_key, subkey, timestamp)
+            VALUES (?, ?, ?)
+            ON CONFLICT(metric_key, subkey) DO UPDATE SET
+                timestamp = excluded.timestamp
+            WHERE excluded.timestamp >= timestamp
+            """,
+            (name, subkey, timestamp),
+        )
+        if cursor.rowcount:
+            self._upsert(cursor, "set", [(name, subkey, value)])
+
+    def write(self, record: Record, metadata: Optional[Dict]) -> None:
+        name = record["family"]
+        cursor = self.conn.cursor()
+        if "metadata" in record:
+            cursor.execute(
+                """
+                INSERT INTO metrics_metadata (metric_key, metadata)
+                VALUES (?, ?)
+                ON CONFLICT(metric_key) DO UPDATE SET
+                    metadata = excluded.metadata
+                """,
+                (name, json.dumps(record["metadata"], sort_keys=True)),
+            )
+        rows: Dict[str, List[tuple]] = {}
+        for subkey, value, *timestamp in record.get("values", ()):
+            op = "set"
+            if self.merge:
+                suffix = subkey.split(":", 1)[0]
+                op = _merge_op(suffix, metadata, bool(timestamp))
+            if op == "mostrecent":
+                self._most_recent(cursor, name, subkey, value, timestamp[0])
+                continue
+            rows.setdefault(op, []).append((name, subkey, value))
+            if timestamp and op == "set":
+                cursor.execute(
+                    """
+                    INSERT INTO metrics_timestamps
+                        (metric_key, subkey, timestamp)
+                    VALUES (?, ?, ?)
+                    ON CONFLICT(metric_key, subkey) DO UPDATE SET
+                        timestamp = excluded.timestamp
+                    """,
+                    (name, subkey, timestamp[0]),
+                )
+        for op, op_rows in rows.items():
+            self._upsert(cursor, op, op_rows)
+        sketches = record.get("sketches", ())
+        if sketches:
+            update = (
+                "merge_sketch(sketch, excluded.sketch, ?)"
+                if self.merge
+                else "excluded.sketch"
+            )
+            params = (_max_bins(metadata),) if self.merge else ()
+            cursor.executemany(
+                f"""
+                INSERT INTO metrics_sketches (metric_key, labels, sketch)
+                VALUES (?, ?, ?)
+                ON CONFLICT(metric_key, labels) DO UPDATE SET
+                    sketch = {update}
+                """,
+                [
+                    (name, labels, sketch) + params
+                    for labels, sketch in sketches
+                ],
+            )
+        self.conn.commit()
+
+
+def write_backend(
+    records: Iterable[Record],
+    backend: Backend = DEFAULT_BACKEND,
+    merge: bool = False,
+) -> int:
+    """Writes snapshot records to backend, returns the values written."""
+    if backend.kind == "redis":
+        writer = _RedisWriter(backend, merge)
+    elif backend.kind == "sqlite":
+        writer = _SqliteWriter(backend, merge)  # type: ignore[assignment]
+    else:
+        raise ValueError("backend is not set up")
+    # the metadata of a family precedes its values
+    metadata: Dict[str, Dict] = {}
+    written = 0
+    for record in records:
+        if "metadata" in record:
+            metadata[record["family"]] = record["metadata"]
+        writer.write(record, metadata.get(record["family"]))
+        written += len(record.get("values", ()))
+    return written
+
+
+def export_snapshot(path: str, backend: Backend = DEFAULT_BACKEND) -> int:
+    """Writes every family of backend to path, returns the values written."""
+    written = 0
+    with _open(path, "w") as fd:
+        header = {
+            "format": SNAPSHOT_FORMAT,
+            "version": SNAPSHOT_VERSION,
+            "created": time.time(),
+            "source": backend.kind,
+        }
+        fd.write(json.dumps(header) + "\n")
+        for record in read_backend(backend):
+            fd.write(json.dumps(record, separators=(",", ":")) + "\n")
+            written += len(record.get("values", ()))
+    return written
+
+
+def read_snapshot(path: str) -> Iterator[Record]:
+    """Records of the snapshot at path."""
+    with _open(path, "r") as fd:
+        header = json.loads(fd.readline() or "{}")
+        if header.get("format") != SNAPSHOT_FORMAT:
+            raise ValueError(f"{path} is not a snapshot")
+        if header.get("version", 0) > SNAPSHOT_VERSION:
+            raise ValueError(
+                f"{path} is a version {header['version']} snapshot, "
+                f"version {SNAPSHOT_VERSION} at most is supported"
+            )
+        for line in fd:
+            yield json.loads(line)
+
+
+def import_snapshot(
+    path: str, backend: Backend = DEFAULT_BACKEND, merge: bool = False
+) -> int:
+    """Writes the families of the snapshot at path to backend, adding them
+    to the stored ones with merge, returns the values written."""
+    return write_backend(read_snapshot(path), backend, merge)
+
+
+def migrate(source: Backend, target: Backend, merge: bool = False) -> int:
+    """Copies every family of source to target, returns the values
+    written."""
+    return write_backend(read_backend(source), target, merge)
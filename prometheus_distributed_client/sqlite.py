@@ -1,16 +1,45 @@
 import json
 import time
-from typing import Dict, Iterable, Optional
+import weakref
+from bisect import bisect_left
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
 
 import prometheus_client
 from prometheus_client.samples import Sample
-from prometheus_client.utils import floatToGoString
-from prometheus_client.values import MutexValue
 
-from .config import get_sqlite_conn
+from .cardinality import CardinalityLimitMixin
+from .children import BoundedChildrenMixin, BucketLayoutMixin
+from .config import DEFAULT_BACKEND, Backend, BackendMixin
+from .exponential import BUCKET_LABEL, ExponentialMixin
+from .fields import labels_json, merge_values
+from .generations import GenerationCacheMixin
+from .integers import IntegerCounterMixin
+from .metadata import MetadataMixin, dump_metadata
+from .packed import packed_delta, packed_fields
+from .prepare import PrepareMixin
+from .quantiles import QuantileMixin
+from .read_cache import MISS
+from .rollup import RollupMixin
+from .sampling import SamplingMixin
+from .selection import matchable
+
+
+class ValueClass:
+    """A value stored in a row of the metrics table. Each update is its
+    own transaction, so unlike prometheus_client values no local value or
+    lock is kept (see children.py)."""
+
+    __slots__ = (
+        "__metric_name",
+        "__suffix",
+        "__labelnames",
+        "__labelvalues",
+        "__le",
+        "__mode",
+        "__rollups",
+        "__backend",
+    )
 
-
-class ValueClass(MutexValue):
     def __init__(
         self,
         typ,
@@ -19,18 +48,24 @@ class ValueClass(MutexValue):
         labelvalues,
         **kwargs,
     ):
-        super().__init__(
-            typ,
-            metric_name,
-            metric_name + kwargs.get("suffix", ""),
-            labelnames,
-            labelvalues,
-            **kwargs,
-        )
         self.__metric_name = metric_name
         self.__suffix = kwargs.get("suffix", "")
         self.__labelnames = labelnames
         self.__labelvalues = labelvalues
+        # bucket bound, the last label value, kept apart to share the tuple
+        # of label values between the buckets of a child
+        self.__le = kwargs.get("le")
+        self.__mode = kwargs.get("multiprocess_mode", "").removeprefix("live")
+        self.__rollups = tuple(
+            (rollup_metric, f"{self.__suffix}:{labels_json(names, values)}")
+            for rollup_metric, names, values in kwargs.get("rollups", ())
+        )
+        self.__backend: Backend = kwargs.get("backend", DEFAULT_BACKEND)
+
+    def __all_labelvalues(self):
+        if self.__le is None:
+            return self.__labelvalues
+        return self.__labelvalues + (self.__le,)
 
     @property
     def _sqlite_key(self):
@@ -38,50 +73,106 @@ class ValueClass(MutexValue):
 
     @property
     def _sqlite_subkey(self):
-        labels_json = json.dumps(
-            dict(zip(self.__labelnames, self.__labelvalues)),
-            sort_keys=True,
-            separators=(",", ":"),
+        return (
+            f"{self.__suffix}:"
+            f"{labels_json(self.__labelnames, self.__all_labelvalues())}"
         )
-        return f"{self.__suffix}:{labels_json}"
 
     def _execute(self, query, params):
-        conn = get_sqlite_conn()
+        conn = self.__backend.sqlite
         cursor = conn.cursor()
         cursor.execute(query, params)
         conn.commit()
+        self._invalidate_cache()
         return cursor
 
-    def inc(self, amount):
-        metric_key = self._sqlite_key
-        subkey = self._sqlite_subkey
+    def _execute_many(self, query, params_seq):
+        conn = self.__backend.sqlite
+        cursor = conn.cursor()
+        cursor.executemany(query, params_seq)
+        conn.commit()
+        self._invalidate_cache()
+        return cursor
 
+    def _invalidate_cache(self):
+        # commits of our own connection do not bump data_version
+        cache = self.__backend.read_cache
+        if cache is None:
+            return
+        for metric_key, subkey in self._targets():
+            cache.invalidate(metric_key, subkey)
+
+    def _targets(self):
+        """This value's row followed by the rows mirroring it in rollups."""
+        return ((self._sqlite_key, self._sqlite_subkey),) + self.__rollups
+
+    def inc(self, amount):
         # SQLite doesn't have atomic float increment, so we need to
-        # do it in a transaction
-        self._execute(
+        # do it in a transaction, along with the rollups
+        self._execute_many(
             """
             INSERT INTO metrics (metric_key, subkey, value)
             VALUES (?, ?, ?)
             ON CONFLICT(metric_key, subkey) DO UPDATE SET
                 value = value + ?
             """,
-            (metric_key, subkey, amount, amount),
+            [
+                (metric_key, subkey, amount, amount)
+                for metric_key, subkey in self._targets()
+            ],
         )
 
     def set(self, value, timestamp=None):
         metric_key = self._sqlite_key
         subkey = self._sqlite_subkey
 
+        if self.__mode == "mostrecent":
+            self._set_most_recent(
+                value, time.time() if timestamp is None else timestamp
+            )
+            return
+        # MAX() and MIN() make max and min modes a single atomic upsert
+        update = {"max": "MAX(value, ?)", "min": "MIN(value, ?)"}.get(
+            self.__mode, "?"
+        )
         self._execute(
-            """
+            f"""
             INSERT INTO metrics (metric_key, subkey, value)
             VALUES (?, ?, ?)
             ON CONFLICT(metric_key, subkey) DO UPDATE SET
-                value = ?
+                value = {update}
             """,
             (metric_key, subkey, value, value),
         )
 
+    def _set_most_recent(self, value, timestamp):
+        conn = self.__backend.sqlite
+        cursor = conn.cursor()
+        # writing the timestamp first takes the database write lock, making
+        # the following update part of the same atomic transaction
+        cursor.execute(
+            """
+            INSERT INTO metrics_timestamps (metric_key, subkey, timestamp)
+            VALUES (?, ?, ?)
+            ON CONFLICT(metric_key, subkey) DO UPDATE SET
+                timestamp = excluded.timestamp
+            WHERE excluded.timestamp >= timestamp
+            """,
+            (self._sqlite_key, self._sqlite_subkey, timestamp),
+        )
+        if cursor.rowcount:
+            cursor.execute(
+                """
+                INSERT INTO metrics (metric_key, subkey, value)
+                VALUES (?, ?, ?)
+                ON CONFLICT(metric_key, subkey) DO UPDATE SET
+                    value = excluded.value
+                """,
+                (self._sqlite_key, self._sqlite_subkey, value),
+            )
+        conn.commit()
+        self._invalidate_cache()
+
     def refresh_expire(self):
         # No-op for SQLite - no TTL needed
         pass
@@ -90,20 +181,35 @@ class ValueClass(MutexValue):
         raise NotImplementedError()
 
     def setnx(self, value):
-        metric_key = self._sqlite_key
-        subkey = self._sqlite_subkey
-
-        self._execute(
+        self._execute_many(
             """
             INSERT INTO metrics (metric_key, subkey, value)
             VALUES (?, ?, ?)
             ON CONFLICT(metric_key, subkey) DO NOTHING
             """,
-            (metric_key, subkey, value),
+            [
+                (metric_key, subkey, value)
+                for metric_key, subkey in self._targets()
+            ],
         )
 
     def get(self) -> Optional[float]:
-        conn = get_sqlite_conn()
+        cache = self.__backend.read_cache
+        if cache is None:
+            return self._fetch()
+        conn = self.__backend.sqlite
+        # bumped whenever another connection commits to the database
+        version = conn.execute("PRAGMA data_version").fetchone()[0]
+        key, subkey = self._sqlite_key, self._sqlite_subkey
+        value = cache.get(key, subkey, version)
+        if value is MISS:
+            token = cache.token(key)
+            value = self._fetch()
+            cache.put(key, subkey, value, token, version)
+        return value
+
+    def _fetch(self) -> Optional[float]:
+        conn = self.__backend.sqlite
         cursor = conn.cursor()
         metric_key = self._sqlite_key
         subkey = self._sqlite_subkey
@@ -121,63 +227,253 @@ class ValueClass(MutexValue):
         return float(row[0])
 
 
-class Counter(prometheus_client.Counter):
-    def _metric_init(self):
-        self._value = ValueClass(
-            self._type,
-            self._name,
-            self._labelnames,
-            self._labelvalues,
-            help_text=self._documentation,
-            suffix="_total",
+def _usable(conn) -> bool:
+    """Whether conn may be used from this thread, connections opened
+    without check_same_thread=False only being usable from their own."""
+    try:
+        return conn.total_changes is not None
+    except conn.ProgrammingError:
+        return False
+
+
+def _labels_condition(
+    labels: str, matchers: Optional[Dict[str, str]], family_wide: bool
+) -> Tuple[str, List[str]]:
+    """Condition on the labels JSON of a row for it to match matchers, and
+    with family_wide for the family wide _created (no labels) to match."""
+    if not matchers:
+        return "", []
+    params: List[str] = []
+    for name, value in matchers.items():
+        params.extend((f'$."{name}"', value))
+    conditions = " AND ".join(
+        [f"json_extract({labels}, ?) = ?"] * len(matchers)
+    )
+    if not family_wide:
+        return f" AND {conditions}", params
+    return f" AND ({labels} = '{{}}' OR ({conditions}))", params
+
+
+class SqliteMetricMixin(
+    BackendMixin,
+    BoundedChildrenMixin,
+    PrepareMixin,
+    MetadataMixin,
+    CardinalityLimitMixin,
+    GenerationCacheMixin,
+):
+    _backend = "sqlite"
+    # suffix of the fields whose label sets get a family wide _created
+    _created_anchor = "_total"
+    _created_sent = False
+    # ValueClass of the child, prometheus_client's float _created unused
+    _created: Any = None
+
+    @staticmethod
+    def _prepare_children(backend: Backend, children: List) -> None:
+        now = time.time()
+        rows: List[Tuple[str, str, float]] = []
+        written: List[ValueClass] = []
+        for child in children:
+            values = [(value, 0.0) for value in child._zero_values()]
+            if child._created is not None and not child._created_sent:
+                values.append((child._created, now))
+            child._created_sent = True
+            for value, initial in values:
+                rows.extend(
+                    (metric_key, subkey, initial)
+                    for metric_key, subkey in value._targets()
+                )
+                written.append(value)
+        conn = backend.sqlite
+        conn.executemany(
+            """
+            INSERT INTO metrics (metric_key, subkey, value)
+            VALUES (?, ?, ?)
+            ON CONFLICT(metric_key, subkey) DO NOTHING
+            """,
+            rows,
         )
-        self._created = ValueClass(
+        conn.commit()
+        for value in written:
+            value._invalidate_cache()
+
+    def _store_metadata(self) -> None:
+        conn = self._target.sqlite
+        conn.execute(
+            """
+            INSERT INTO metrics_metadata (metric_key, metadata)
+            VALUES (?, ?)
+            ON CONFLICT(metric_key) DO UPDATE SET
+                metadata = excluded.metadata
+            """,
+            (self._name, dump_metadata(self)),
+        )
+        conn.commit()
+
+    def _admit_series(self, labelvalues) -> bool:
+        conn = self._target.sqlite
+        cursor = conn.cursor()
+        member = labels_json(self._labelnames, labelvalues)
+        cursor.execute(
+            """
+            SELECT 1 FROM metrics_series
+            WHERE metric_key = ? AND labels = ?
+            """,
+            (self._name, member),
+        )
+        if cursor.fetchone():
+            return True
+        # one statement, the caps are checked under the write lock
+        cursor.execute(
+            """
+            INSERT INTO metrics_series (metric_key, labels)
+            SELECT ?, ?
+            WHERE (
+                ? IS NULL OR (
+                    SELECT COUNT(*) FROM metrics_series WHERE metric_key = ?
+                ) < ?
+            ) AND (
+                ? IS NULL OR (SELECT COUNT(*) FROM metrics_series) < ?
+            )
+            ON CONFLICT(metric_key, labels) DO NOTHING
+            """,
+            (
+                self._name,
+                member,
+                self._max_series,
+                self._name,
+                self._max_series,
+                self._target.max_series,
+                self._target.max_series,
+            ),
+        )
+        conn.commit()
+        if cursor.rowcount == 1:
+            return True
+        # admitted meanwhile by another process
+        cursor.execute(
+            """
+            SELECT 1 FROM metrics_series
+            WHERE metric_key = ? AND labels = ?
+            """,
+            (self._name, member),
+        )
+        return cursor.fetchone() is not None
+
+    def _count_overflow(self) -> None:
+        _overflow_counter(self._target).labels(self._name).inc()
+
+    def _created_value(self) -> Optional[ValueClass]:
+        policy = self._target.created
+        if policy == "disabled":
+            return None
+        if policy == "family":
+            return ValueClass(
+                "gauge",
+                self._name,
+                (),
+                (),
+                help_text=self._documentation,
+                backend=self._target,
+                suffix="_created",
+                rollups=tuple(
+                    (rollup, (), ()) for rollup, _, _ in self._rollup_fields()
+                ),
+            )
+        return ValueClass(
             "gauge",
             self._name,
             self._labelnames,
             self._labelvalues,
             help_text=self._documentation,
+            backend=self._target,
             suffix="_created",
+            rollups=self._rollup_fields(),
         )
-        self._created.setnx(time.time())  # type: ignore[attr-defined]
 
-    def inc(
-        self, amount: float = 1, exemplar: Optional[Dict[str, str]] = None
-    ) -> None:
-        self._created.setnx(time.time())  # type: ignore[attr-defined]
-        self._created.refresh_expire()  # type: ignore[attr-defined]
-        return super().inc(amount, exemplar)
-
-    def reset(self) -> None:
-        self._value.set(0)
-        self._created.set(time.time())  # type: ignore[attr-defined]
+    def _ensure_created(self):
+        """Sends _created on the first write of a child, SQLite never
+        expires it."""
+        if self._created is not None and not self._created_sent:
+            self._created.setnx(time.time())  # type: ignore[attr-defined]
+        self._created_sent = True
+
+    @staticmethod
+    def _read_generations(
+        backend: Backend, names: List[str]
+    ) -> Dict[str, Optional[int]]:
+        placeholders = ", ".join("?" * len(names))
+        return dict(
+            backend.sqlite.execute(
+                f"""
+                SELECT metric_key, generation FROM metrics_generations
+                WHERE metric_key IN ({placeholders})
+                """,
+                names,
+            ).fetchall()
+        )
 
-    def _samples(self) -> Iterable[Sample]:
-        conn = get_sqlite_conn()
+    def _raw_fields(
+        self, matchers: Optional[Dict[str, str]] = None
+    ) -> Iterable[Tuple[str, float]]:
+        """Subkeys and values of the whole family, as stored, or of the label
+        sets matching matchers (see selection.py)."""
+        if not matchers:
+            return self._cached_fields(self._read_fields)
+        if not matchable(self._labelnames, matchers):
+            return []
+        return self._read_fields(matchers)
+
+    def _read_fields(
+        self, matchers: Optional[Dict[str, str]] = None
+    ) -> List[Tuple[str, float]]:
+        conn = self._target.sqlite
         cursor = conn.cursor()
-
+        where, params = _labels_condition(
+            "substr(subkey, instr(subkey, ':') + 1)",
+            matchers,
+            bool(self._labelnames),
+        )
         cursor.execute(
-            """
+            f"""
             SELECT subkey, value FROM metrics
-            WHERE metric_key = ?
+            WHERE metric_key = ?{where}
             """,
-            (self._name,),
+            (self._name, *params),
         )
+        return cursor.fetchall()
 
-        for row in cursor.fetchall():
-            subkey, value = row
-            suffix, labels_json = subkey.split(":", 1)
-            yield Sample(
-                suffix,
-                json.loads(labels_json),
-                float(value),
-            )
+    def _samples(self) -> Iterable[Sample]:
+        return self._cached_samples(self._raw_fields(), self._decode_samples)
+
+    def _decode_samples(self, fields) -> Iterable[Sample]:
+        family_created, anchors = None, []
+        for subkey, value in fields:
+            suffix, labels_str = subkey.split(":", 1)
+            family_wide = self._labelnames and labels_str == "{}"
+            if suffix == "_created" and family_wide:
+                family_created = float(value)
+                continue
+            labels = json.loads(labels_str)
+            if suffix == self._created_anchor:
+                anchors.append(labels)
+            yield Sample(suffix, labels, float(value))
+        if family_created is not None:
+            for labels in anchors:
+                yield Sample("_created", labels, family_created)
 
     _child_samples = _samples
     _multi_samples = _samples
 
 
-class Gauge(prometheus_client.Gauge):
+class Counter(
+    RollupMixin,
+    IntegerCounterMixin,
+    SamplingMixin,
+    SqliteMetricMixin,
+    prometheus_client.Counter,
+):
     def _metric_init(self):
         self._value = ValueClass(
             self._type,
@@ -185,43 +481,74 @@ class Gauge(prometheus_client.Gauge):
             self._labelnames,
             self._labelvalues,
             help_text=self._documentation,
-            suffix="",
+            backend=self._target,
+            suffix="_total",
+            rollups=self._rollup_fields(),
         )
+        self._created = self._created_value()
 
-    def _samples(self) -> Iterable[Sample]:
-        conn = get_sqlite_conn()
-        cursor = conn.cursor()
+    def _zero_values(self) -> List[ValueClass]:
+        return [self._value]
 
-        cursor.execute(
-            """
-            SELECT subkey, value FROM metrics
-            WHERE metric_key = ?
-            """,
-            (self._name,),
+    def inc(
+        self, amount: float = 1, exemplar: Optional[Dict[str, str]] = None
+    ) -> None:
+        scale = self._sampler.sample()
+        if not scale:
+            return None
+        self._ensure_created()
+        return super().inc(amount * scale, exemplar)
+
+    def reset(self) -> None:
+        self._value.set(0)
+        if self._created is not None:
+            self._created.set(time.time())  # type: ignore[attr-defined]
+
+
+class Gauge(SqliteMetricMixin, prometheus_client.Gauge):
+    def _metric_init(self):
+        self._value = ValueClass(
+            self._type,
+            self._name,
+            self._labelnames,
+            self._labelvalues,
+            help_text=self._documentation,
+            backend=self._target,
+            suffix="",
+            multiprocess_mode=self._multiprocess_mode,
         )
 
-        for row in cursor.fetchall():
-            subkey, value = row
-            suffix, labels_json = subkey.split(":", 1)
-            yield Sample(
-                suffix,
-                json.loads(labels_json),
-                float(value),
-            )
+    def _zero_values(self) -> List[ValueClass]:
+        # 0 would win every later min/max/mostrecent comparison
+        mode = self._multiprocess_mode.removeprefix("live")
+        if mode in ("max", "min", "mostrecent"):
+            return []
+        return [self._value]
+
+    def get(self) -> Optional[float]:
+        return self._value.get()
 
-    _child_samples = _samples
-    _multi_samples = _samples
 
+class Summary(
+    RollupMixin,
+    SamplingMixin,
+    QuantileMixin,
+    SqliteMetricMixin,
+    prometheus_client.Summary,
+):
+    _created_anchor = "_count"
 
-class Summary(prometheus_client.Summary):
     def _metric_init(self):
+        rollups = self._rollup_fields()
         self._count = ValueClass(
             self._type,
             self._name,
             self._labelnames,
             self._labelvalues,
             help_text=self._documentation,
+            backend=self._target,
             suffix="_count",
+            rollups=rollups,
         )
         self._sum = ValueClass(
             self._type,
@@ -229,67 +556,239 @@ class Summary(prometheus_client.Summary):
             self._labelnames,
             self._labelvalues,
             help_text=self._documentation,
+            backend=self._target,
             suffix="_sum",
+            rollups=rollups,
         )
-        self._created = ValueClass(
-            "gauge",
-            self._name,
-            self._labelnames,
-            self._labelvalues,
-            help_text=self._documentation,
-            suffix="_created",
-        )
-        self._created.setnx(time.time())  # type: ignore[attr-defined]
+        self._created = self._created_value()
 
-    def observe(self, amount: float) -> None:
-        self._created.refresh_expire()  # type: ignore[attr-defined]
-        return super().observe(amount)
+    def _zero_values(self) -> List[ValueClass]:
+        return [self._count, self._sum]
 
-    def _samples(self) -> Iterable[Sample]:
-        conn = get_sqlite_conn()
-        cursor = conn.cursor()
+    def observe(self, amount: float) -> None:
+        self._raise_if_not_observable()
+        self._observe_quantile(amount)
+        scale = self._sampler.sample()
+        if not scale:
+            return
+        self._ensure_created()
+        self._count.inc(scale)
+        self._sum.inc(amount * scale)
+
+    def _merge_sketch(
+        self, targets: Sequence[Tuple[str, str]], encoded: str
+    ) -> bool:
+        conn = self._target.sqlite
+        if not _usable(conn):
+            # flushed from another thread, see quantiles.py
+            return False
+        # merge_sketch() is registered by connect_sqlite()
+        conn.executemany(
+            """
+            INSERT INTO metrics_sketches (metric_key, labels, sketch)
+            VALUES (?, ?, ?)
+            ON CONFLICT(metric_key, labels) DO UPDATE SET
+                sketch = merge_sketch(sketch, excluded.sketch, ?)
+            """,
+            [
+                (name, labels, encoded, self._max_bins)
+                for name, labels in targets
+            ],
+        )
+        conn.commit()
+        return True
 
-        cursor.execute(
+    def _stored_sketches(self) -> Iterable[Tuple[str, str]]:
+        cursor = self._target.sqlite.execute(
             """
-            SELECT subkey, value FROM metrics
+            SELECT labels, sketch FROM metrics_sketches
             WHERE metric_key = ?
             """,
             (self._name,),
         )
+        return cursor.fetchall()
 
-        for row in cursor.fetchall():
-            subkey, value = row
-            suffix, labels_json = subkey.split(":", 1)
-            yield Sample(
-                suffix,
-                json.loads(labels_json),
-                float(value),
-            )
 
-    _child_samples = _samples
-    _multi_samples = _samples
+class Histogram(
+    RollupMixin,
+    SamplingMixin,
+    BucketLayoutMixin,
+    SqliteMetricMixin,
+    prometheus_client.Histogram,
+):
+    _created_anchor = "_count"
 
+    def __init__(self, *args, packed: bool = False, **kwargs):
+        self._packed = packed
+        super().__init__(*args, **kwargs)
+        self._kwargs["packed"] = packed
 
-class Histogram(prometheus_client.Histogram):
     def _metric_init(self):
-        self._buckets = []
-        self._created = ValueClass(
-            "gauge",
+        if self._packed:
+            # _created of a series is the created column of its row
+            self._created = (
+                self._created_value()
+                if self._target.created == "family"
+                else None
+            )
+            self._packed_targets = (
+                (self._name, labels_json(self._labelnames, self._labelvalues)),
+            ) + tuple(
+                (rollup_metric, labels_json(names, values))
+                for rollup_metric, names, values in self._rollup_fields()
+            )
+            return
+        self._created = self._created_value()
+        rollups = self._rollup_fields()
+        bucket_labelnames = self._labelnames + ("le",)
+        self._count = ValueClass(
+            self._type,
             self._name,
             self._labelnames,
             self._labelvalues,
             help_text=self._documentation,
-            suffix="_created",
+            backend=self._target,
+            suffix="_count",
+            rollups=rollups,
         )
-        self._created.setnx(time.time())  # type: ignore[attr-defined]
-        bucket_labelnames = self._labelnames + ("le",)
+        self._sum = ValueClass(
+            self._type,
+            self._name,
+            self._labelnames,
+            self._labelvalues,
+            help_text=self._documentation,
+            backend=self._target,
+            suffix="_sum",
+            rollups=rollups,
+        )
+        self._buckets = tuple(
+            ValueClass(
+                self._type,
+                self._name,
+                bucket_labelnames,
+                self._labelvalues,
+                help_text=self._documentation,
+                backend=self._target,
+                suffix="_bucket",
+                le=le,
+                rollups=self._rollup_fields({"le": le}),
+            )
+            for le in self._bucket_layout.les
+        )
+
+    def _zero_values(self) -> List[ValueClass]:
+        if self._packed:
+            return []
+        return [self._count, self._sum, *self._buckets]
+
+    def observe(
+        self, amount: float, exemplar: Optional[Dict[str, str]] = None
+    ) -> None:
+        """Observe the given amount."""
+        scale = self._sampler.sample()
+        if not scale:
+            return
+        self._ensure_created()
+        if self._packed:
+            self._observe_packed(amount, scale)
+            return
+        self._sum.inc(amount * scale)
+        for i, bound in enumerate(self._upper_bounds):
+            self._buckets[i].inc(scale if amount <= bound else 0)
+        self._count.inc(scale)
+
+    def _observe_packed(self, amount: float, scale: float) -> None:
+        # counted in the first bucket whose bound is not below amount
+        index = bisect_left(self._upper_bounds, amount)
+        buckets = packed_delta(len(self._upper_bounds), index, scale)
+        created = time.time() if self._target.created == "series" else None
+        conn = self._target.sqlite
+        conn.executemany(
+            """
+            INSERT INTO metrics_histograms
+                (metric_key, labels, sum, count, created, buckets)
+            VALUES (?, ?, ?, ?, ?, ?)
+            ON CONFLICT(metric_key, labels) DO UPDATE SET
+                sum = sum + excluded.sum,
+                count = count + excluded.count,
+                buckets = add_packed(buckets, excluded.buckets)
+            """,
+            [
+                (metric_key, labels, amount * scale, scale, created, buckets)
+                for metric_key, labels in self._packed_targets
+            ],
+        )
+        conn.commit()
+
+    def _read_fields(
+        self, matchers: Optional[Dict[str, str]] = None
+    ) -> List[Tuple[str, float]]:
+        fields = super()._read_fields(matchers)
+        if not self._packed:
+            return fields
+        # rows written before the family was packed are added up
+        merged: Dict[str, float] = {}
+        # le is not stored in the labels of packed rows
+        le = (matchers or {}).get("le")
+        where, params = _labels_condition(
+            "labels",
+            {
+                name: value
+                for name, value in (matchers or {}).items()
+                if name != "le"
+            },
+            False,
+        )
+        cursor = self._target.sqlite.execute(
+            f"""
+            SELECT labels, sum, count, created, buckets
+            FROM metrics_histograms WHERE metric_key = ?{where}
+            """,
+            (self._name, *params),
+        )
+        for labels, sum_value, count, created, buckets in cursor:
+            fields.extend(
+                (subkey, value)
+                for subkey, value in packed_fields(
+                    labels,
+                    sum_value,
+                    count,
+                    created,
+                    buckets,
+                    self._bucket_layout.les,
+                )
+                if le is None or f'"le":{json.dumps(le)}' in subkey
+            )
+        for subkey, value in fields:
+            merged[subkey] = merge_values(
+                subkey.split(":", 1)[0], merged.get(subkey), value
+            )
+        return list(merged.items())
+
+
+class ExponentialHistogram(
+    RollupMixin,
+    SamplingMixin,
+    ExponentialMixin,
+    SqliteMetricMixin,
+    prometheus_client.Histogram,
+):
+    """Histogram with sparse exponential buckets, see exponential.py."""
+
+    _created_anchor = "_count"
+
+    def _metric_init(self):
+        self._created = self._created_value()
+        rollups = self._rollup_fields()
         self._count = ValueClass(
             self._type,
             self._name,
             self._labelnames,
             self._labelvalues,
             help_text=self._documentation,
+            backend=self._target,
             suffix="_count",
+            rollups=rollups,
         )
         self._sum = ValueClass(
             self._type,
@@ -297,53 +796,74 @@ class Histogram(prometheus_client.Histogram):
             self._labelnames,
             self._labelvalues,
             help_text=self._documentation,
+            backend=self._target,
             suffix="_sum",
+            rollups=rollups,
         )
-        for b in self._upper_bounds:
-            self._buckets.append(
-                ValueClass(
-                    self._type,
-                    self._name,
-                    bucket_labelnames,
-                    self._labelvalues + (floatToGoString(b),),
-                    help_text=self._documentation,
-                    suffix="_bucket",
-                )
-            )
+
+    def _new_bucket_value(self, key: str) -> ValueClass:
+        return ValueClass(
+            self._type,
+            self._name,
+            self._labelnames + (BUCKET_LABEL,),
+            self._labelvalues,
+            help_text=self._documentation,
+            backend=self._target,
+            suffix="_ebucket",
+            le=key,
+            rollups=self._rollup_fields({BUCKET_LABEL: key}),
+        )
+
+    def _zero_values(self) -> List[ValueClass]:
+        return [self._count, self._sum]
 
     def observe(
         self, amount: float, exemplar: Optional[Dict[str, str]] = None
     ) -> None:
         """Observe the given amount."""
-        self._sum.inc(amount)
-        for i, bound in enumerate(self._upper_bounds):
-            if amount <= bound:
-                self._buckets[i].inc(1)
-            else:
-                self._buckets[i].inc(0)
-        self._count.inc(1)
-        self._created.refresh_expire()  # type: ignore[attr-defined]
+        scale = self._sampler.sample()
+        if not scale:
+            return
+        self._ensure_created()
+        self._sum.inc(amount * scale)
+        self._observe_bucket(amount, scale)
+        self._count.inc(scale)
+
+
+def stored_metadata(backend: Backend = DEFAULT_BACKEND) -> Dict[str, str]:
+    """Metadata of the declared families which hold values, by name."""
+    cursor = backend.sqlite.execute("""
+        SELECT metric_key, metadata FROM metrics_metadata
+        WHERE EXISTS (
+            SELECT 1 FROM metrics
+            WHERE metrics.metric_key = metrics_metadata.metric_key
+        ) OR EXISTS (
+            SELECT 1 FROM metrics_histograms
+            WHERE metrics_histograms.metric_key = metrics_metadata.metric_key
+        )
+        """)
+    return dict(cursor.fetchall())
 
-    def _samples(self) -> Iterable[Sample]:
-        conn = get_sqlite_conn()
-        cursor = conn.cursor()
 
-        cursor.execute(
-            """
-            SELECT subkey, value FROM metrics
-            WHERE metric_key = ?
-            """,
-            (self._name,),
+# counters of the foldings because of max_series, by backend
+_OVERFLOW_COUNTERS: "weakref.WeakKeyDictionary" = weakref.WeakKeyDictionary()
+
+
+def _overflow_counter(backend: Backend = DEFAULT_BACKEND) -> Counter:
+    """Counts the foldings of the metrics stored in backend, in backend."""
+    counter = _OVERFLOW_COUNTERS.get(backend)
+    if counter is None:
+        counter = Counter(
+            "prometheus_distributed_series_overflow",
+            "Label sets folded into the overflow series because of "
+            "max_series",
+            ["metric"],
+            registry=None,
+            backend=backend,
         )
+        counter._series_exempt = True
+        _OVERFLOW_COUNTERS[backend] = counter
+    return counter
 
-        for row in cursor.fetchall():
-            subkey, value = row
-            suffix, labels_json = subkey.split(":", 1)
-            yield Sample(
-                suffix,
-                json.loads(labels_json),
-                float(value),
-            )
 
-    _child_samples = _samples
-    _multi_samples = _samples
+SERIES_OVERFLOW = _overflow_counter()
@@ -0,0 +1,259 @@
+"""Append-only writes through a Redis Stream (Redis only).
+
+With ``setup(redis=..., redis_stream=True)``, writes no longer update the
+family hashes. A ``StreamWriter`` aggregates them locally, like the spool
+of resilience.py, and appends them to the ``{prefix}:stream`` stream as a
+single entry once ``redis_stream_batch_size`` fields are pending, every
+``redis_stream_flush_interval`` seconds and at interpreter exit. A write
+then costs one ``XADD`` per batch, whatever the number of processes
+writing the same fields.
+
+A ``StreamAggregator`` (``python -m prometheus_distributed_client
+aggregate``) reads the stream as a member of a consumer group and applies
+the entries to the family hashes: each batch of entries is aggregated
+again, applied and acknowledged within a single transaction, then the
+stream is trimmed of the entries every consumer acknowledged. Entries left
+pending by a dead aggregator are claimed by the others once idle for
+``claim_idle`` seconds. Scrapes see the writes once aggregated.
+
+Series admission (``max_series``), removals, metadata and quantile
+sketches are still written directly.
+"""
+
+import atexit
+import json
+import logging
+import os
+import socket
+import sys
+import threading
+import weakref
+from typing import List, Optional, cast
+
+from redis import Redis
+from redis.exceptions import RedisError, ResponseError
+
+from .integers import execute_increments
+from .resilience import Op, Spool, queue_ops
+
+logger = logging.getLogger(__name__)
+
+STREAM_BATCH_SIZE = 1000
+# seconds between two flushes of the pending writes of a process
+STREAM_FLUSH_INTERVAL = 1.0
+AGGREGATOR_GROUP = "aggregator"
+# stream entries read at most per aggregated batch
+AGGREGATE_BATCH_SIZE = 1000
+
+_WRITERS: "weakref.WeakSet" = weakref.WeakSet()
+
+
+class StreamWriter:
+    """Batches the writes of a backend into stream entries, see the module
+    docstring."""
+
+    def __init__(
+        self,
+        backend,
+        batch_size: int = STREAM_BATCH_SIZE,
+        flush_interval: float = STREAM_FLUSH_INTERVAL,
+    ):
+        self.backend = backend
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        # aggregated writes, never full: flushed at batch_size
+        self.pending = Spool(sys.maxsize)
+        self._flush_lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._flusher: Optional[threading.Thread] = None
+        _WRITERS.add(self)
+
+    def add(self, ops: List[Op]) -> None:
+        self.pending.add(ops)
+        if len(self.pending) >= self.batch_size:
+            try:
+                self.flush()
+            except RedisError:
+                # kept pending, for the next flush
+                logger.exception("could not flush writes to the stream")
+        if self._flusher is None:
+            self._start_flusher()
+
+    def _start_flusher(self) -> None:
+        with self._flush_lock:
+            if self._flusher is None and not self._stopped.is_set():
+                self._flusher = threading.Thread(
+                    target=self._flush_periodically,
+                    name="prometheus-distributed-stream",
+                    daemon=True,
+                )
+                self._flusher.start()
+
+    def _flush_periodically(self) -> None:
+        while not self._stopped.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("could not flush writes to the stream")
+
+    def flush(self) -> None:
+        """Appends the pending writes to the stream as one entry. They stay
+        pending if that fails."""
+        with self._flush_lock:
+            ops = self.pending.take(len(self.pending))
+            if not ops:
+                return
+            backend = self.backend
+            pipe = backend.redis_write_conn.pipeline(transaction=False)
+            # trimmed by the aggregator, of acknowledged entries only
+            pipe.xadd(
+                backend.redis_stream_key(),
+                {"ops": json.dumps(ops), "expire": backend.redis_expire},
+            )
+            if backend.write_guard is None:
+                try:
+                    pipe.execute()
+                except Exception:
+                    self.pending.restore(ops)
+                    raise
+            else:  # spooled ops are replayed to the hashes directly
+                backend.write_guard.execute(pipe, ops)
+
+    def close(self) -> None:
+        """Flushes the pending writes and stops the periodic flushes."""
+        self._stopped.set()
+        self.flush()
+
+
+def flush_streams() -> None:
+    """Flushes the pending writes of every stream writer of this process."""
+    for writer in list(_WRITERS):
+        try:
+            writer.flush()
+        except Exception:
+            logger.exception("could not flush writes to the stream")
+
+
+atexit.register(flush_streams)
+
+
+class StreamAggregator:
+    """Applies the stream entries to the family hashes, see the module
+    docstring. Several aggregators may share a group."""
+
+    def __init__(
+        self,
+        redis: Redis,
+        redis_prefix: str = "prometheus",
+        group: str = AGGREGATOR_GROUP,
+        consumer: Optional[str] = None,
+        batch_size: int = AGGREGATE_BATCH_SIZE,
+        block: float = 1.0,
+        claim_idle: float = 60.0,
+    ):
+        self.redis = redis
+        self.key = f"{redis_prefix}:stream"
+        self.group = group
+        self.consumer = consumer or f"{socket.gethostname()}-{os.getpid()}"
+        self.batch_size = batch_size
+        self.block = block
+        self.claim_idle = claim_idle
+        self._stopped = threading.Event()
+
+    def create_group(self) -> None:
+        try:
+            self.redis.xgroup_create(
+                self.key, self.group, id="0", mkstream=True
+            )
+        except ResponseError as error:
+            if "BUSYGROUP" not in str(error):
+                raise
+
+    def _claim(self) -> list:
+        """Entries another consumer left pending for claim_idle seconds."""
+        _, entries, *_ = self.redis.xautoclaim(
+            self.key,
+            self.group,
+            self.consumer,
+            int(self.claim_idle * 1000),
+            count=self.batch_size,
+        )
+        return [entry for entry in entries if entry[1]]
+
+    def _read(self) -> list:
+        # [[key, entries]], or nothing once block elapsed
+        response = cast(
+            list,
+            self.redis.xreadgroup(
+                self.group,
+                self.consumer,
+                {self.key: ">"},
+                count=self.batch_size,
+                block=int(self.block * 1000),
+            ),
+        )
+        return response[0][1] if response else []
+
+    def _apply(self, entries: list) -> None:
+        batch = Spool(sys.maxsize)
+        expire = None
+        for _, fields in entries:
+            try:
+                ops = json.loads(fields[b"ops"])
+                entry_expire = int(fields[b"expire"])
+            except (KeyError, ValueError):
+                logger.warning("skipping malformed stream entry %r", fields)
+                continue
+            batch.add(
+                [
+                    (op, tuple(keys), field, value)
+                    for op, keys, field, value in ops
+                ]
+            )
+            expire = max(expire or 0, entry_expire)
+        pipe = self.redis.pipeline(transaction=True)
+        queue_ops(self.redis, pipe, batch.take(len(batch)), expire)
+        pipe.xack(self.key, self.group, *[entry[0] for entry in entries])
+        execute_increments(pipe)
+
+    def _trim(self) -> None:
+        """Drops the entries no consumer of the group still has to apply."""
+        pending = self.redis.xpending(self.key, self.group)
+        if pending["pending"]:
+            min_id = pending["min"]
+        else:
+            group = next(
+                group
+                for group in self.redis.xinfo_groups(self.key)
+                if group["name"] in (self.group, self.group.encode())
+            )
+            last_id = group["last-delivered-id"]
+            if isinstance(last_id, bytes):
+                last_id = last_id.decode()
+            milliseconds, sequence = last_id.split("-")
+            min_id = f"{milliseconds}-{int(sequence) + 1}"
+        self.redis.xtrim(self.key, minid=min_id, approximate=False)
+
+    def run_once(self) -> int:
+        """Applies a batch of entries, returns how many."""
+        entries = self._claim() or self._read()
+        if entries:
+            self._apply(entries)
+            self._trim()
+        return len(entries)
+
+    def run(self) -> None:
+        """Applies entries until stop() is called."""
+        self.create_group()
+        logger.info(
+            "aggregating %s as %s/%s", self.key, self.group, self.consumer
+        )
+        while not self._stopped.is_set():
+            try:
+                self.run_once()
+            except RedisError:  # unapplied entries stay pending
+                logger.exception("could not aggregate %s", self.key)
+                self._stopped.wait(self.block)
+
+    def stop(self) -> None:
+        self._stopped.set()
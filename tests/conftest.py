@@ -0,0 +1,53 @@
+"""Fixtures shared by the test cases.
+
+The test cases are unittest TestCases, the fixtures set attributes of the
+classes using them (with ``@pytest.mark.usefixtures``) rather than being
+passed as arguments.
+"""
+
+import json
+import os
+
+import pytest
+from redis.connection import parse_url
+
+
+def _redis_creds() -> dict:
+    """Arguments of the test Redis connection: REDIS_URL if set, else the
+    content of .redis.json (see the README)."""
+    url = os.environ.get("REDIS_URL")
+    if url:
+        return parse_url(url)
+    with open(".redis.json", encoding="utf8") as fd:
+        return json.load(fd)
+
+
+def sample_values(registry) -> dict:
+    """Values of the samples of registry by name and labels, _created
+    aside."""
+    return {
+        (sample.name, tuple(sorted(sample.labels.items()))): sample.value
+        for family in registry.collect()
+        for sample in family.samples
+        if not sample.name.endswith("_created")
+    }
+
+
+def exposition_samples(exposition: bytes) -> set:
+    """Sample lines of a text exposition, _created aside."""
+    return {
+        line
+        for line in exposition.decode("utf8").splitlines()
+        if line and not line.startswith("#") and "_created" not in line
+    }
+
+
+@pytest.fixture(scope="class")
+def redis_creds(request):
+    request.cls.redis_creds = _redis_creds()
+
+
+@pytest.fixture(scope="class")
+def samples(request):
+    request.cls.sample_values = staticmethod(sample_values)
+    request.cls.exposition_samples = staticmethod(exposition_samples)
@@ -1,8 +1,8 @@
-import json
 import time
 import unittest
 from unittest.mock import patch
 
+import pytest
 from prometheus_client import (
     CollectorRegistry,
     Counter,
@@ -11,26 +11,26 @@ from prometheus_client import (
     Summary,
     generate_latest,
 )
-from prometheus_distributed_client import setup
+from prometheus_client.openmetrics.exposition import (
+    generate_latest as generate_openmetrics,
+)
+from prometheus_distributed_client import exposition, setup
 from prometheus_distributed_client import redis
+from prometheus_distributed_client.exporter import Exporter
 from redis import Redis
 
 
+@pytest.mark.usefixtures("redis_creds")
 class PDCTestCase(unittest.TestCase):
 
-    @staticmethod
-    def _get_redis_creds():
-        with open(".redis.json", encoding="utf8") as fd:
-            return json.load(fd)
-
     def _clean(self):
-        Redis(**self._get_redis_creds()).flushdb()
+        Redis(**self.redis_creds).flushdb()
 
     def setUp(self):
         self.registry = CollectorRegistry()
         self.oregistry = CollectorRegistry()
         self._clean()
-        setup(redis=Redis(**self._get_redis_creds()))
+        setup(redis=Redis(**self.redis_creds))
         self.time_patch = patch("time.time")
         time_mock = self.time_patch.start()
         time_mock.return_value = 1549444326.4298077
@@ -44,6 +44,22 @@ class PDCTestCase(unittest.TestCase):
             return sorted(generate_latest(registry).decode("utf8").split("\n"))
 
         self.assertEqual(gen_latest(self.oregistry), gen_latest(self.registry))
+        self.compare_direct_rendering()
+
+    def compare_direct_rendering(self):
+        def lines(output):
+            return sorted(output.decode("utf8").split("\n"))
+
+        self.assertEqual(
+            lines(generate_latest(self.registry)),
+            lines(exposition.generate_latest(self.registry)),
+        )
+        openmetrics = exposition.generate_openmetrics(self.registry)
+        # prometheus_client turns colons of sample names into underscores
+        if b":" not in openmetrics:
+            self.assertEqual(
+                lines(generate_openmetrics(self.registry)), lines(openmetrics)
+            )
 
     def test_counter_no_label(self):
         metric = redis.Counter(
@@ -119,7 +135,7 @@ class PDCTestCase(unittest.TestCase):
         self._test_observe(redis.Gauge, Gauge, method="set")
 
     def test_expire(self):
-        setup(Redis(**self._get_redis_creds()), redis_expire=1)
+        setup(Redis(**self.redis_creds), redis_expire=1)
         metric = redis.Counter(
             "shruberry", "shruberry", registry=self.registry
         )
@@ -130,7 +146,7 @@ class PDCTestCase(unittest.TestCase):
         assert metric._redis_created.get() is None
 
     def test_prefix(self):
-        setup(Redis(**self._get_redis_creds()), redis_prefix="patang")
+        setup(Redis(**self.redis_creds), redis_prefix="patang")
         ametric = redis.Counter(
             "shruberry", "shruberry", registry=self.registry
         )
@@ -138,7 +154,7 @@ class PDCTestCase(unittest.TestCase):
         assert 1 == ametric._value.get()
         assert ametric._redis_created.get() is not None
 
-        setup(Redis(**self._get_redis_creds()), redis_prefix="eki")
+        setup(Redis(**self.redis_creds), redis_prefix="eki")
         bmetric = redis.Counter(
             "shruberry", "shruberry", registry=self.oregistry
         )
@@ -147,13 +163,13 @@ class PDCTestCase(unittest.TestCase):
         assert 10 == bmetric._value.get()
         assert bmetric._redis_created.get() is not None
 
-        setup(Redis(**self._get_redis_creds()), redis_prefix="patang")
+        setup(Redis(**self.redis_creds), redis_prefix="patang")
         assert 1 == ametric._value.get()
         assert ametric._redis_created.get() is not None
 
     def test_counter_expired_created(self):
         "testing that _created gets refresh on inc"
-        setup(Redis(**self._get_redis_creds()), redis_expire=2)
+        setup(Redis(**self.redis_creds), redis_expire=2)
         metric = redis.Counter(
             "shruberry", "shruberry", registry=self.registry
         )
@@ -167,7 +183,7 @@ class PDCTestCase(unittest.TestCase):
 
     def test_summary_expired_created(self):
         "testing that _created gets refresh on observe"
-        setup(Redis(**self._get_redis_creds()), redis_expire=2)
+        setup(Redis(**self.redis_creds), redis_expire=2)
         metric = redis.Summary(
             "request_duration", "request duration", registry=self.registry
         )
@@ -183,7 +199,7 @@ class PDCTestCase(unittest.TestCase):
 
     def test_histogram_expired_created(self):
         "testing that _created gets refresh on observe"
-        setup(Redis(**self._get_redis_creds()), redis_expire=2)
+        setup(Redis(**self.redis_creds), redis_expire=2)
         metric = redis.Histogram(
             "request_size", "request size", registry=self.registry
         )
@@ -196,3 +212,240 @@ class PDCTestCase(unittest.TestCase):
         assert metric._sum.get() is not None
         assert metric._count.get() is not None
         assert metric._redis_created.get() is not None
+
+    def test_max_series_overflow(self):
+        metric = redis.Counter(
+            "fleshwound",
+            "fleshwound",
+            ["cross"],
+            registry=self.registry,
+            max_series=2,
+        )
+        for value in ("eki", "patang", "ni", "shrubbery"):
+            metric.labels(value).inc()
+        metric.labels("eki").inc()
+        samples = {
+            sample.labels["cross"]: sample.value
+            for sample in metric.collect()[0].samples
+            if sample.name == "fleshwound_total"
+        }
+        self.assertEqual(
+            {"eki": 2.0, "patang": 1.0, "__overflow__": 2.0}, samples
+        )
+        self.assertEqual(2, metric.series_overflow)
+        self.assertEqual(
+            2, redis.SERIES_OVERFLOW.labels("fleshwound")._value.get()
+        )
+
+    def test_max_series_shared_between_processes(self):
+        setup(Redis(**self.redis_creds), max_series=1)
+        metric = redis.Counter(
+            "fleshwound", "fleshwound", ["cross"], registry=self.registry
+        )
+        other = redis.Counter(
+            "fleshwound", "fleshwound", ["cross"], registry=self.oregistry
+        )
+        metric.labels("eki").inc()
+        other.labels("patang").inc()
+        other.labels("eki").inc()
+        self.assertEqual(
+            ("__overflow__",), tuple(other._metrics)[0]
+        )
+        self.assertEqual(2, metric.labels("eki")._value.get())
+
+    def test_max_series_expire_refreshed(self):
+        setup(Redis(**self.redis_creds), max_series=10)
+        conn = Redis(**self.redis_creds)
+        metric = redis.Counter(
+            "fleshwound",
+            "fleshwound",
+            ["cross"],
+            registry=self.registry,
+            max_series=2,
+        )
+        metric.labels("eki").inc()
+        for key in ("prometheus_fleshwound:series", "prometheus:series"):
+            conn.expire(key, 5)
+        # no new label set, the admitted ones are kept all the same
+        metric.labels("eki").inc()
+        for key in ("prometheus_fleshwound:series", "prometheus:series"):
+            self.assertGreater(conn.ttl(key), 5)
+
+    def test_series_expire(self):
+        setup(Redis(**self.redis_creds), redis_series_expire=60)
+        metric = redis.Histogram(
+            "saysni",
+            "saysni",
+            ["cross"],
+            registry=self.registry,
+            buckets=(0, 2, 4),
+        )
+        metric.labels("black").observe(1)
+        metric.labels("knight").observe(3)
+        with patch("time.time", return_value=1549444326.4298077 + 120):
+            metric.labels("knight").observe(3)
+            self.assertEqual(
+                {"knight"},
+                {
+                    sample.labels["cross"]
+                    for sample in metric.collect()[0].samples
+                },
+            )
+            self.assertEqual(0, metric.prune_stale())
+        # 4 buckets, _count, _sum and _created for the knight only
+        self.assertEqual(
+            7, Redis(**self.redis_creds).hlen("prometheus_saysni")
+        )
+
+    def test_rollups(self):
+        metric = redis.Histogram(
+            "saysni",
+            "saysni",
+            ["cross", "knight"],
+            registry=None,
+            buckets=(0, 2, 4),
+            rollups=[("cross",)],
+            rollup_registry=self.registry,
+        )
+        ometric = Histogram(
+            "cross:saysni",
+            "saysni (sum by cross)",
+            ["cross"],
+            registry=self.oregistry,
+            buckets=(0, 2, 4),
+        )
+        for cross, knight, amount in (
+            ("black", "ni", 1),
+            ("black", "eki", 3),
+            ("", "ni", 5),
+        ):
+            metric.labels(cross, knight).observe(amount)
+            ometric.labels(cross).observe(amount)
+        self.compate_to_original()
+
+    def test_read_cache(self):
+        with patch(
+            "prometheus_distributed_client.config.start_invalidation_listener"
+        ) as start:
+            setup(Redis(**self.redis_creds), read_cache_size=10)
+            metric = redis.Gauge(
+                "shruberry", "shruberry", registry=self.registry
+            )
+            metric.set(1)
+            # the invalidation listener is started by the first cached read
+            start.assert_not_called()
+            self.assertEqual(1, metric.get())
+            start.assert_called_once()
+        with patch.object(Redis, "hget") as hget:
+            self.assertEqual(1, metric.get())
+        hget.assert_not_called()
+        metric.set(2)
+        self.assertEqual(2, metric.get())
+
+    def test_gauge_modes(self):
+        for mode, expected in ("max", 5), ("min", 1), ("livesum", 3):
+            metric = redis.Gauge(
+                f"queue_{mode}",
+                "queue depth",
+                registry=self.registry,
+                multiprocess_mode=mode,
+            )
+            for value in (2, 5, 1, 3):
+                metric.set(value)
+            self.assertEqual(expected, metric.get())
+
+    def test_gauge_mostrecent(self):
+        metric = redis.Gauge(
+            "queue",
+            "queue",
+            registry=self.registry,
+            multiprocess_mode="mostrecent",
+        )
+        metric._value.set(2, timestamp=20)
+        metric._value.set(1, timestamp=10)
+        self.assertEqual(2, metric.get())
+        metric._value.set(3, timestamp=30)
+        self.assertEqual(3, metric.get())
+
+    def test_created_sent_once(self):
+        metric = redis.Counter(
+            "shruberry", "shruberry", registry=self.registry
+        )
+        with patch.object(Redis, "hsetnx") as hsetnx:
+            for _ in range(3):
+                metric.inc()
+        self.assertEqual(1, hsetnx.call_count)
+
+    def test_created_family(self):
+        setup(Redis(**self.redis_creds), created="family")
+        self._test_observe(redis.Histogram, Histogram, buckets=(0, 2, 4))
+        fields = Redis(**self.redis_creds).hkeys("prometheus_saysni")
+        self.assertEqual(
+            [b"_created:{}"], [f for f in fields if b"_created" in f]
+        )
+
+    def test_created_disabled(self):
+        setup(Redis(**self.redis_creds), created="disabled")
+        metric = redis.Summary(
+            "saysni", "saysni", ["cross"], registry=self.registry
+        )
+        metric.labels("black").observe(1)
+        self.assertEqual(
+            ["saysni_count", "saysni_sum"],
+            sorted(s.name for s in metric.collect()[0].samples),
+        )
+
+    def test_compact_field_encoding(self):
+        setup(Redis(**self.redis_creds), redis_field_encoding="compact")
+        self._test_observe(redis.Histogram, Histogram, buckets=(0, 2, 4))
+        fields = Redis(**self.redis_creds).hkeys("prometheus_saysni")
+        self.assertTrue(all(field.startswith(b"~") for field in fields))
+        self.assertIn(b"~b|black|+Inf", fields)
+
+    def test_field_encoding_migration(self):
+        metric = redis.Counter(
+            "fleshwound", "fleshwound", ["cross"], registry=self.registry
+        )
+        ometric = Counter(
+            "fleshwound", "fleshwound", ["cross"], registry=self.oregistry
+        )
+        metric.labels("e|k\\i").inc(2)
+        setup(Redis(**self.redis_creds), redis_field_encoding="compact")
+        self.registry = CollectorRegistry()
+        metric = redis.Counter(
+            "fleshwound", "fleshwound", ["cross"], registry=self.registry
+        )
+        metric.labels("e|k\\i").inc(3)
+        ometric.labels("e|k\\i").inc(5)
+        self.compate_to_original()
+
+    def test_exporter_keeps_ttl(self):
+        setup(Redis(**self.redis_creds), redis_expire=100)
+        metric = redis.Gauge("shruberry", "shruberry", registry=self.registry)
+        metric.set(2)
+        conn = Redis(**self.redis_creds)
+        conn.expire("prometheus_shruberry", 5)
+        self.assertIn(b"shruberry 2.0", b"".join(Exporter().stream()))
+        self.assertLessEqual(conn.ttl("prometheus_shruberry"), 5)
+        metric.collect()
+        self.assertGreater(conn.ttl("prometheus_shruberry"), 5)
+
+    def test_exporter_families(self):
+        metric = redis.Histogram(
+            "saysni", "saysni", ["cross"], registry=self.registry, buckets=[1]
+        )
+        redis.Counter("fleshwound", "fleshwound", registry=self.registry)
+        metric.labels("black").observe(2)
+        registry = Exporter().registry()
+        self.assertEqual(
+            sorted(
+                generate_latest(self.registry)
+                .replace(
+                    b"# HELP fleshwound_total fleshwound\n"
+                    b"# TYPE fleshwound_total counter\n",
+                    b"",
+                )
+                .split(b"\n")
+            ),
+            sorted(exposition.generate_latest(registry).split(b"\n")),
+        )
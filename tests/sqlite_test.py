@@ -1,4 +1,7 @@
+import os
 import sqlite3
+import tempfile
+import threading
 import time
 import unittest
 from unittest.mock import patch
@@ -11,7 +14,10 @@ from prometheus_client import (
     Summary,
     generate_latest,
 )
-from prometheus_distributed_client import setup
+from prometheus_client.openmetrics.exposition import (
+    generate_latest as generate_openmetrics,
+)
+from prometheus_distributed_client import Backend, exposition, setup
 from prometheus_distributed_client import sqlite as sqlite_metrics
 
 
@@ -47,6 +53,22 @@ class PDCTestCase(unittest.TestCase):
             return sorted(generate_latest(registry).decode("utf8").split("\n"))
 
         self.assertEqual(gen_latest(self.oregistry), gen_latest(self.registry))
+        self.compare_direct_rendering()
+
+    def compare_direct_rendering(self):
+        def lines(output):
+            return sorted(output.decode("utf8").split("\n"))
+
+        self.assertEqual(
+            lines(generate_latest(self.registry)),
+            lines(exposition.generate_latest(self.registry)),
+        )
+        openmetrics = exposition.generate_openmetrics(self.registry)
+        # prometheus_client turns colons of sample names into underscores
+        if b":" not in openmetrics:
+            self.assertEqual(
+                lines(generate_openmetrics(self.registry)), lines(openmetrics)
+            )
 
     def test_counter_no_label(self):
         metric = sqlite_metrics.Counter(
@@ -123,3 +145,152 @@ class PDCTestCase(unittest.TestCase):
     def test_gauge(self):
         self._test_observe(sqlite_metrics.Gauge, Gauge, method="set")
 
+    def test_max_series_overflow(self):
+        metric = sqlite_metrics.Counter(
+            "fleshwound",
+            "fleshwound",
+            ["cross"],
+            registry=self.registry,
+            max_series=2,
+        )
+        for value in ("eki", "patang", "ni", "shrubbery"):
+            metric.labels(value).inc()
+        metric.labels("eki").inc()
+        samples = {
+            sample.labels["cross"]: sample.value
+            for sample in metric.collect()[0].samples
+            if sample.name == "fleshwound_total"
+        }
+        self.assertEqual(
+            {"eki": 2.0, "patang": 1.0, "__overflow__": 2.0}, samples
+        )
+        self.assertEqual(2, metric.series_overflow)
+        self.assertEqual(
+            2,
+            sqlite_metrics.SERIES_OVERFLOW.labels("fleshwound")._value.get(),
+        )
+
+    def test_max_series_concurrent_admission(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, "metrics.db")
+            sqlite3.connect(path).close()
+            barrier = threading.Barrier(8)
+
+            def admit(index):
+                metric = sqlite_metrics.Counter(
+                    "fleshwound",
+                    "fleshwound",
+                    ["cross"],
+                    registry=None,
+                    backend=Backend(
+                        sqlite=sqlite3.connect(path, timeout=10)
+                    ),
+                    max_series=3,
+                )
+                metric._target.sqlite  # tables created before the race
+                barrier.wait()
+                metric._admit_series((str(index),))
+
+            threads = [
+                threading.Thread(target=admit, args=(index,))
+                for index in range(8)
+            ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.assertEqual(
+                3,
+                sqlite3.connect(path)
+                .execute("SELECT COUNT(*) FROM metrics_series")
+                .fetchone()[0],
+            )
+
+    def test_rollups(self):
+        metric = sqlite_metrics.Counter(
+            "fleshwound",
+            "fleshwound",
+            ["cross", "knight"],
+            registry=None,
+            rollups=[("cross",)],
+            rollup_registry=self.registry,
+        )
+        ometric = Counter(
+            "cross:fleshwound",
+            "fleshwound (sum by cross)",
+            ["cross"],
+            registry=self.oregistry,
+        )
+        for cross, knight, amount in (
+            ("black", "ni", 1),
+            ("black", "eki", 3),
+            ("", "ni", 5),
+        ):
+            metric.labels(cross, knight).inc(amount)
+            ometric.labels(cross).inc(amount)
+        self.compate_to_original()
+
+    def test_read_cache(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, "metrics.db")
+            conn = sqlite3.connect(path)
+            setup(sqlite=conn, read_cache_size=10)
+            metric = sqlite_metrics.Gauge(
+                "shruberry", "shruberry", registry=self.registry
+            )
+            metric.set(1)
+            self.assertEqual(1, metric.get())
+            metric.set(2)
+            self.assertEqual(2, metric.get())
+            other = sqlite3.connect(path)
+            other.execute("UPDATE metrics SET value = 3")
+            other.commit()
+            self.assertEqual(3, metric.get())
+            other.close()
+            conn.close()
+
+    def test_gauge_modes(self):
+        for mode, expected in ("max", 5), ("min", 1), ("livesum", 3):
+            metric = sqlite_metrics.Gauge(
+                f"queue_{mode}",
+                "queue depth",
+                registry=self.registry,
+                multiprocess_mode=mode,
+            )
+            for value in (2, 5, 1, 3):
+                metric.set(value)
+            self.assertEqual(expected, metric.get())
+
+    def test_gauge_mostrecent(self):
+        metric = sqlite_metrics.Gauge(
+            "queue",
+            "queue",
+            registry=self.registry,
+            multiprocess_mode="mostrecent",
+        )
+        metric._value.set(2, timestamp=20)
+        metric._value.set(1, timestamp=10)
+        self.assertEqual(2, metric.get())
+        metric._value.set(3, timestamp=30)
+        self.assertEqual(3, metric.get())
+
+    def test_created_family(self):
+        setup(sqlite=self.sqlite_conn, created="family")
+        self._test_observe(
+            sqlite_metrics.Histogram, Histogram, buckets=(0, 2, 4)
+        )
+        rows = self.sqlite_conn.execute(
+            "SELECT subkey FROM metrics WHERE subkey LIKE '_created:%'"
+        ).fetchall()
+        self.assertEqual([("_created:{}",)], rows)
+
+    def test_created_disabled(self):
+        setup(sqlite=self.sqlite_conn, created="disabled")
+        metric = sqlite_metrics.Summary(
+            "saysni", "saysni", ["cross"], registry=self.registry
+        )
+        metric.labels("black").observe(1)
+        self.assertEqual(
+            ["saysni_count", "saysni_sum"],
+            sorted(s.name for s in metric.collect()[0].samples),
+        )
@@ -0,0 +1,178 @@
+import sqlite3
+import unittest
+
+import pytest
+from prometheus_client import CollectorRegistry
+from prometheus_distributed_client import redis, setup, sqlite
+from prometheus_distributed_client.config import (
+    _ROUTES,
+    DEFAULT_BACKEND,
+    Backend,
+    bind_registry,
+    route,
+)
+from redis import Redis
+
+
+@pytest.mark.usefixtures("redis_creds")
+class BackendRoutingTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.default = Redis(**self.redis_creds)
+        self.hot = Redis(**{**self.redis_creds, "db": 1})
+        self.default.flushdb()
+        self.hot.flushdb()
+        setup(redis=self.default)
+        self.hot_backend = Backend(
+            redis=self.hot, redis_prefix="hot", redis_expire=60
+        )
+        self.registry = CollectorRegistry()
+
+    def tearDown(self):
+        _ROUTES.clear()
+        self.default.flushdb()
+        self.hot.flushdb()
+
+    def test_explicit_backend(self):
+        counter = redis.Counter(
+            "requests",
+            "...",
+            ["path"],
+            registry=self.registry,
+            backend=self.hot_backend,
+        )
+        counter.labels("/").inc(2)
+        self.assertIs(self.hot_backend, counter.labels("/")._target)
+        self.assertEqual(
+            b"2", self.hot.hget("hot_requests", '_total:{"path":"/"}')
+        )
+        self.assertLessEqual(self.hot.ttl("hot_requests"), 60)
+        self.assertEqual([], self.default.keys("*requests*"))
+        self.assertIn(b"requests", self.hot.hkeys("hot:metadata"))
+
+    def test_route_by_prefix(self):
+        route("hot_", self.hot_backend)
+        route("hot_cold_", DEFAULT_BACKEND)
+        hot = redis.Gauge("hot_queue", "...", registry=self.registry)
+        cold = redis.Gauge("hot_cold_queue", "...", registry=self.registry)
+        other = redis.Gauge("queue", "...", registry=self.registry)
+        for gauge in (hot, cold, other):
+            gauge.set(1)
+        self.assertEqual([b"hot_hot_queue"], self.hot.keys("hot_*"))
+        self.assertEqual(
+            [b"prometheus_hot_cold_queue", b"prometheus_queue"],
+            sorted(self.default.keys("prometheus_*")),
+        )
+
+    def test_registry_binding(self):
+        bind_registry(self.registry, self.hot_backend)
+        summary = redis.Summary("latency", "...", registry=self.registry)
+        summary.observe(3)
+        self.assertEqual(b"3", self.hot.hget("hot_latency", "_sum:{}"))
+        samples = {
+            sample.name: sample.value
+            for family in self.registry.collect()
+            for sample in family.samples
+        }
+        self.assertEqual(3, samples["latency_sum"])
+
+    def test_rollups_follow_their_metric(self):
+        counter = redis.Counter(
+            "hits",
+            "...",
+            ["path", "code"],
+            registry=self.registry,
+            rollups=[["code"]],
+            backend=self.hot_backend,
+        )
+        counter.labels("/", "200").inc()
+        self.assertEqual(
+            b"1", self.hot.hget("hot_code:hits", '_total:{"code":"200"}')
+        )
+
+    def test_overflow_counted_in_own_backend(self):
+        counter = redis.Counter(
+            "requests",
+            "...",
+            ["path"],
+            registry=self.registry,
+            backend=self.hot_backend,
+            max_series=1,
+        )
+        counter.labels("/a").inc()
+        counter.labels("/b").inc()
+        self.assertEqual(
+            b"1",
+            self.hot.hget(
+                "hot_prometheus_distributed_series_overflow",
+                '_total:{"metric":"requests"}',
+            ),
+        )
+        self.assertEqual([], self.default.keys("*overflow*"))
+
+        conn = sqlite3.connect(":memory:")
+        counter = sqlite.Counter(
+            "requests",
+            "...",
+            ["path"],
+            registry=CollectorRegistry(),
+            backend=Backend(sqlite=conn),
+            max_series=1,
+        )
+        counter.labels("/a").inc()
+        counter.labels("/b").inc()
+        self.assertEqual(
+            [(1,)],
+            conn.execute(
+                "SELECT value FROM metrics WHERE metric_key = "
+                "'prometheus_distributed_series_overflow' "
+                "AND subkey LIKE '_total:%'"
+            ).fetchall(),
+        )
+
+    def test_backend_kind_mismatch(self):
+        with self.assertRaises(ValueError):
+            sqlite.Counter(
+                "requests",
+                "...",
+                registry=self.registry,
+                backend=self.hot_backend,
+            )
+
+
+@pytest.mark.usefixtures("redis_creds")
+class FamilyCreatedTestCase(unittest.TestCase):
+    """_created of family wide created, on both backends."""
+
+    def test_labelled_summaries(self):
+        conn = Redis(**self.redis_creds)
+        conn.flushdb()
+        self.addCleanup(conn.flushdb)
+        for module, backend in (
+            (redis, Backend(redis=conn, created="family")),
+            (
+                sqlite,
+                Backend(sqlite=sqlite3.connect(":memory:"), created="family"),
+            ),
+        ):
+            summary = module.Summary(
+                "size",
+                "...",
+                ["kind"],
+                registry=CollectorRegistry(),
+                backend=backend,
+            )
+            summary.labels("a").observe(1)
+            summary.labels("b").observe(2)
+            self.assertEqual(
+                [{"kind": "a"}, {"kind": "b"}],
+                sorted(
+                    (
+                        sample.labels
+                        for sample in summary.collect()[0].samples
+                        if sample.name == "size_created"
+                    ),
+                    key=lambda labels: labels["kind"],
+                ),
+                module.__name__,
+            )
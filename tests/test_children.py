@@ -0,0 +1,56 @@
+import unittest
+
+import pytest
+from prometheus_client import CollectorRegistry
+from prometheus_distributed_client import setup
+from prometheus_distributed_client.children import BucketLayout
+from prometheus_distributed_client.sqlite import Counter, Histogram
+
+
+@pytest.mark.usefixtures("samples")
+class ChildrenTestCase(unittest.TestCase):
+
+    def setUp(self):
+        setup(sqlite=":memory:")
+        self.registry = CollectorRegistry()
+
+    def test_shared_bucket_layout(self):
+        histogram = Histogram(
+            "latency",
+            "...",
+            ["path"],
+            buckets=(1, 2),
+            registry=self.registry,
+            rollups=[[]],
+        )
+        child = histogram.labels("/")
+        self.assertIs(histogram._bucket_layout, child._bucket_layout)
+        self.assertIs(
+            histogram._bucket_layout, histogram.rollups[()]._bucket_layout
+        )
+        self.assertEqual(("1.0", "2.0", "+Inf"), child._bucket_layout.les)
+        self.assertFalse(hasattr(child._buckets[0], "__dict__"))
+        child.observe(1.5)
+        bucket = ("latency_bucket", (("le", "2.0"), ("path", "/")))
+        self.assertEqual(1, self.sample_values(self.registry)[bucket])
+        with self.assertRaises(ValueError):
+            BucketLayout((2, 1))
+
+    def test_bounded_children(self):
+        counter = Counter(
+            "requests", "...", ["path"], registry=self.registry, max_children=2
+        )
+        counter.labels("/a").inc()
+        counter.labels("/b").inc()
+        counter.labels("/a").inc()
+        counter.labels("/c").inc()  # evicts /b
+        self.assertEqual([("/a",), ("/c",)], list(counter._metrics))
+        counter.labels("/b").inc()  # values outlive their child
+        self.assertEqual(
+            {
+                ("requests_total", (("path", "/a"),)): 2,
+                ("requests_total", (("path", "/b"),)): 2,
+                ("requests_total", (("path", "/c"),)): 1,
+            },
+            self.sample_values(self.registry),
+        )
@@ -0,0 +1,77 @@
+import os
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import unittest
+
+from prometheus_client import CollectorRegistry
+from prometheus_distributed_client import setup, sqlite
+from prometheus_distributed_client.config import DEFAULT_BACKEND
+
+IMPORTS = """
+import sys
+import prometheus_distributed_client.sqlite
+print(",".join(sorted({"redis", "sqlite3"} & set(sys.modules))))
+"""
+
+
+class ColdStartTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = CollectorRegistry()
+
+    def test_backends_imported_on_setup(self):
+        loaded = subprocess.run(
+            [sys.executable, "-c", IMPORTS],
+            capture_output=True,
+            check=True,
+            text=True,
+            env={**os.environ, "PYTHONPATH": os.getcwd()},
+        ).stdout.strip()
+        self.assertEqual("", loaded)
+
+    def test_path_opened_by_first_write(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "metrics.db")
+            setup(sqlite=path)
+            counter = sqlite.Counter(
+                "jobs", "...", ["kind"], registry=self.registry
+            )
+            self.assertFalse(os.path.exists(path))
+            counter.labels("cron").inc()
+            conn = sqlite3.connect(path)
+            self.assertEqual(
+                {'_created:{"kind":"cron"}', '_total:{"kind":"cron"}'},
+                {row[0] for row in conn.execute("SELECT subkey FROM metrics")},
+            )
+            self.assertIn(
+                ("jobs",),
+                conn.execute("SELECT metric_key FROM metrics_metadata"),
+            )
+            conn.close()
+            DEFAULT_BACKEND.sqlite.close()
+
+    def test_schema_created_once(self):
+        conn = sqlite3.connect(":memory:")
+        statements = []
+        conn.set_trace_callback(statements.append)
+        setup(sqlite=conn)
+        self.assertTrue(any("CREATE TABLE" in sql for sql in statements))
+        statements.clear()
+        setup(sqlite=conn)
+        self.assertEqual(1, len(statements))  # the lookup of the tables
+        self.assertIn("sqlite_master", statements[0])
+
+    def test_created_on_first_write(self):
+        conn = sqlite3.connect(":memory:")
+        setup(sqlite=conn)
+        summary = sqlite.Summary("duration", "...", registry=self.registry)
+        self.assertEqual(
+            0, conn.execute("SELECT COUNT(*) FROM metrics").fetchone()[0]
+        )
+        summary.observe(2)
+        self.assertEqual(
+            {"_count:{}", "_created:{}", "_sum:{}"},
+            {row[0] for row in conn.execute("SELECT subkey FROM metrics")},
+        )
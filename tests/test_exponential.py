@@ -0,0 +1,193 @@
+import random
+import sqlite3
+import time
+import unittest
+from unittest import mock
+
+import pytest
+from prometheus_client import CollectorRegistry
+from prometheus_client.samples import BucketSpan
+from prometheus_distributed_client import redis, setup, sqlite
+from prometheus_distributed_client.exponential import (
+    ExponentialLayout,
+    upper_bound,
+)
+from prometheus_distributed_client.exporter import Exporter
+from prometheus_distributed_client.fields import decode_field
+from redis import Redis
+
+
+def _samples(registry):
+    return {
+        (sample.name, tuple(sorted(sample.labels.items()))): sample
+        for family in registry.collect()
+        for sample in family.samples
+        if not sample.name.endswith("_created")
+    }
+
+
+class ExponentialLayoutTestCase(unittest.TestCase):
+
+    def test_index(self):
+        rng = random.Random(0)
+        for schema in (-2, 0, 1, 3, 8):
+            layout = ExponentialLayout(schema)
+            for value in [1, 2, 0.5, 1024] + [
+                10 ** rng.uniform(-6, 6) for _ in range(200)
+            ]:
+                index = layout.index(value)
+                self.assertLessEqual(value, upper_bound(index, schema))
+                self.assertGreater(value, upper_bound(index - 1, schema))
+
+    def test_key(self):
+        layout = ExponentialLayout(0, zero_threshold=0.01)
+        self.assertEqual("p1", layout.key(2))
+        self.assertEqual("n2", layout.key(-3))
+        self.assertEqual("z", layout.key(-0.005))
+        self.assertIsNone(layout.key(float("nan")))
+        self.assertEqual("p1024", layout.key(float("inf")))
+        with self.assertRaises(ValueError):
+            ExponentialLayout(9)
+
+
+class SqliteExponentialTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.conn = sqlite3.connect(":memory:")
+        setup(sqlite=self.conn)
+        self.registry = CollectorRegistry()
+
+    def test_classic_rendering(self):
+        histogram = sqlite.ExponentialHistogram(
+            "latency",
+            "...",
+            ["path"],
+            registry=self.registry,
+            schema=2,
+            render_schema=0,
+        )
+        for value in (0, 0.3, 3, 3.1, -4, 1000):
+            histogram.labels("/").observe(value)
+        rows = self.conn.execute(
+            "SELECT COUNT(*) FROM metrics WHERE subkey LIKE '_ebucket:%'"
+        ).fetchone()[0]
+        self.assertEqual(5, rows)  # 3 and 3.1 share a bucket
+        buckets = {
+            labels[0][1]: sample.value
+            for (name, labels), sample in _samples(self.registry).items()
+            if name == "latency_bucket"
+        }
+        self.assertEqual(
+            {
+                "-2.0": 1,
+                "2.938735877055719e-39": 2,
+                "0.5": 3,
+                "4.0": 5,
+                "1024.0": 6,
+                "+Inf": 6,
+            },
+            buckets,
+        )
+        samples = _samples(self.registry)
+        self.assertEqual(6, samples[("latency_count", (("path", "/"),))].value)
+
+    def test_native_rendering(self):
+        histogram = sqlite.ExponentialHistogram(
+            "latency", "...", registry=self.registry, render="native"
+        )
+        for value in (1, 1.1, 2, -4, 0):
+            histogram.observe(value)
+        native = _samples(self.registry)[("latency", ())].native_histogram
+        self.assertEqual(5, native.count_value)
+        self.assertEqual(1, native.zero_count)
+        self.assertEqual(
+            [BucketSpan(0, 1), BucketSpan(1, 1), BucketSpan(5, 1)],
+            native.pos_spans,
+        )
+        self.assertEqual([1, 0, 0], native.pos_deltas)
+        self.assertEqual([BucketSpan(16, 1)], native.neg_spans)
+
+    def test_exported(self):
+        sqlite.ExponentialHistogram(
+            "latency", "...", registry=self.registry, schema=0
+        ).observe(3)
+        exported = b"".join(Exporter().stream())
+        self.assertIn(b'latency_bucket{le="4.0"} 1.0', exported)
+
+
+@pytest.mark.usefixtures("redis_creds")
+class RedisExponentialTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.redis = Redis(**self.redis_creds)
+        self.redis.flushdb()
+        self.registry = CollectorRegistry()
+
+    def tearDown(self):
+        self.redis.flushdb()
+
+    def test_sparse_fields(self):
+        for encoding in ("json", "compact"):
+            setup(redis=self.redis, redis_field_encoding=encoding)
+            histogram = redis.ExponentialHistogram(
+                f"latency_{encoding}",
+                "...",
+                ["path"],
+                registry=self.registry,
+                schema=0,
+                rollups=[[]],
+            )
+            histogram.labels("/").observe(3)
+            histogram.labels("/").observe(0.75)
+        self.assertEqual(
+            {
+                b'_count:{"path":"/"}',
+                b'_sum:{"path":"/"}',
+                b'_created:{"path":"/"}',
+                b'_ebucket:{"__bucket__":"p2","path":"/"}',
+                b'_ebucket:{"__bucket__":"p0","path":"/"}',
+            },
+            set(self.redis.hkeys("prometheus_latency_json")),
+        )
+        self.assertIn(
+            b"~e|/|p2", self.redis.hkeys("prometheus_latency_compact")
+        )
+        samples = _samples(self.registry)
+        for name in ("latency_json", "latency_compact"):
+            bucket = (f"{name}_bucket", (("le", "4.0"), ("path", "/")))
+            self.assertEqual(2, samples[bucket].value)
+        rollup = samples[("all:latency_json_bucket", (("le", "1.0"),))]
+        self.assertEqual(1, rollup.value)
+
+    def test_pruned_buckets(self):
+        now = time.time()
+        for encoding in ("json", "compact"):
+            setup(
+                redis=self.redis,
+                redis_field_encoding=encoding,
+                redis_series_expire=60,
+            )
+            histogram = redis.ExponentialHistogram(
+                f"latency_{encoding}",
+                "...",
+                ["path"],
+                registry=self.registry,
+                schema=0,
+            )
+            key = f"prometheus_latency_{encoding}"
+            histogram.labels("/a").observe(0.003)
+            histogram.labels("/a").observe(5000)
+            histogram.labels("/a|b").observe(3)
+            with mock.patch("time.time", return_value=now + 120):
+                histogram.labels("/a|b").observe(3)
+                self.assertEqual(1, histogram.prune_stale())
+            self.assertEqual(
+                {"/a|b"},
+                {
+                    decode_field(field.decode("utf8"), ["path"])[1]["path"]
+                    for field in self.redis.hkeys(key)
+                },
+            )
+            with mock.patch("time.time", return_value=now + 240):
+                self.assertEqual(1, histogram.prune_stale())
+            self.assertEqual({}, self.redis.hgetall(key))
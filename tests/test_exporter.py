@@ -0,0 +1,83 @@
+import gzip
+import os
+import sqlite3
+import tempfile
+import threading
+import unittest
+from unittest import mock
+from urllib.request import Request, urlopen
+
+from prometheus_client import CollectorRegistry, generate_latest
+from prometheus_distributed_client import setup
+from prometheus_distributed_client import sqlite as sqlite_metrics
+from prometheus_distributed_client.exporter import Exporter, make_server
+
+
+class ExporterTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp_dir.name, "metrics.db")
+        self.registry = CollectorRegistry()
+        # declared before setup, as in modules imported at startup
+        self.histogram = sqlite_metrics.Histogram(
+            "saysni",
+            "saysni",
+            ["cross"],
+            registry=self.registry,
+            buckets=(1, 5),
+            unit="seconds",
+        )
+        setup(sqlite=sqlite3.connect(self.path, check_same_thread=False))
+        self.counter = sqlite_metrics.Counter(
+            "fleshwound", "fleshwound", ["cross"], registry=self.registry
+        )
+        sqlite_metrics.Gauge("shruberry", "shruberry", registry=self.registry)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def _serve(self):
+        server = make_server("127.0.0.1", 0, Exporter())
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        return f"http://127.0.0.1:{server.server_port}/metrics"
+
+    def test_serves_stored_families(self):
+        self.histogram.labels("black").observe(2)
+        self.counter.labels("knight").inc(3)
+        with urlopen(self._serve()) as response:
+            body = response.read()
+        self.assertEqual(
+            sorted(generate_latest(self.registry).split(b"\n")),
+            # the gauge was never set
+            sorted(
+                body.split(b"\n")
+                + [b"# HELP shruberry shruberry", b"# TYPE shruberry gauge"]
+            ),
+        )
+
+    def test_gzip_and_openmetrics(self):
+        self.counter.labels("knight").inc(3)
+        request = Request(
+            self._serve(),
+            headers={
+                "Accept": "application/openmetrics-text; version=1.0.0",
+                "Accept-Encoding": "gzip",
+            },
+        )
+        with urlopen(request) as response:
+            self.assertEqual("gzip", response.headers["Content-Encoding"])
+            body = gzip.decompress(response.read())
+        self.assertIn(b'fleshwound_total{cross="knight"} 3.0\n', body)
+        self.assertTrue(body.endswith(b"# EOF\n"))
+
+    def test_metadata_not_written_back(self):
+        self.counter.labels("knight").inc(3)
+        with mock.patch.object(
+            sqlite_metrics.SqliteMetricMixin, "_store_metadata"
+        ) as store:
+            body = b"".join(Exporter().stream())
+        self.assertIn(b'fleshwound_total{cross="knight"} 3.0\n', body)
+        store.assert_not_called()
@@ -0,0 +1,61 @@
+import sqlite3
+import unittest
+
+from prometheus_client import CollectorRegistry, Counter, generate_latest
+from prometheus_distributed_client import exposition, setup
+from prometheus_distributed_client import sqlite as sqlite_metrics
+
+
+class ExpositionTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.conn = sqlite3.connect(":memory:")
+        setup(sqlite=self.conn)
+        self.registry = CollectorRegistry()
+
+    def tearDown(self):
+        self.conn.close()
+
+    def test_other_collectors(self):
+        sqlite_metrics.Counter("eki", "eki", registry=self.registry).inc()
+        Counter("patang", "patang", registry=self.registry).inc(2)
+        self.assertEqual(
+            sorted(generate_latest(self.registry).split(b"\n")),
+            sorted(exposition.generate_latest(self.registry).split(b"\n")),
+        )
+
+    def test_openmetrics_groups_label_sets(self):
+        metric = sqlite_metrics.Histogram(
+            "saysni",
+            "saysni",
+            ["cross"],
+            registry=self.registry,
+            buckets=(2, 10),
+        )
+        metric.labels("black").observe(1)
+        metric.labels("knight").observe(3)
+        lines = exposition.generate_openmetrics(self.registry).split(b"\n")
+        self.assertEqual(b"# EOF", lines[-2])
+        self.assertEqual(
+            [
+                b'saysni_bucket{cross="black",le="2.0"} 1.0',
+                b'saysni_bucket{cross="black",le="10.0"} 1.0',
+                b'saysni_bucket{cross="black",le="+Inf"} 1.0',
+                b'saysni_count{cross="black"} 1.0',
+                b'saysni_sum{cross="black"} 1.0',
+            ],
+            [line for line in lines[2:7] if b"_created" not in line],
+        )
+        self.assertTrue(lines[7].startswith(b'saysni_created{cross="black"}'))
+        self.assertTrue(lines[8].startswith(b"saysni_bucket{cross=\"knight\""))
+
+    def test_fragment_cache_bound(self):
+        cache = exposition.FragmentCache(max_size=2)
+        metric = sqlite_metrics.Gauge(
+            "ni", "ni", ["cross"], registry=self.registry
+        )
+        for cross in ("a", "b", "c"):
+            metric.labels(cross).set(1)
+        output = exposition.generate_latest(self.registry, cache=cache)
+        self.assertIn(b'ni{cross="c"} 1.0', output)
+        self.assertEqual(2, len(cache._entries))
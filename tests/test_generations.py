@@ -0,0 +1,186 @@
+import sqlite3
+import unittest
+from unittest import mock
+
+import pytest
+from prometheus_client import CollectorRegistry
+from prometheus_distributed_client import Backend, redis, sqlite
+from prometheus_distributed_client.exposition import generate_latest
+from prometheus_distributed_client.resilience import queue_ops
+from redis import Redis
+
+
+@pytest.mark.usefixtures("redis_creds", "samples")
+class RedisGenerationsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.redis = Redis(**self.redis_creds)
+        self.redis.flushdb()
+        self.backend = Backend(redis=self.redis)
+        self.registry = CollectorRegistry()
+
+    def tearDown(self):
+        self.redis.flushdb()
+
+    def _generations(self):
+        return {
+            key.decode("utf8"): int(value)
+            for key, value in self.redis.hgetall(
+                "prometheus:generations"
+            ).items()
+        }
+
+    def test_bumped_by_writes(self):
+        jobs = redis.Counter(
+            "jobs",
+            "...",
+            ["kind"],
+            registry=self.registry,
+            backend=self.backend,
+            rollups=[[]],
+        )
+        jobs.labels("a").inc()
+        generations = self._generations()
+        # _created, then the value, each also written to the rollup
+        self.assertEqual(2, generations["prometheus_jobs"])
+        self.assertEqual(2, generations["prometheus_all:jobs"])
+        redis.Gauge(
+            "level", "...", registry=self.registry, backend=self.backend
+        ).set(1)
+        self.assertEqual(1, self._generations()["prometheus_level"])
+
+        pipe = self.redis.pipeline()
+        queue_ops(
+            self.redis,
+            pipe,
+            [
+                ("inc", ("prometheus_jobs",), '_total:{"kind":"a"}', 1.0),
+                (
+                    "generation",
+                    ("prometheus:generations",),
+                    "prometheus_jobs",
+                    1,
+                ),
+            ],
+            60,
+        )
+        pipe.execute()
+        self.assertEqual(3, self._generations()["prometheus_jobs"])
+
+    def test_unchanged_families_not_read(self):
+        jobs = redis.Counter(
+            "jobs", "...", registry=self.registry, backend=self.backend
+        )
+        level = redis.Gauge(
+            "level", "...", registry=self.registry, backend=self.backend
+        )
+        jobs.inc()
+        level.set(1)
+        first = generate_latest(self.registry)
+        with mock.patch.object(
+            Redis, "hgetall", side_effect=AssertionError
+        ):
+            self.assertEqual(first, generate_latest(self.registry))
+
+        level.set(2)
+        read = []
+        hgetall = Redis.hgetall
+
+        def spy(conn, key):
+            read.append(key)
+            return hgetall(conn, key)
+
+        with mock.patch.object(Redis, "hgetall", spy):
+            exposition = generate_latest(self.registry)
+        self.assertIn("level 2.0", self.exposition_samples(exposition))
+        self.assertEqual(["prometheus_level"], read)
+
+        # expired without any write
+        self.redis.delete("prometheus_level")
+        self.assertNotIn(
+            "level 2.0",
+            self.exposition_samples(generate_latest(self.registry)),
+        )
+        # read as before without prefetched generations
+        with mock.patch.object(Redis, "hgetall", spy):
+            jobs.collect()
+        self.assertEqual(["prometheus_level", "prometheus_jobs"], read)
+
+    def test_pruned_series(self):
+        backend = Backend(redis=self.redis, redis_series_expire=60)
+        jobs = redis.Counter(
+            "jobs", "...", ["kind"], registry=self.registry, backend=backend
+        )
+        jobs.labels("a").inc()
+        jobs.labels("b").inc()
+        self.assertEqual(
+            2, len(self.exposition_samples(generate_latest(self.registry)))
+        )
+        self.redis.zadd("prometheus_jobs:touched", {'{"kind":"a"}': 0})
+        self.assertEqual(
+            {'jobs_total{kind="b"} 1.0'},
+            self.exposition_samples(generate_latest(self.registry)),
+        )
+
+
+@pytest.mark.usefixtures("samples")
+class SqliteGenerationsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.conn = sqlite3.connect(":memory:")
+        self.backend = Backend(sqlite=self.conn)
+        self.registry = CollectorRegistry()
+
+    def _generation(self, name):
+        row = self.conn.execute(
+            "SELECT generation FROM metrics_generations WHERE metric_key = ?",
+            (name,),
+        ).fetchone()
+        return None if row is None else row[0]
+
+    def test_unchanged_families_not_read(self):
+        jobs = sqlite.Counter(
+            "jobs", "...", registry=self.registry, backend=self.backend
+        )
+        latency = sqlite.Histogram(
+            "latency",
+            "...",
+            registry=self.registry,
+            backend=self.backend,
+            buckets=(1,),
+            packed=True,
+        )
+        jobs.inc()
+        latency.observe(0.5)
+        self.assertEqual(2, self._generation("jobs"))  # _created, _total
+        self.assertEqual(1, self._generation("latency"))
+        first = generate_latest(self.registry)
+
+        statements = []
+        self.conn.set_trace_callback(statements.append)
+        self.assertEqual(first, generate_latest(self.registry))
+        self.assertEqual(
+            1, len(statements), "only the generations are read"
+        )
+        self.assertIn("metrics_generations", statements[0])
+
+        latency.observe(2)
+        statements.clear()
+        self.assertIn(
+            "latency_count 2.0",
+            self.exposition_samples(generate_latest(self.registry)),
+        )
+        self.assertFalse(
+            [
+                statement
+                for statement in statements[1:]
+                if "'jobs'" in statement
+            ]
+        )
+        # once per deleted row
+        self.conn.execute("DELETE FROM metrics WHERE metric_key = 'jobs'")
+        self.assertEqual(4, self._generation("jobs"))
+        self.assertNotIn(
+            "jobs_total 1.0",
+            self.exposition_samples(generate_latest(self.registry)),
+        )
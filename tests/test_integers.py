@@ -0,0 +1,204 @@
+import json
+import sqlite3
+import unittest
+from unittest import mock
+
+import pytest
+from prometheus_client import CollectorRegistry
+from prometheus_distributed_client import Backend, redis, sqlite
+from prometheus_distributed_client.exporter import declare_family
+from prometheus_distributed_client.integers import execute_increments
+from prometheus_distributed_client.resilience import queue_ops
+from redis import Redis
+from redis.client import Pipeline
+
+
+@pytest.mark.usefixtures("redis_creds")
+class IntegerFieldsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.redis = Redis(**self.redis_creds)
+        self.redis.flushdb()
+        self.backend = Backend(redis=self.redis)
+        self.registry = CollectorRegistry()
+
+    def tearDown(self):
+        self.redis.flushdb()
+
+    def _commands(self, func):
+        """Fields incremented by func, by command."""
+        commands = {"hincrby": [], "hincrbyfloat": []}
+
+        def spy(command):
+            original = getattr(Pipeline, command)
+
+            def wrapper(pipe, key, field, amount):
+                if key != self.backend.redis_generations_key():
+                    commands[command].append((field.split(":")[0], amount))
+                return original(pipe, key, field, amount)
+
+            return mock.patch.object(Pipeline, command, wrapper)
+
+        with spy("hincrby"), spy("hincrbyfloat"):
+            func()
+        return commands
+
+    def test_counts_incremented_as_integers(self):
+        histogram = redis.Histogram(
+            "latency",
+            "...",
+            registry=self.registry,
+            backend=self.backend,
+            buckets=(1,),
+        )
+        commands = self._commands(lambda: histogram.observe(0.5))
+        self.assertEqual(
+            [("_bucket", 1), ("_bucket", 1), ("_count", 1)],
+            commands["hincrby"],
+        )
+        self.assertEqual([("_sum", 0.5)], commands["hincrbyfloat"])
+
+        sampled = redis.Histogram(
+            "sampled",
+            "...",
+            registry=self.registry,
+            backend=self.backend,
+            sample_rate=0.999999,
+        )
+        commands = self._commands(lambda: sampled.observe(0.5))
+        self.assertFalse(commands["hincrby"])
+
+    def test_integer_counter(self):
+        counter = redis.Counter(
+            "jobs",
+            "...",
+            ["kind"],
+            registry=self.registry,
+            backend=self.backend,
+            integer=True,
+            rollups=[[]],
+        )
+        commands = self._commands(lambda: counter.labels("a").inc(2.0))
+        self.assertEqual([("_total", 2)] * 2, commands["hincrby"])
+        self.assertIsInstance(commands["hincrby"][0][1], int)
+        with self.assertRaises(ValueError):
+            counter.labels("a").inc(0.5)
+        with self.assertRaises(ValueError):
+            redis.Counter(
+                "sampled",
+                "...",
+                registry=None,
+                backend=self.backend,
+                integer=True,
+                sample_rate=0.5,
+            )
+        plain = redis.Counter(
+            "plain", "...", registry=self.registry, backend=self.backend
+        )
+        commands = self._commands(lambda: plain.inc())
+        self.assertEqual([("_total", 1.0)], commands["hincrbyfloat"])
+
+        metadata = json.loads(self.redis.hget("prometheus:metadata", "jobs"))
+        self.assertTrue(metadata["integer"])
+        self.assertTrue(
+            declare_family(self.backend, "jobs", metadata)._integer
+        )
+
+    def test_sampled_then_unsampled_writers(self):
+        sampled = redis.Histogram(
+            "latency",
+            "...",
+            registry=None,
+            backend=self.backend,
+            buckets=(1,),
+            sample_rate=0.6,
+        )
+        while not self.redis.hexists("prometheus_latency", "_count:{}"):
+            sampled.observe(0.5)
+        count = float(self.redis.hget("prometheus_latency", "_count:{}"))
+        self.assertFalse(count.is_integer())
+        unsampled = redis.Histogram(
+            "latency",
+            "...",
+            registry=self.registry,
+            backend=self.backend,
+            buckets=(1,),
+        )
+        unsampled.observe(0.5)
+        self.assertAlmostEqual(
+            count + 1,
+            float(self.redis.hget("prometheus_latency", "_count:{}")),
+        )
+
+        pipe = self.redis.pipeline()
+        queue_ops(
+            self.redis,
+            pipe,
+            [("inc", ("prometheus_latency",), "_count:{}", 1)],
+            60,
+        )
+        results = execute_increments(pipe)
+        self.assertAlmostEqual(count + 2, float(results[0]))
+
+    def test_mixed_encodings(self):
+        counter = redis.Counter(
+            "jobs",
+            "...",
+            registry=self.registry,
+            backend=self.backend,
+            integer=True,
+        )
+        pipe = self.redis.pipeline()
+        queue_ops(
+            self.redis,
+            pipe,
+            [
+                ("inc", ("prometheus_jobs",), "_total:{}", 2),
+                ("inc", ("prometheus_jobs",), "_sum:{}", 0.5),
+            ],
+            60,
+        )
+        pipe.execute()
+        counter.inc()
+        self.redis.hincrbyfloat("prometheus_jobs", "_sum:{}", 1)
+        self.assertEqual(
+            {("jobs_total", 3.0), ("jobs_sum", 1.5)},
+            {
+                (sample.name, sample.value)
+                for sample in counter.collect()[0].samples
+                if sample.name != "jobs_created"
+            },
+        )
+
+    def test_sqlite_integer_storage(self):
+        conn = sqlite3.connect(":memory:")
+        backend = Backend(sqlite=conn)
+        histogram = sqlite.Histogram(
+            "latency",
+            "...",
+            registry=self.registry,
+            backend=backend,
+            buckets=(1,),
+        )
+        histogram.observe(0.5)
+        histogram.observe(2)
+        self.assertEqual(
+            {
+                "_bucket": "integer",
+                "_count": "integer",
+                "_created": "real",
+                "_sum": "real",
+            },
+            dict(
+                conn.execute(
+                    "SELECT substr(subkey, 1, instr(subkey, ':') - 1), "
+                    "typeof(value) FROM metrics"
+                )
+            ),
+        )
+        values = {
+            sample.name: sample.value
+            for sample in histogram.collect()[0].samples
+        }
+        self.assertEqual(2.0, values["latency_count"])
+        self.assertIsInstance(values["latency_count"], float)
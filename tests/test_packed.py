@@ -0,0 +1,119 @@
+import json
+import sqlite3
+import unittest
+
+from prometheus_client import CollectorRegistry, generate_latest
+from prometheus_distributed_client import Backend, sqlite
+from prometheus_distributed_client.exporter import declare_family
+from prometheus_distributed_client.exposition import generate_latest as render
+from prometheus_distributed_client.snapshot import migrate, read_backend
+
+
+def _samples(registry):
+    return sorted(
+        (sample.name, tuple(sorted(sample.labels.items())), sample.value)
+        for family in registry.collect()
+        for sample in family.samples
+        if not sample.name.endswith("_created")
+    )
+
+
+class PackedHistogramTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.conn = sqlite3.connect(":memory:")
+        self.backend = Backend(sqlite=self.conn, created="series")
+        self.registry = CollectorRegistry()
+
+    def _histogram(self, registry, packed, **kwargs):
+        return sqlite.Histogram(
+            "latency",
+            "...",
+            ["path"],
+            registry=registry,
+            backend=Backend(sqlite=sqlite3.connect(":memory:"))
+            if registry is not self.registry
+            else self.backend,
+            buckets=(1, 5),
+            packed=packed,
+            **kwargs,
+        )
+
+    def _observe(self, histogram):
+        for amount in (0.5, 2, 2, 10):
+            histogram.labels("/").observe(amount)
+        histogram.labels("/a").observe(3)
+
+    def test_one_row_per_series(self):
+        statements = []
+        self.conn.set_trace_callback(statements.append)
+        histogram = self._histogram(self.registry, True)
+        self._observe(histogram)
+        writes = [
+            statement
+            for statement in statements
+            if "metrics_histograms" in statement
+        ]
+        # traced again for the generation trigger, and for its statement
+        self.assertEqual(5 * 3, len(writes))
+        self.assertEqual(
+            2,
+            self.conn.execute(
+                "SELECT COUNT(*) FROM metrics_histograms"
+            ).fetchone()[0],
+        )
+        self.assertEqual(
+            0, self.conn.execute("SELECT COUNT(*) FROM metrics").fetchone()[0]
+        )
+
+    def test_same_samples_as_rows(self):
+        packed = self._histogram(self.registry, True)
+        self._observe(packed)
+        rows_registry = CollectorRegistry()
+        self._observe(self._histogram(rows_registry, False))
+        self.assertEqual(_samples(rows_registry), _samples(self.registry))
+        self.assertIn(
+            b'latency_bucket{le="5.0",path="/"} 3.0',
+            render(self.registry),
+        )
+        created = [
+            sample
+            for family in self.registry.collect()
+            for sample in family.samples
+            if sample.name == "latency_created"
+        ]
+        self.assertEqual(2, len(created))
+
+    def test_rollups_and_declared_family(self):
+        histogram = self._histogram(self.registry, True, rollups=[[]])
+        self._observe(histogram)
+        self.assertEqual(
+            3,
+            self.conn.execute(
+                "SELECT COUNT(*) FROM metrics_histograms"
+            ).fetchone()[0],
+        )
+        metadata = json.loads(sqlite.stored_metadata(self.backend)["latency"])
+        self.assertTrue(metadata["packed"])
+        declared = declare_family(self.backend, "latency", metadata)
+        self.assertTrue(declared._packed)
+        registry = CollectorRegistry()
+        registry.register(declared)
+        self.assertEqual(_samples(self.registry), _samples(registry))
+
+    def test_snapshot_in_row_layout(self):
+        self._observe(self._histogram(self.registry, True))
+        target = Backend(sqlite=sqlite3.connect(":memory:"))
+        migrate(self.backend, target)
+        values = {
+            entry[0]: entry[1]
+            for record in read_backend(target)
+            for entry in record.get("values", ())
+        }
+        self.assertEqual(4, values['_count:{"path":"/"}'])
+        self.assertEqual(3, values['_bucket:{"le":"5.0","path":"/"}'])
+        self.assertEqual(
+            generate_latest(self.registry).count(b"latency_bucket"),
+            sum(subkey.startswith("_bucket") for subkey in values),
+        )
+
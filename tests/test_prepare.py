@@ -0,0 +1,101 @@
+import sqlite3
+import unittest
+from unittest.mock import patch
+
+import pytest
+from prometheus_client import CollectorRegistry
+from prometheus_distributed_client import redis, setup, sqlite
+from prometheus_distributed_client.config import DEFAULT_BACKEND
+from prometheus_distributed_client.prepare import prepare_registry
+from redis import Redis
+from redis.client import Pipeline
+
+
+@pytest.mark.usefixtures("samples")
+class SqlitePrepareTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.conn = sqlite3.connect(":memory:")
+        setup(sqlite=self.conn)
+        self.registry = CollectorRegistry()
+
+    def test_prepare_in_one_transaction(self):
+        counter = sqlite.Counter(
+            "requests", "...", ["path"], registry=self.registry
+        )
+        counter.labels("/a").inc(3)
+        statements = []
+        self.conn.set_trace_callback(statements.append)
+        children = counter.prepare([("/a",), ("/b",), ("/c",)])
+        self.conn.set_trace_callback(None)
+        self.assertEqual(3, len(children))
+        self.assertEqual(1, statements.count("COMMIT"))
+        self.assertEqual(
+            {
+                ("requests_total", (("path", "/a"),)): 3,
+                ("requests_total", (("path", "/b"),)): 0,
+                ("requests_total", (("path", "/c"),)): 0,
+            },
+            self.sample_values(self.registry),
+        )
+        created = self.conn.execute(
+            "SELECT COUNT(*) FROM metrics WHERE subkey LIKE '_created:%'"
+        ).fetchone()[0]
+        self.assertEqual(3, created)
+
+    def test_gauge_modes_left_unset(self):
+        gauge = sqlite.Gauge(
+            "peak", "...", registry=self.registry, multiprocess_mode="max"
+        )
+        gauge.prepare()
+        self.assertEqual({}, self.sample_values(self.registry))
+
+
+@pytest.mark.usefixtures("redis_creds", "samples")
+class RedisPrepareTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.redis = Redis(**self.redis_creds)
+        self.redis.flushdb()
+        setup(redis=self.redis)
+        self.registry = CollectorRegistry()
+
+    def tearDown(self):
+        self.redis.flushdb()
+
+    def test_prepare_registry_in_one_pipeline(self):
+        counter = redis.Counter(
+            "requests", "...", ["path"], registry=self.registry
+        )
+        histogram = redis.Histogram(
+            "latency", "...", ["path"], buckets=(1,), registry=self.registry
+        )
+        redis.Summary("size", "...", registry=self.registry)
+        redis.Counter("other", "...", ["path"], registry=self.registry)
+        DEFAULT_BACKEND.connect()  # stores the metadata
+        with patch.object(
+            Pipeline, "execute", autospec=True, side_effect=Pipeline.execute
+        ) as execute:
+            prepare_registry(
+                self.registry,
+                {"requests": [("/a",)], "latency": [("/a",), ("/b",)]},
+            )
+        self.assertEqual(1, execute.call_count)
+        samples = self.sample_values(self.registry)
+        self.assertEqual(0, samples[("requests_total", (("path", "/a"),))])
+        self.assertEqual(
+            0, samples[("latency_bucket", (("le", "+Inf"), ("path", "/b")))]
+        )
+        self.assertEqual(0, samples[("size_count", ())])
+        self.assertNotIn("other_total", {name for name, _ in samples})
+        self.assertTrue(
+            self.redis.hexists(
+                "prometheus_requests", '_created:{"path":"/a"}'
+            )
+        )
+        self.assertGreater(self.redis.ttl("prometheus_latency"), 0)
+        # _created is not sent again on first use
+        with patch.object(redis.ValueClass, "setnx") as setnx:
+            counter.labels("/a").inc()
+            histogram.labels("/b").observe(2)
+        setnx.assert_not_called()
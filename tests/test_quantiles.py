@@ -0,0 +1,212 @@
+import json
+import os
+import sqlite3
+import tempfile
+import time
+import unittest
+
+import pytest
+from prometheus_client import CollectorRegistry
+from prometheus_distributed_client import redis, setup, sqlite
+from prometheus_distributed_client.exporter import Exporter
+from prometheus_distributed_client.quantiles import (
+    DDSketch,
+    flush_sketches,
+    merge_encoded,
+)
+from redis import Redis
+
+
+def _quantiles(registry):
+    return {
+        (
+            family.name,
+            tuple(sorted(sample.labels.items())),
+        ): sample.value
+        for family in registry.collect()
+        for sample in family.samples
+        if "quantile" in sample.labels
+    }
+
+
+class DDSketchTestCase(unittest.TestCase):
+
+    def test_relative_accuracy(self):
+        sketch = DDSketch(0.01)
+        for i in range(1, 10001):
+            sketch.add(i / 1000)
+        for q in (0.0, 0.5, 0.9, 0.99, 1.0):
+            expected = max(1, round(q * 9999) + 1) / 1000
+            self.assertAlmostEqual(
+                expected, sketch.quantile(q), delta=expected * 0.01
+            )
+
+    def test_signs_and_weights(self):
+        sketch = DDSketch()
+        sketch.add(-2)
+        sketch.add(0, weight=2)
+        sketch.add(3)
+        sketch.add(float("nan"))
+        self.assertAlmostEqual(-2, sketch.quantile(0), delta=0.02)
+        self.assertEqual(0, sketch.quantile(0.5))
+        self.assertAlmostEqual(3, sketch.quantile(1), delta=0.03)
+        self.assertIsNone(DDSketch().quantile(0.5))
+
+    def test_bounded_merge(self):
+        sketch = DDSketch(max_bins=10)
+        for i in range(1, 1001):
+            sketch.add(i)
+        self.assertEqual(10, len(sketch.bins))
+        self.assertEqual(1000, sum(sketch.bins.values()))
+        # the highest quantiles are kept, the lowest collapsed
+        self.assertAlmostEqual(1000, sketch.quantile(1), delta=10)
+        other = DDSketch(max_bins=10)
+        other.add(0.5)
+        merged = json.loads(
+            merge_encoded(sketch.encode(), other.encode(), 10)
+        )
+        self.assertEqual(10, len(merged))
+        self.assertEqual(1001, sum(merged.values()))
+
+
+class SqliteQuantilesTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.conn = sqlite3.connect(":memory:")
+        setup(sqlite=self.conn)
+        self.registry = CollectorRegistry()
+
+    def test_merged_across_processes(self):
+        summaries = [
+            sqlite.Summary(
+                "latency",
+                "...",
+                ["path"],
+                registry=registry,
+                quantiles=(0.5, 0.99),
+                rollups=[[]],
+            )
+            for registry in (self.registry, CollectorRegistry())
+        ]
+        for i in range(1, 1001):  # odd and even values in two processes
+            summaries[i % 2].labels("/").observe(i)
+        # a scrape flushes the sketches of its own process only
+        _quantiles(self.registry)
+        self.assertFalse(summaries[0].labels("/")._sketch.bins)
+        self.assertTrue(summaries[1].labels("/")._sketch.bins)
+        for summary in summaries:
+            summary.flush_quantiles()
+        quantiles = _quantiles(self.registry)
+        self.assertAlmostEqual(
+            500,
+            quantiles[("latency", (("path", "/"), ("quantile", "0.5")))],
+            delta=5,
+        )
+        self.assertAlmostEqual(
+            990,
+            quantiles[("all:latency", (("quantile", "0.99"),))],
+            delta=10,
+        )
+        count = {
+            sample.name: sample.value
+            for family in self.registry.collect()
+            for sample in family.samples
+        }["latency_count"]
+        self.assertEqual(1000, count)
+
+    def test_flush_interval(self):
+        summary = sqlite.Summary(
+            "size",
+            "...",
+            registry=self.registry,
+            quantiles=(0.5,),
+            quantile_flush_interval=0,
+        )
+        summary.observe(4)
+        self.assertEqual(
+            {("size", (("quantile", "0.5"),)): summary._sketch._value("p70")},
+            _quantiles(self.registry),
+        )
+
+    def test_flushed_in_background(self):
+        with tempfile.TemporaryDirectory() as directory:
+            setup(
+                sqlite=sqlite3.connect(
+                    os.path.join(directory, "metrics.db"),
+                    check_same_thread=False,
+                )
+            )
+            summary = sqlite.Summary(
+                "size",
+                "...",
+                registry=self.registry,
+                quantiles=(0.5,),
+                quantile_flush_interval=0.1,
+            )
+            summary.observe(1)
+            time.sleep(0.5)
+            # merged without any other observation or scrape
+            self.assertFalse(summary._sketch.bins)
+            self.assertEqual(
+                [("{}",)],
+                summary._target.sqlite.execute(
+                    "SELECT labels FROM metrics_sketches"
+                ).fetchall(),
+            )
+
+    def test_exported(self):
+        sqlite.Summary(
+            "latency", "...", registry=self.registry, quantiles=(0.9,)
+        ).observe(2)
+        flush_sketches()
+        exported = Exporter().stream()
+        self.assertIn(b'latency{quantile="0.9"} 1.99', b"".join(exported))
+
+
+@pytest.mark.usefixtures("redis_creds")
+class RedisQuantilesTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.redis = Redis(**self.redis_creds)
+        self.redis.flushdb()
+        setup(redis=self.redis)
+        self.registry = CollectorRegistry()
+
+    def tearDown(self):
+        self.redis.flushdb()
+
+    def test_bounded_merge(self):
+        summary = redis.Summary(
+            "latency",
+            "...",
+            ["path"],
+            registry=self.registry,
+            quantiles=(0.5, 1),
+            max_bins=20,
+            max_children=1,
+        )
+        for i in range(1, 101):
+            summary.labels("/a").observe(i)
+        summary.labels("/b").observe(1)  # evicts and flushes /a
+        self.assertTrue(
+            self.redis.hexists("prometheus_latency:sketches", '{"path":"/a"}')
+        )
+        flush_sketches()
+        for i in range(101, 201):
+            summary.labels("/a").observe(i)
+        summary.flush_quantiles()
+        stored = json.loads(
+            self.redis.hget("prometheus_latency:sketches", '{"path":"/a"}')
+        )
+        self.assertEqual(20, len(stored))
+        self.assertEqual(200, sum(stored.values()))
+        quantiles = _quantiles(self.registry)
+        self.assertAlmostEqual(
+            200,
+            quantiles[("latency", (("path", "/a"), ("quantile", "1.0")))],
+            delta=2,
+        )
+        self.assertIn(
+            ("latency", (("path", "/b"), ("quantile", "0.5"))), quantiles
+        )
+        self.assertGreater(self.redis.ttl("prometheus_latency:sketches"), 0)
@@ -0,0 +1,68 @@
+import unittest
+from unittest.mock import MagicMock, patch
+
+from prometheus_distributed_client.read_cache import (
+    MISS,
+    ReadCache,
+    RedisInvalidationListener,
+)
+
+
+class ReadCacheTestCase(unittest.TestCase):
+
+    def test_lru_bound(self):
+        cache = ReadCache(2, 60)
+        for subkey in "abc":
+            cache.put("key", subkey, 1.0, cache.token("key"))
+        self.assertIs(MISS, cache.get("key", "a"))
+        self.assertEqual(1.0, cache.get("key", "c"))
+
+    def test_max_staleness(self):
+        cache = ReadCache(2, 60)
+        cache.put("key", "a", 1.0, cache.token("key"))
+        with patch("time.monotonic", return_value=10**9):
+            self.assertIs(MISS, cache.get("key", "a"))
+
+    def test_version(self):
+        cache = ReadCache(2, 60)
+        cache.put("key", "a", 1.0, cache.token("key"), version=1)
+        self.assertEqual(1.0, cache.get("key", "a", version=1))
+        self.assertIs(MISS, cache.get("key", "a", version=2))
+
+    def test_invalidated_while_reading(self):
+        cache = ReadCache(2, 60)
+        token = cache.token("key")
+        other = cache.token("other")
+        cache.invalidate("key", "a")
+        cache.put("key", "a", 1.0, token)
+        self.assertIs(MISS, cache.get("key", "a"))
+        # writes to other keys leave the read cacheable
+        cache.put("other", "a", 1.0, other)
+        self.assertEqual(1.0, cache.get("other", "a"))
+        token = cache.token("other")
+        cache.clear()
+        cache.put("other", "a", 1.0, token)
+        self.assertIs(MISS, cache.get("other", "a"))
+
+    def test_tracking_invalidation(self):
+        cache = ReadCache(4, 60)
+        for key, subkey in (
+            ("prometheus_a", "_total:{}"),
+            ("prometheus_a", "_created:{}"),
+            ("prometheus_b", "_total:{}"),
+        ):
+            cache.put(key, subkey, 1.0, cache.token(key))
+        listener = RedisInvalidationListener(
+            MagicMock(), "prometheus_", cache
+        )
+        channel = b"__redis__:invalidate"
+        listener.handle([b"message", channel, [b"prometheus_a"]])
+        self.assertIs(MISS, cache.get("prometheus_a", "_total:{}"))
+        self.assertIs(MISS, cache.get("prometheus_a", "_created:{}"))
+        self.assertEqual(1.0, cache.get("prometheus_b", "_total:{}"))
+        listener.handle([b"message", channel, None])
+        self.assertIs(MISS, cache.get("prometheus_b", "_total:{}"))
+
+
+if __name__ == "__main__":
+    unittest.main()
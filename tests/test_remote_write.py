@@ -0,0 +1,145 @@
+import os
+import sqlite3
+import struct
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+from prometheus_client import CollectorRegistry
+from prometheus_distributed_client import setup
+from prometheus_distributed_client import sqlite as sqlite_metrics
+from prometheus_distributed_client.compression import (
+    _compress,
+    _decompress,
+)
+from prometheus_distributed_client.remote_write import RemoteWritePusher
+
+
+def _read_varint(data, pos):
+    value, shift = 0, 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7F) << shift
+        shift += 7
+        if not byte & 0x80:
+            return value, pos
+
+
+def _fields(data):
+    pos = 0
+    while pos < len(data):
+        key, pos = _read_varint(data, pos)
+        if key & 7 == 2:
+            size, pos = _read_varint(data, pos)
+            yield key >> 3, data[pos:pos + size]
+            pos += size
+        elif key & 7 == 1:
+            yield key >> 3, struct.unpack("<d", data[pos:pos + 8])[0]
+            pos += 8
+        else:
+            value, pos = _read_varint(data, pos)
+            yield key >> 3, value
+
+
+def decode_write_request(body):
+    series = {}
+    for _, timeseries in _fields(_decompress(body)):
+        labels, value = [], None
+        for number, payload in _fields(timeseries):
+            if number == 1:
+                label = dict(_fields(payload))
+                labels.append((label[1].decode(), label[2].decode()))
+            else:
+                value = dict(_fields(payload))[1]
+        series[tuple(labels)] = value
+    return series
+
+
+class Receiver(BaseHTTPRequestHandler):
+    requests: list
+    failures: list
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        if self.failures:
+            self.send_response(self.failures.pop())
+        else:
+            self.requests.append(decode_write_request(body))
+            self.send_response(204)
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class RemoteWriteTestCase(unittest.TestCase):
+
+    def setUp(self):
+        setup(sqlite=sqlite3.connect(":memory:"))
+        self.registry = CollectorRegistry()
+        self.handler = type(
+            "Handler", (Receiver,), {"requests": [], "failures": []}
+        )
+        server = HTTPServer(("127.0.0.1", 0), self.handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        self.url = f"http://127.0.0.1:{server.server_port}/api/v1/write"
+
+    def test_snappy_roundtrip(self):
+        for data in (b"", b"abcd" * 1000, os.urandom(5000)):
+            self.assertEqual(data, _decompress(_compress(data)))
+        self.assertLess(len(_compress(b"abcd" * 1000)), 400)
+
+    def test_push(self):
+        metric = sqlite_metrics.Counter(
+            "fleshwound", "fleshwound", ["cross"], registry=self.registry
+        )
+        metric.labels("black").inc(3)
+        pusher = RemoteWritePusher(
+            self.url, registry=self.registry, labels={"job": "batch"}
+        )
+        self.assertEqual(2, pusher.push())
+        self.assertEqual(
+            3.0,
+            self.handler.requests[0][
+                (
+                    ("__name__", "fleshwound_total"),
+                    ("cross", "black"),
+                    ("job", "batch"),
+                )
+            ],
+        )
+
+    def test_chunks_and_retries(self):
+        metric = sqlite_metrics.Gauge(
+            "shruberry", "shruberry", ["cross"], registry=self.registry
+        )
+        for i in range(10):
+            metric.labels(str(i)).set(i)
+        self.handler.failures.extend([503, 429])
+        pusher = RemoteWritePusher(
+            self.url,
+            registry=self.registry,
+            max_request_bytes=100,
+            senders=2,
+            min_backoff=0.01,
+        )
+        self.assertEqual(10, pusher.push())
+        self.assertGreater(len(self.handler.requests), 1)
+        received = {}
+        for request in self.handler.requests:
+            received.update(request)
+        self.assertEqual(
+            set(range(10)), {int(value) for value in received.values()}
+        )
+
+    def test_refused(self):
+        sqlite_metrics.Gauge(
+            "shruberry", "shruberry", registry=self.registry
+        ).set(1)
+        self.handler.failures.append(400)
+        pusher = RemoteWritePusher(self.url, registry=self.registry)
+        self.assertEqual(0, pusher.push())
+        self.assertEqual([], self.handler.requests)
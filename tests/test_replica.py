@@ -0,0 +1,118 @@
+import unittest
+from unittest.mock import patch
+
+import pytest
+from prometheus_client import CollectorRegistry
+from prometheus_distributed_client import setup
+from prometheus_distributed_client.config import DEFAULT_BACKEND
+from prometheus_distributed_client.exposition import generate_latest
+from prometheus_distributed_client.redis import Counter
+from redis import ConnectionPool, Redis
+
+IN_SYNC = {
+    "role": "slave",
+    "master_link_status": "up",
+    "master_sync_in_progress": 0,
+    "master_last_io_seconds_ago": 1,
+    "slave_repl_offset": 900,
+}
+
+
+@pytest.mark.usefixtures("redis_creds")
+class ReplicaReadTestCase(unittest.TestCase):
+    """The fake Redis server has no replication: db 1 plays the replica of
+    db 0 and INFO replication is mocked."""
+
+    def setUp(self):
+        creds = self.redis_creds
+        self.primary = Redis(**creds)
+        self.replica = Redis(**{**creds, "db": 1})
+        for conn in (self.primary, self.replica):
+            conn.flushdb()
+        self.registry = CollectorRegistry()
+
+    def tearDown(self):
+        for conn in (self.primary, self.replica):
+            conn.flushdb()
+
+    def _setup(self, **kwargs):
+        setup(redis=self.primary, redis_read=self.replica, **kwargs)
+        DEFAULT_BACKEND.replica_reader.check_interval = 0
+
+    def _total(self):
+        return {
+            sample.name: sample.value
+            for family in self.registry.collect()
+            for sample in family.samples
+        }["requests_total"]
+
+    def test_reads_from_replica_in_sync(self):
+        self._setup()
+        Counter("requests", "...", registry=self.registry).inc(2)
+        self.assertEqual(
+            b"2", self.primary.hget("prometheus_requests", "_total:{}")
+        )
+        self.replica.hset("prometheus_requests", "_total:{}", 1)  # lagging
+        with patch.object(self.replica, "info", return_value=IN_SYNC):
+            self.assertEqual(1, self._total())
+        with patch.object(
+            self.replica,
+            "info",
+            return_value={**IN_SYNC, "master_last_io_seconds_ago": 30},
+        ):
+            self.assertEqual(2, self._total())
+        with patch.object(
+            self.replica,
+            "info",
+            return_value={**IN_SYNC, "master_link_status": "down"},
+        ):
+            self.assertEqual(2, self._total())
+
+    def test_byte_lag(self):
+        self._setup(redis_read_max_lag_bytes=50)
+        Counter("requests", "...", registry=self.registry).inc(2)
+        self.replica.hset("prometheus_requests", "_total:{}", 1)
+        with patch.object(
+            self.replica, "info", return_value=IN_SYNC
+        ), patch.object(
+            self.primary, "info", return_value={"master_repl_offset": 1000}
+        ) as primary_info:
+            self.assertEqual(2, self._total())
+            primary_info.return_value = {"master_repl_offset": 920}
+            self.assertEqual(1, self._total())
+
+    def test_unreachable_replica(self):
+        setup(
+            redis=self.primary,
+            redis_read=ConnectionPool(port=1, socket_connect_timeout=0.1),
+        )
+        DEFAULT_BACKEND.replica_reader._in_sync = True
+        DEFAULT_BACKEND.replica_reader._next_check = float("inf")
+        Counter("requests", "...", registry=self.registry).inc(2)
+        self.assertEqual(2, self._total())
+        self.assertFalse(DEFAULT_BACKEND.replica_reader._in_sync)
+
+    def test_generation_read_with_fields(self):
+        self._setup()
+        Counter("requests", "...", registry=self.registry).inc(2)
+        generation = self.primary.hget(
+            "prometheus:generations", "prometheus_requests"
+        )
+        # the replica is one write behind
+        self.replica.hset("prometheus_requests", "_total:{}", 1)
+        self.replica.hset(
+            "prometheus:generations",
+            "prometheus_requests",
+            int(generation) - 1,
+        )
+        down = {**IN_SYNC, "master_link_status": "down"}
+        # generations read from the primary, then fields from the replica
+        with patch.object(self.replica, "info", side_effect=[down, IN_SYNC]):
+            self.assertIn(
+                b"requests_total 1.0", generate_latest(self.registry)
+            )
+        # the stale fields are not taken for the primary's generation
+        with patch.object(self.replica, "info", return_value=down):
+            self.assertIn(
+                b"requests_total 2.0", generate_latest(self.registry)
+            )
@@ -0,0 +1,207 @@
+import os
+import socket
+import tempfile
+import time
+import unittest
+from unittest.mock import patch
+
+import pytest
+from prometheus_client import CollectorRegistry
+from prometheus_distributed_client import redis, setup
+from prometheus_distributed_client.config import get_redis_write_guard
+from prometheus_distributed_client.resilience import (
+    CircuitBreaker,
+    Spool,
+    WriteGuard,
+)
+from redis import Redis
+
+
+def _closed_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+class CircuitBreakerTestCase(unittest.TestCase):
+
+    def test_open_and_half_open(self):
+        breaker = CircuitBreaker(failure_threshold=2, reset_timeout=10)
+        breaker.record_failure()
+        self.assertTrue(breaker.allow())
+        breaker.record_failure()
+        self.assertTrue(breaker.is_open)
+        self.assertFalse(breaker.allow())
+        with patch("time.monotonic", return_value=time.monotonic() + 11):
+            self.assertTrue(breaker.allow())  # the trial
+            self.assertFalse(breaker.allow())
+        breaker.record_success()
+        self.assertFalse(breaker.is_open)
+        self.assertTrue(breaker.allow())
+
+
+class SpoolTestCase(unittest.TestCase):
+
+    def test_aggregation_and_bound(self):
+        spool = Spool(2)
+        spool.add([("inc", ("a",), "x", 1.0), ("max", ("a", "t"), "y", 3)])
+        spool.add([("inc", ("a",), "x", 2.0), ("max", ("a", "t"), "y", 1)])
+        spool.add([("set", ("a",), "z", 5)])
+        self.assertEqual(2, len(spool))
+        self.assertEqual(1, spool.dropped)
+        self.assertEqual(
+            [("inc", ("a",), "x", 3.0), ("max", ("a", "t"), "y", 3)],
+            spool.take(10),
+        )
+
+    def test_restore_is_older(self):
+        spool = Spool(10)
+        spool.add([("mostrecent", ("a", "t"), "x", [1, 100])])
+        taken = spool.take(10)
+        spool.add([("mostrecent", ("a", "t"), "x", [2, 50])])
+        spool.restore(taken)
+        spool.add([("set", ("a",), "y", 1)])
+        spool.restore([("set", ("a",), "y", 0)])
+        self.assertEqual(
+            [
+                ("mostrecent", ("a", "t"), "x", [1, 100]),
+                ("set", ("a",), "y", 1),
+            ],
+            spool.take(10),
+        )
+
+    def test_file_reload_and_compaction(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "spool")
+            spool = Spool(2, path)
+            for _ in range(5):
+                spool.add([("inc", ("a",), "x", 1.0)])
+            with open(path, encoding="utf8") as fd:
+                self.assertEqual(1, len(fd.readlines()))  # compacted
+            spool.add([("inc", ("a",), "x", 1.0)])
+            with open(path, "a", encoding="utf8") as fd:
+                fd.write('["inc", ["a"]')  # torn by a crash
+            reloaded = Spool(2, path)
+            self.assertEqual([("inc", ("a",), "x", 6.0)], reloaded.take(10))
+
+
+@pytest.mark.usefixtures("redis_creds")
+class WriteGuardTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.live = Redis(**self.redis_creds)
+        self.live.flushdb()
+        setup(
+            redis=Redis(port=_closed_port()),
+            redis_write_timeout=0.05,
+            created="disabled",
+        )
+        self.guard = get_redis_write_guard()
+
+    def tearDown(self):
+        self.live.flushdb()
+
+    def test_spool_then_replay(self):
+        registry = CollectorRegistry()
+        counter = redis.Counter("spooled", "...", ["a"], registry=registry)
+        gauge = redis.Gauge(
+            "spooled_max", "...", registry=registry, multiprocess_mode="max"
+        )
+        started = time.monotonic()
+        for value in range(100):
+            counter.labels("x").inc()
+            gauge.set(value)
+        self.assertLess(time.monotonic() - started, 1)
+        self.assertIn(
+            ("inc", ("prometheus_spooled",), '_total:{"a":"x"}'),
+            self.guard.spool._entries,
+        )
+
+        # Redis is back
+        self.guard.client = self.live
+        self.guard.breaker.reset_timeout = 0
+        self.guard._replayer.join(5)
+        self.assertEqual(0, len(self.guard.spool))
+        self.assertEqual(
+            b"100",
+            self.live.hget("prometheus_spooled", '_total:{"a":"x"}'),
+        )
+        self.assertEqual(
+            b"99.0", self.live.hget("prometheus_spooled_max", ":{}")
+        )
+        self.assertIn(b"spooled", self.live.hkeys("prometheus:metadata"))
+        self.assertEqual(-1, self.live.ttl("prometheus:metadata"))
+
+    def _replay(self, guard, ops):
+        guard.spool.add(ops)
+        guard._start_replay()
+        replayer = guard._replayer
+        if replayer is not None:
+            replayer.join(5)
+
+    def test_rejected_batch_dropped(self):
+        self.live.set("prometheus_wrong", "not a hash")
+        guard = WriteGuard(self.live, 1, 10)
+        with self.assertLogs("prometheus_distributed_client.resilience"):
+            self._replay(
+                guard,
+                [
+                    ("inc", ("prometheus_wrong",), "_total:{}", 1.0),
+                    ("inc", ("prometheus_ok",), "_total:{}", 1.0),
+                ],
+            )
+        # the other commands of the transaction were applied
+        self.assertEqual(1, guard.rejected)
+        self.assertEqual(b"1", self.live.hget("prometheus_ok", "_total:{}"))
+        self.assertEqual(0, len(guard.spool))
+        self.assertIsNone(guard._replayer)
+        self.assertTrue(guard.available())
+        # the next spooled writes are replayed
+        self._replay(guard, [("inc", ("prometheus_ok",), "_total:{}", 1.0)])
+        self.assertEqual(b"2", self.live.hget("prometheus_ok", "_total:{}"))
+
+    def test_replayed_without_expire(self):
+        guard = WriteGuard(self.live, 1, 10)
+        self._replay(
+            guard,
+            [
+                (
+                    "mostrecent",
+                    ("prometheus_recent", "prometheus_recent:timestamps"),
+                    ":{}",
+                    (2.0, 100.0),
+                )
+            ],
+        )
+        self.assertEqual(0, guard.rejected)
+        self.assertEqual(b"2.0", self.live.hget("prometheus_recent", ":{}"))
+        self.assertEqual(-1, self.live.ttl("prometheus_recent:timestamps"))
+
+    def test_file_compacted_per_batch(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "spool")
+            guard = WriteGuard(self.live, 1, 10, path)
+            replay_batch = guard._replay_batch
+            spooled = []
+
+            def spy(ops):
+                with open(path, encoding="utf8") as fd:
+                    spooled.append(len(fd.readlines()))
+                return replay_batch(ops)
+
+            guard._replay_batch = spy
+            with patch(
+                "prometheus_distributed_client.resilience.REPLAY_BATCH_SIZE",
+                1,
+            ):
+                self._replay(
+                    guard,
+                    [
+                        ("inc", ("prometheus_a",), "_total:{}", 1.0),
+                        ("inc", ("prometheus_b",), "_total:{}", 1.0),
+                    ],
+                )
+            # the first batch left the file before the second was sent
+            self.assertEqual([2, 1], spooled)
+            with open(path, encoding="utf8") as fd:
+                self.assertEqual([], fd.readlines())
@@ -0,0 +1,88 @@
+import unittest
+from unittest.mock import patch
+
+from prometheus_client import CollectorRegistry
+from prometheus_distributed_client import setup
+from prometheus_distributed_client.sampling import Sampler
+from prometheus_distributed_client.sqlite import Counter, Histogram, Summary
+
+
+class SamplerTestCase(unittest.TestCase):
+
+    def test_sample(self):
+        self.assertEqual(1, Sampler().sample())
+        sampler = Sampler(0.25)
+        with patch(
+            "prometheus_distributed_client.sampling._random",
+            side_effect=[0.1, 0.3],
+        ):
+            self.assertEqual(4, sampler.sample())
+            self.assertEqual(0, sampler.sample())
+        with self.assertRaises(ValueError):
+            Sampler(0)
+
+    def test_adaptive_rate(self):
+        with patch("time.monotonic", return_value=0):
+            sampler = Sampler(0.5, max_write_rate=100)
+        with patch("time.monotonic", return_value=0.5):
+            for _ in range(999):
+                sampler.sample()
+        self.assertEqual(0.5, sampler.rate)
+        with patch("time.monotonic", return_value=2):
+            sampler.sample()  # 1000 events in 2 seconds
+        self.assertEqual(0.2, sampler.rate)
+        with patch("time.monotonic", return_value=12):
+            sampler.sample()  # traffic dropped
+        self.assertEqual(0.5, sampler.rate)
+
+
+class SampledMetricsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        setup(sqlite=":memory:")
+        self.registry = CollectorRegistry()
+
+    def _samples(self):
+        return {
+            (sample.name, sample.labels.get("le")): sample.value
+            for family in self.registry.collect()
+            for sample in family.samples
+        }
+
+    def test_unbiased(self):
+        counter = Counter(
+            "events", "...", ["kind"], registry=self.registry, sample_rate=0.1
+        )
+        for _ in range(20000):
+            counter.labels("a").inc(2)
+        self.assertEqual(0.1, counter.labels("a").sample_rate)
+        self.assertAlmostEqual(
+            40000, self._samples()[("events_total", None)], delta=4000
+        )
+
+    def test_scaled_writes(self):
+        histogram = Histogram(
+            "latency",
+            "...",
+            buckets=(1,),
+            registry=self.registry,
+            sample_rate=0.5,
+        )
+        summary = Summary(
+            "size", "...", registry=self.registry, sample_rate=0.5
+        )
+        with patch(
+            "prometheus_distributed_client.sampling._random",
+            side_effect=[0.1, 0.9, 0.2, 0.9],
+        ):
+            histogram.observe(3)
+            histogram.observe(3)  # skipped
+            summary.observe(3)
+            summary.observe(3)  # skipped
+        samples = self._samples()
+        self.assertEqual(2, samples[("latency_count", None)])
+        self.assertEqual(6, samples[("latency_sum", None)])
+        self.assertEqual(0, samples[("latency_bucket", "1.0")])
+        self.assertEqual(2, samples[("latency_bucket", "+Inf")])
+        self.assertEqual(2, samples[("size_count", None)])
+        self.assertEqual(6, samples[("size_sum", None)])
@@ -0,0 +1,180 @@
+import os
+import sqlite3
+import tempfile
+import threading
+import unittest
+from unittest import mock
+from urllib.error import HTTPError
+from urllib.request import urlopen
+
+import pytest
+from prometheus_client import CollectorRegistry
+from prometheus_distributed_client import Backend, redis, setup, sqlite
+from prometheus_distributed_client.exporter import Exporter, make_server
+from prometheus_distributed_client.exposition import generate_latest
+from redis import Redis
+
+
+@pytest.mark.usefixtures("redis_creds", "samples")
+class SelectionTestCase(unittest.TestCase):
+    """The same families, filtered, on both backends."""
+
+    def setUp(self):
+        self.redis = Redis(**self.redis_creds)
+        self.redis.flushdb()
+        self.conn = sqlite3.connect(":memory:")
+
+    def tearDown(self):
+        self.redis.flushdb()
+
+    def _fill(self, module, backend):
+        registry = CollectorRegistry()
+        jobs = module.Counter(
+            "jobs", "...", ["kind", "host"], registry=registry, backend=backend
+        )
+        jobs.labels("a|b", "h1").inc()
+        jobs.labels("a|b", "h2").inc(2)
+        jobs.labels("c", "h1").inc(3)
+        latency = module.Histogram(
+            "latency",
+            "...",
+            ["kind"],
+            registry=registry,
+            backend=backend,
+            buckets=(1,),
+        )
+        latency.labels("a|b").observe(0.5)
+        latency.labels("c").observe(2)
+        module.Gauge(
+            "other", "...", registry=registry, backend=backend
+        ).set(1)
+        return registry
+
+    def _check(self, registry):
+        self.assertEqual(
+            {
+                'jobs_total{host="h1",kind="a|b"} 1.0',
+                'jobs_total{host="h2",kind="a|b"} 2.0',
+                'latency_bucket{kind="a|b",le="1.0"} 1.0',
+                'latency_bucket{kind="a|b",le="+Inf"} 1.0',
+                'latency_count{kind="a|b"} 1.0',
+                'latency_sum{kind="a|b"} 0.5',
+            },
+            self.exposition_samples(
+                generate_latest(
+                    registry,
+                    names=["jobs", "latency"],
+                    matchers={"kind": "a|b"},
+                )
+            ),
+        )
+        self.assertEqual(
+            {'latency_bucket{kind="c",le="1.0"} 0.0'},
+            self.exposition_samples(
+                generate_latest(
+                    registry,
+                    names=["latency_bucket"],
+                    matchers={"kind": "c", "le": "1.0"},
+                )
+            ),
+        )
+        exposition = generate_latest(registry, names=["jobs_created"])
+        self.assertEqual(3, exposition.count(b"\njobs_created{"))
+        self.assertNotIn(b"\njobs_total{", exposition)
+        self.assertEqual(
+            b"", generate_latest(registry, matchers={"unknown": "x"})
+        )
+
+    def test_redis_both_encodings(self):
+        backend = Backend(redis=self.redis, redis_field_encoding="compact")
+        registry = self._fill(redis, backend)
+        self._check(registry)
+        with mock.patch.object(Redis, "hgetall", side_effect=AssertionError):
+            generate_latest(registry, matchers={"kind": "c"})
+        # the same value in the json encoding
+        self.redis.hset(
+            "prometheus_jobs", '_total:{"host":"h1","kind":"a|b"}', 1
+        )
+        self.assertIn(
+            'jobs_total{host="h1",kind="a|b"} 2.0',
+            self.exposition_samples(
+                generate_latest(registry, matchers={"host": "h1"})
+            ),
+        )
+
+    def test_sqlite(self):
+        backend = Backend(sqlite=self.conn, created="family")
+        registry = self._fill(sqlite, backend)
+        statements = []
+        self.conn.set_trace_callback(statements.append)
+        self._check(registry)
+        self.assertFalse(
+            [statement for statement in statements if "'other'" in statement]
+        )
+
+    def test_sqlite_packed_and_quantiles(self):
+        backend = Backend(sqlite=self.conn)
+        registry = CollectorRegistry()
+        latency = sqlite.Histogram(
+            "latency",
+            "...",
+            ["kind"],
+            registry=registry,
+            backend=backend,
+            buckets=(1,),
+            packed=True,
+        )
+        latency.labels("a").observe(0.5)
+        latency.labels("c").observe(2)
+        size = sqlite.Summary(
+            "size",
+            "...",
+            ["kind"],
+            registry=registry,
+            backend=backend,
+            quantiles=(0.5,),
+        )
+        size.labels("a").observe(3)
+        size.labels("c").observe(4)
+        size.flush_quantiles()
+        samples = self.exposition_samples(
+            generate_latest(registry, matchers={"kind": "a"})
+        )
+        # 2 buckets, count and sum, then quantile, count and sum
+        self.assertEqual(7, len(samples))
+        self.assertTrue(all('{kind="a"' in line for line in samples))
+        self.assertIn('latency_bucket{kind="a",le="+Inf"} 1.0', samples)
+
+
+@pytest.mark.usefixtures("samples")
+class ExporterSelectionTestCase(unittest.TestCase):
+
+    def test_query_parameters(self):
+        with tempfile.TemporaryDirectory() as directory:
+            setup(
+                sqlite=sqlite3.connect(
+                    os.path.join(directory, "metrics.db"),
+                    check_same_thread=False,
+                )
+            )
+            registry = CollectorRegistry()
+            sqlite.Counter(
+                "jobs", "...", ["kind"], registry=registry
+            ).labels("a").inc()
+            sqlite.Counter(
+                "jobs", "...", ["kind"], registry=CollectorRegistry()
+            ).labels("b").inc()
+            sqlite.Gauge("other", "...", registry=registry).set(1)
+            server = make_server("127.0.0.1", 0, Exporter())
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            self.addCleanup(server.server_close)
+            self.addCleanup(server.shutdown)
+            url = f"http://127.0.0.1:{server.server_port}/metrics"
+            with urlopen(f"{url}?name[]=jobs_total&match[]=kind=a") as resp:
+                self.assertEqual(
+                    {'jobs_total{kind="a"} 1.0'},
+                    self.exposition_samples(resp.read()),
+                )
+            with self.assertRaises(HTTPError) as raised:
+                urlopen(f"{url}?match[]=kind")
+            self.assertEqual(400, raised.exception.code)
@@ -0,0 +1,149 @@
+import json
+import os
+import sqlite3
+import tempfile
+import unittest
+
+import pytest
+from prometheus_client import CollectorRegistry
+from prometheus_distributed_client import Backend, redis, sqlite
+from prometheus_distributed_client.snapshot import (
+    export_snapshot,
+    import_snapshot,
+    migrate,
+    read_backend,
+)
+from redis import Redis
+
+
+def _values(backend):
+    return {
+        (record["family"], entry[0]): entry[1]
+        for record in read_backend(backend)
+        for entry in record.get("values", ())
+        if not entry[0].startswith("_created")
+    }
+
+
+@pytest.mark.usefixtures("redis_creds")
+class SnapshotTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.redis = Redis(**self.redis_creds)
+        self.redis.flushdb()
+        self.directory = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.redis.flushdb()
+        self.directory.cleanup()
+
+    def _sqlite_source(self, increment=2):
+        backend = Backend(sqlite=sqlite3.connect(":memory:"))
+        registry = CollectorRegistry()
+        sqlite.Counter(
+            "jobs", "...", ["kind"], registry=registry, backend=backend
+        ).labels("a|b").inc(increment)
+        sqlite.Gauge(
+            "peak",
+            "...",
+            registry=registry,
+            backend=backend,
+            multiprocess_mode="max",
+        ).set(increment)
+        sqlite.Gauge(
+            "last",
+            "...",
+            registry=registry,
+            backend=backend,
+            multiprocess_mode="mostrecent",
+        ).set(increment)
+        sqlite.Summary(
+            "size",
+            "...",
+            registry=registry,
+            backend=backend,
+            quantiles=(0.5,),
+        ).observe(increment)
+        for metric in registry._collector_to_names:
+            getattr(metric, "flush_quantiles", lambda: None)()
+        return backend
+
+    def test_sqlite_to_redis_through_file(self):
+        source = self._sqlite_source()
+        path = os.path.join(self.directory.name, "metrics.jsonl.gz")
+        self.assertEqual(7, export_snapshot(path, source))
+        target = Backend(
+            redis=self.redis,
+            redis_prefix="moved",
+            redis_field_encoding="compact",
+        )
+        self.assertEqual(7, import_snapshot(path, target))
+        self.assertEqual(b"2", self.redis.hget("moved_jobs", "~t|a\\|b"))
+        self.assertIn(b"size", self.redis.hkeys("moved:metadata"))
+        self.assertEqual(1, len(self.redis.hkeys("moved_size:sketches")))
+        self.assertTrue(self.redis.hget("moved_last:timestamps", "~g"))
+        self.assertEqual(_values(source), _values(target))
+
+    def test_merge(self):
+        target = Backend(sqlite=sqlite3.connect(":memory:"))
+        for increment in (2, 3):
+            migrate(self._sqlite_source(increment), target, merge=True)
+        values = _values(target)
+        self.assertEqual(5, values[("jobs", '_total:{"kind":"a|b"}')])
+        self.assertEqual(3, values[("peak", ":{}")])
+        self.assertEqual(3, values[("last", ":{}")])
+        self.assertEqual(2, values[("size", "_count:{}")])
+        sketch = json.loads(
+            target.sqlite.execute(
+                "SELECT sketch FROM metrics_sketches"
+            ).fetchone()[0]
+        )
+        self.assertEqual(2, sum(sketch.values()))
+
+        registry = CollectorRegistry()
+        redis_source = Backend(redis=self.redis)
+        redis.Counter(
+            "jobs", "...", ["kind"], registry=registry, backend=redis_source
+        ).labels("a|b").inc()
+        migrate(redis_source, target, merge=True)
+        self.assertEqual(
+            6, _values(target)[("jobs", '_total:{"kind":"a|b"}')]
+        )
+
+    def test_merged_sketches_bounded(self):
+        sqlite_target = Backend(sqlite=sqlite3.connect(":memory:"))
+        redis_target = Backend(redis=self.redis)
+        for values in ((1, 10, 100), (1000, 10000)):
+            source = Backend(sqlite=sqlite3.connect(":memory:"))
+            summary = sqlite.Summary(
+                "size",
+                "...",
+                registry=None,
+                backend=source,
+                quantiles=(0.5,),
+                max_bins=2,
+            )
+            for value in values:
+                summary.observe(value)
+            summary.flush_quantiles()
+            for target in (sqlite_target, redis_target):
+                migrate(source, target, merge=True)
+        # collapsed to the max_bins of the family
+        for stored in (
+            sqlite_target.sqlite.execute(
+                "SELECT sketch FROM metrics_sketches"
+            ).fetchone()[0],
+            self.redis.hget("prometheus_size:sketches", "{}"),
+        ):
+            sketch = json.loads(stored)
+            self.assertEqual(2, len(sketch))
+            self.assertEqual(5, sum(sketch.values()))
+
+    def test_version_checked(self):
+        path = os.path.join(self.directory.name, "metrics.jsonl")
+        with open(path, "w", encoding="utf8") as fd:
+            fd.write(
+                '{"format": "prometheus-distributed-client", "version": 2}\n'
+            )
+        with self.assertRaises(ValueError):
+            import_snapshot(path, Backend(sqlite=sqlite3.connect(":memory:")))
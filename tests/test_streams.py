@@ -0,0 +1,103 @@
+import unittest
+from unittest import mock
+
+import pytest
+from prometheus_client import CollectorRegistry
+from prometheus_distributed_client import Backend, redis, setup
+from prometheus_distributed_client.config import DEFAULT_BACKEND
+from prometheus_distributed_client.streams import StreamAggregator
+from redis import Redis
+from redis.client import Pipeline
+from redis.exceptions import ConnectionError as RedisConnectionError
+
+
+@pytest.mark.usefixtures("redis_creds")
+class StreamIngestionTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.redis = Redis(**self.redis_creds)
+        self.redis.flushdb()
+        setup(
+            redis=self.redis,
+            redis_stream=True,
+            redis_stream_flush_interval=60,
+        )
+        self.registry = CollectorRegistry()
+        self.aggregator = StreamAggregator(self.redis, consumer="first")
+        self.aggregator.create_group()
+
+    def tearDown(self):
+        setup(redis=self.redis)  # stops the stream writer
+        self.redis.flushdb()
+
+    def test_writes_appended_then_aggregated(self):
+        counter = redis.Counter(
+            "jobs", "...", ["kind"], registry=self.registry
+        )
+        gauge = redis.Gauge("last", "...", registry=self.registry)
+        for _ in range(3):
+            counter.labels("cron").inc()
+        gauge.set(7)
+        gauge.set(5)
+        self.assertFalse(self.redis.exists("prometheus_jobs"))
+        DEFAULT_BACKEND.stream_writer.flush()
+        self.assertEqual(1, self.redis.xlen("prometheus:stream"))
+
+        self.assertEqual(1, self.aggregator.run_once())
+        self.assertEqual(
+            b"3", self.redis.hget("prometheus_jobs", '_total:{"kind":"cron"}')
+        )
+        self.assertEqual(b"5.0", self.redis.hget("prometheus_last", ":{}"))
+        self.assertIn(
+            b'_created:{"kind":"cron"}', self.redis.hkeys("prometheus_jobs")
+        )
+        self.assertGreater(self.redis.ttl("prometheus_jobs"), 0)
+        self.assertEqual(0, self.redis.xlen("prometheus:stream"))
+
+    def test_batches_of_processes_merged(self):
+        writers = [
+            Backend(redis=self.redis, redis_stream=True, created="disabled")
+            for _ in range(2)
+        ]
+        for backend in writers:
+            counter = redis.Counter(
+                "jobs", "...", registry=CollectorRegistry(), backend=backend
+            )
+            counter.inc(2)
+            backend.stream_writer.close()
+        self.assertEqual(2, self.aggregator.run_once())
+        self.assertEqual(b"4", self.redis.hget("prometheus_jobs", "_total:{}"))
+
+    def test_flushed_at_batch_size(self):
+        setup(redis=self.redis, redis_stream=True, redis_stream_batch_size=3)
+        counter = redis.Counter(
+            "jobs", "...", ["kind"], registry=self.registry
+        )
+        # _created and the generation of the family are the first fields
+        counter.labels("a")
+        counter.labels("a").inc()
+        self.assertEqual(1, self.redis.xlen("prometheus:stream"))
+
+    def test_failed_flush_kept_pending(self):
+        setup(redis=self.redis, redis_stream=True, redis_stream_batch_size=1)
+        counter = redis.Counter("jobs", "...", registry=self.registry)
+        with mock.patch.object(
+            Pipeline, "execute", side_effect=RedisConnectionError
+        ), self.assertLogs("prometheus_distributed_client.streams"):
+            counter.inc()  # the error does not reach the caller
+        self.assertEqual(0, self.redis.xlen("prometheus:stream"))
+        DEFAULT_BACKEND.stream_writer.flush()
+        self.assertEqual(1, self.aggregator.run_once())
+        self.assertEqual(b"1", self.redis.hget("prometheus_jobs", "_total:{}"))
+
+    def test_pending_entries_claimed(self):
+        redis.Counter("jobs", "...", registry=self.registry).inc()
+        DEFAULT_BACKEND.stream_writer.flush()
+        self.assertEqual(1, len(self.aggregator._read()))  # then dies
+        self.assertEqual(0, self.aggregator.run_once())
+        self.assertIsNone(self.redis.hget("prometheus_jobs", "_total:{}"))
+
+        other = StreamAggregator(self.redis, consumer="other", claim_idle=0)
+        self.assertEqual(1, other.run_once())
+        self.assertEqual(b"1", self.redis.hget("prometheus_jobs", "_total:{}"))
+        self.assertEqual(0, self.redis.xlen("prometheus:stream"))